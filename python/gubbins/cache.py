@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+# encoding: utf-8
+#
+# Wellcome Trust Sanger Institute
+# Copyright (C) 2013  Wellcome Trust Sanger Institute
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+#
+
+
+import os
+import json
+import shutil
+import hashlib
+import tempfile
+from gubbins.checkpoint import hash_file
+
+entry_filename = "entry.json"
+
+def normalise_command(command, substitutions):
+    """Replaces run-specific paths and names in a command with placeholders, longest first, such that the
+    commands of runs in different directories or with different prefixes can be compared"""
+    for original in sorted(substitutions, key = len, reverse = True):
+        if len(original) > 0:
+            command = command.replace(original, substitutions[original])
+    return command
+
+class ResultCache:
+    """Directory of the outputs of expensive stages, shared between runs and keyed on a hash of the stage
+    parameters and the contents of its input files. Each entry is a directory containing the outputs numbered
+    in order; the least recently used entries are evicted once the cache exceeds its size limit. No results are
+    cached if no directory is specified."""
+
+    def __init__(self, directory, max_size, substitutions = None):
+        """Opens the cache, creating the directory if necessary"""
+        self.directory = directory
+        self.max_size = max_size
+        self.substitutions = {} if substitutions is None else substitutions
+        self.hits = 0
+        self.misses = 0
+        if self.directory is not None:
+            os.makedirs(self.directory, exist_ok = True)
+
+    def get_key(self, stage, inputs, parameters):
+        """Get the key of a stage from the hashes of its input files and its parameters, with run-specific
+        paths and names removed"""
+        if self.directory is None:
+            return None
+        description = {'stage': stage,
+                       'parameters': [normalise_command(str(parameter), self.substitutions) for parameter in parameters],
+                       'inputs': [hash_file(filename) for filename in inputs]}
+        return hashlib.blake2b(json.dumps(description).encode(), digest_size = 16).hexdigest()
+
+    def restore(self, key, outputs):
+        """Copies the outputs of a cached stage to the named files and returns True, or returns False if the
+        stage is not in the cache"""
+        if key is None:
+            return False
+        entry_directory = os.path.join(self.directory, key)
+        entry_file = os.path.join(entry_directory, entry_filename)
+        if not os.path.isfile(entry_file):
+            self.misses += 1
+            return False
+        with open(entry_file, 'r') as entry_json:
+            entry = json.load(entry_json)
+        if len(entry['outputs']) != len(outputs):
+            self.misses += 1
+            return False
+        for index,output_filename in enumerate(outputs):
+            shutil.copyfile(os.path.join(entry_directory, str(index)), output_filename)
+        # The modification time of the entry records when it was last used
+        os.utime(entry_directory)
+        self.hits += 1
+        return True
+
+    def store(self, key, outputs):
+        """Copies the outputs of a stage into the cache, then evicts the least recently used entries if the
+        cache exceeds its size limit"""
+        if key is None:
+            return
+        # Entries are written to a temporary directory and then renamed, such that incomplete entries are never read
+        temporary_directory = tempfile.mkdtemp(dir = self.directory, prefix = '.' + key)
+        for index,output_filename in enumerate(outputs):
+            shutil.copyfile(output_filename, os.path.join(temporary_directory, str(index)))
+        with open(os.path.join(temporary_directory, entry_filename), 'w') as entry_json:
+            json.dump({'outputs': [os.path.basename(filename) for filename in outputs]}, entry_json)
+        entry_directory = os.path.join(self.directory, key)
+        if os.path.isdir(entry_directory):
+            shutil.rmtree(entry_directory)
+        os.replace(temporary_directory, entry_directory)
+        self.evict()
+
+    def get_entries(self):
+        """Get the keys, last use times and sizes of the entries in the cache, from least to most recently used"""
+        entries = []
+        for key in os.listdir(self.directory):
+            entry_directory = os.path.join(self.directory, key)
+            if key.startswith('.') or not os.path.isfile(os.path.join(entry_directory, entry_filename)):
+                continue
+            entry_size = sum(os.path.getsize(os.path.join(entry_directory, filename))
+                             for filename in os.listdir(entry_directory))
+            entries.append((os.path.getmtime(entry_directory), key, entry_size))
+        return sorted(entries)
+
+    def size(self):
+        """Get the total size of the entries in the cache"""
+        if self.directory is None:
+            return 0
+        return sum(entry_size for _,_,entry_size in self.get_entries())
+
+    def evict(self):
+        """Removes the least recently used entries until the cache is within its size limit"""
+        entries = self.get_entries()
+        total_size = sum(entry_size for _,_,entry_size in entries)
+        for _,key,entry_size in entries:
+            if total_size <= self.max_size:
+                break
+            shutil.rmtree(os.path.join(self.directory, key), ignore_errors = True)
+            total_size -= entry_size
@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+# encoding: utf-8
+#
+# Wellcome Trust Sanger Institute
+# Copyright (C) 2013  Wellcome Trust Sanger Institute
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+#
+
+import os
+import sys
+import json
+import hashlib
+
+checkpoint_suffix = ".checkpoint.json"
+
+def hash_file(filename, block_size = 2**20):
+    """Returns the hash of the contents of a file, or None if it does not exist"""
+    if not os.path.isfile(filename):
+        return None
+    digest = hashlib.blake2b(digest_size = 16)
+    with open(filename, 'rb') as input_file:
+        for block in iter(lambda: input_file.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+class CheckpointManifest:
+    """Record of the completed stages of a run, with the hashes of the files each stage read and wrote.
+
+    Later stages overwrite some of the files written by earlier stages, so the files on disk only represent
+    the state of the run after the last of a sequence of completed stages. When resuming, the stages up to
+    the latest point at which every recorded file is unchanged are skipped, if they are encountered in the
+    same order with the same parameters; every stage from the first that is run is then rerun."""
+
+    def __init__(self, filename, working_directory = None, seed = None, resume = False):
+        """Starts a new manifest, or continues that in an existing file if resuming"""
+        self.filename = filename
+        self.working_directory = working_directory
+        self.seed = seed
+        self.stages = []
+        self.pending_stages = {}
+        self.hashes = {}
+        if resume:
+            if not os.path.isfile(filename):
+                sys.stderr.write('Checkpoint file ' + filename + ' does not exist\n')
+                sys.exit(1)
+            with open(filename, 'r') as manifest_file:
+                manifest = json.load(manifest_file)
+            self.working_directory = manifest['working_directory']
+            self.seed = manifest['seed']
+            self.stages = manifest['stages']
+        # Stages can be skipped until the first stage that is run, after which every stage is recorded
+        self.position = 0
+        self.resumable_stages = self.count_resumable_stages()
+
+    def get_hash(self, filename, cached = True):
+        """Get the hash of a file; when checking the recorded stages, hashes are only recalculated for files
+        that have been modified since they were last read"""
+        if not os.path.isfile(filename):
+            return None
+        file_stat = os.stat(filename)
+        file_key = (file_stat.st_size, file_stat.st_mtime_ns)
+        if not cached or filename not in self.hashes or self.hashes[filename][0] != file_key:
+            self.hashes[filename] = (file_key, hash_file(filename))
+        return self.hashes[filename][1]
+
+    def count_resumable_stages(self):
+        """Get the number of recorded stages after which every file read or written by the run is unchanged"""
+        expected_hashes = {}
+        resumable_stages = 0
+        for stage_index,stage in enumerate(self.stages):
+            for filename,file_hash in stage['inputs'].items():
+                expected_hashes.setdefault(filename, file_hash)
+            expected_hashes.update(stage['outputs'])
+            if all(self.get_hash(filename) == file_hash for filename,file_hash in expected_hashes.items()):
+                resumable_stages = stage_index + 1
+        return resumable_stages
+
+    def is_complete(self, stage_name, inputs, parameters = ''):
+        """Returns whether a stage can be skipped. Otherwise, the input hashes are stored for when the stage is
+        recorded, and no later stages are skipped"""
+        if self.position < self.resumable_stages:
+            stage = self.stages[self.position]
+            # Inputs written by earlier stages are checked as part of the state of the run
+            earlier_outputs = set()
+            for earlier_stage in self.stages[:self.position]:
+                earlier_outputs.update(earlier_stage['outputs'])
+            if stage['stage'] == stage_name and stage['parameters'] == parameters \
+                    and sorted(stage['inputs']) == sorted(inputs) \
+                    and all(filename in earlier_outputs or self.get_hash(filename) == file_hash
+                            for filename,file_hash in stage['inputs'].items()):
+                self.position += 1
+                return True
+        self.resumable_stages = 0
+        self.pending_stages[stage_name] = {'stage': stage_name,
+                                            'parameters': parameters,
+                                            'inputs': {filename: self.get_hash(filename, cached = False) for filename in inputs}}
+        return False
+
+    def record(self, stage_name, outputs):
+        """Records the completion of a stage and the hashes of its outputs, replacing the records of any stages
+        that followed it in a previous run"""
+        stage = self.pending_stages.pop(stage_name)
+        stage['outputs'] = {filename: self.get_hash(filename, cached = False) for filename in outputs}
+        self.stages = self.stages[:self.position]
+        self.stages.append(stage)
+        self.position = len(self.stages)
+        self.write()
+
+    def get_outputs(self, stage_name):
+        """Get the output files recorded for a stage"""
+        for stage in self.stages:
+            if stage['stage'] == stage_name:
+                return list(stage['outputs'])
+        return []
+
+    def write(self):
+        """Writes the manifest, replacing the previous version only once it is complete"""
+        temporary_filename = self.filename + '.tmp'
+        with open(temporary_filename, 'w') as manifest_file:
+            json.dump({'working_directory': self.working_directory, 'seed': self.seed, 'stages': self.stages}, manifest_file, indent = 2)
+            manifest_file.write('\n')
+        os.replace(temporary_filename, self.filename)
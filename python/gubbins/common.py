@@ -28,6 +28,7 @@ import sys
 import tempfile
 import gzip
 import time
+import concurrent.futures
 # Phylogenetic imports
 import dendropy
 # Biopython imports
@@ -44,7 +45,11 @@ from gubbins.treebuilders import FastTree, IQTree, RAxML, RAxMLNG, RapidNJ, Star
 from gubbins.pyjar import jar, get_base_patterns
 from gubbins import utils
 from gubbins.__init__ import version
-from gubbins.pyjar import jar, get_base_patterns, Pyjar
+from gubbins.pyjar import jar, get_base_patterns, get_base_pattern_dimensions, Pyjar, ReconstructionEngine, check_compiled_kernels, compiled_kernels, kernel_cache_dir
+from gubbins.tree_arrays import TreeArrays
+from gubbins.checkpoint import CheckpointManifest, checkpoint_suffix
+from gubbins.cache import ResultCache
+from gubbins.runner import Command, CommandRunner
 from gubbins.treebuilders import FastTree, IQTree, RAxML, RAxMLNG, RapidNJ, Star
 
 # Phylogenetic models valid for each algorithm
@@ -57,14 +62,39 @@ tree_models = {
     'rapidnj': ['JC','K2P']
 }
 
+# Minimum work per thread, used to choose the number of threads of each stage from the dimensions of the alignment.
+# These are rules of thumb rather than benchmarked optima, and each can be overridden with --tree-threads,
+# --recon-threads and --detect-threads:
+# - tree: unique base patterns for the external tree building, model fitting and reconstruction algorithms,
+#   following the RAxML-NG guideline of about 1,000 DNA alignment patterns per thread, below which the
+#   synchronisation of the per-pattern likelihood calculations outweighs the gain from further threads
+# - recon: pattern-sequence combinations for reconstruction with pyjar, i.e. 1 MiB of unpacked base patterns
+#   per thread, so that each worker's share outweighs the cost of starting it and attaching to shared memory
+# - detect: sequences for recombination detection, which is parallelised over the branches at each depth of the
+#   tree; 16 sequences give about 30 branches per thread
+stage_work_per_thread = {'tree': 1000, 'recon': 2**20, 'detect': 16}
+
 def parse_and_run(input_args, program_description=""):
     """Main function of the Gubbins program"""
     start_time = time.time()
     current_directory = os.getcwd()
     printer = utils.VerbosePrinter(True, "\n")
+    # Runs external commands, recording the resources used in each stage
+    command_runner = CommandRunner()
 
     # Process input options
     input_args = process_input_arguments(input_args)
+    # A run resumed from a checkpoint uses the random seed of the checkpointed run, such that its commands are
+    # repeated exactly; otherwise, a single seed is drawn for the run if none is specified
+    resume_from_checkpoint = input_args.resume is not None and input_args.resume.endswith(checkpoint_suffix)
+    if resume_from_checkpoint:
+        checkpoints = CheckpointManifest(input_args.resume, resume = True)
+        if input_args.seed is None:
+            input_args.seed = checkpoints.seed
+    input_args.seed = utils.set_seed(input_args.seed)
+    # Marginal reconstruction with pyjar uses the same model fitting and pattern arrays as joint reconstruction
+    external_mar = input_args.mar and input_args.seq_recon != 'pyjar'
+    pyjar_reconstruction = 'marginal' if input_args.mar else 'joint'
     # Check if the Gubbins C-program is available. If so, print a welcome message. Otherwise exit.
     os.environ["PATH"] = os.environ["PATH"] + ":/usr/lib/gubbins/"
     gubbins_exec = 'gubbins'
@@ -79,39 +109,24 @@ def parse_and_run(input_args, program_description=""):
     program_version = version()
     printer.print(["\n--- Gubbins " + program_version + " ---\n", program_description])
     # Log algorithms used
-    methods_log = {property:[] for property in ['citation','process','version','algorithm','model']}
+    methods_log = {property:[] for property in ['citation','process','version','algorithm','model','threads']}
     methods_log['algorithm'].append("Gubbins")
     methods_log['citation'].append("https://doi.org/10.1093/nar/gku1196")
     methods_log['process'].append("Overall")
     methods_log['version'].append(program_version)
     methods_log['model'].append("-")
+    methods_log['threads'].append(str(input_args.threads))
 
-    # Initialize tree builder and check if all required dependencies are available
+    # Check the input files; the dependencies of each algorithm are checked when it is initialised
     printer.print("\nChecking dependencies and input files...")
     current_tree_name = input_args.starting_tree
     tree_file_names = []
     internal_node_label_prefix = "internal_"
     
-    # Select the algorithms used for the first iteration
+    # Select the algorithms used for the first iteration; they are initialised once the number of threads
+    # of each stage is known
     current_tree_builder, current_model_fitter, current_model, current_recon_model, extra_tree_arguments, extra_model_arguments, custom_model, custom_recon_model = return_algorithm_choices(input_args,1)
-    check_model_validity(current_model,current_tree_builder,input_args.mar,current_recon_model,current_model_fitter,custom_model, custom_recon_model)
-    # Initialise tree builder
-    tree_builder = return_algorithm(current_tree_builder, current_model, input_args, node_labels = internal_node_label_prefix, extra = extra_tree_arguments)
-    alignment_suffix = tree_builder.alignment_suffix
-    methods_log = update_methods_log(methods_log, method = tree_builder, step = 'Tree constructor (1st iteration)')
-    # Initialise model fitter
-    model_fitter = return_algorithm(current_model_fitter, current_recon_model, input_args, node_labels = internal_node_label_prefix, extra = extra_model_arguments)
-    methods_log = update_methods_log(methods_log, method = model_fitter, step = 'Model fitter (1st iteration)')
-    # Initialise sequence reconstruction if MAR
-    if input_args.mar:
-        sequence_reconstructor = return_algorithm(input_args.seq_recon, current_recon_model, input_args, node_labels = internal_node_label_prefix, extra = input_args.seq_recon_args)
-        methods_log = update_methods_log(methods_log, method = sequence_reconstructor, step = 'Sequence reconstructor (1st iteration)')
-
-    # Initialise IQtree
-    tree_dater = IQTree(threads = input_args.threads,
-                            model = current_model,
-                            verbose = input_args.verbose
-                        )
+    check_model_validity(current_model,current_tree_builder,external_mar,current_recon_model,current_model_fitter,custom_model, custom_recon_model)
 
     # Check - and potentially correct - further input parameters
     check_and_fix_window_size(input_args)
@@ -127,9 +142,9 @@ def parse_and_run(input_args, program_description=""):
     gaps_vcf_filename = base_filename + ".gaps.vcf"
     joint_sequences_filename = base_filename + ".seq.joint.aln"
 
-    # If restarting from a previous run
+    # If restarting from a previous run, either from the stages recorded in a checkpoint file or from a tree
     starting_iteration = 1
-    if input_args.resume is not None:
+    if input_args.resume is not None and not resume_from_checkpoint:
         search_itr = re.search(r'iteration_(\d+)', input_args.resume)
         if search_itr is None:
             sys.stderr.write('Resuming a Gubbins run requires a tree file name containing the phrase "iteration_X"\n')
@@ -153,8 +168,25 @@ def parse_and_run(input_args, program_description=""):
                  "to automatically delete them or with the --use_time_stamp to add a unique prefix.")
 
     # Filter the input alignment and save as temporary alignment file
-    # Create temporary directory for storing working copies of input files
-    temp_working_dir = tempfile.mkdtemp(dir=os.getcwd())
+    # Create temporary directory for storing working copies of input files, reusing that of the checkpointed run
+    if resume_from_checkpoint and os.path.isdir(checkpoints.working_directory):
+        temp_working_dir = checkpoints.working_directory
+        printer.print("\nResuming from checkpoint " + checkpoints.filename + " (" + str(checkpoints.resumable_stages) + \
+                        " of " + str(len(checkpoints.stages)) + " recorded stages can be skipped)")
+    else:
+        if resume_from_checkpoint:
+            sys.stderr.write("Working directory of the checkpointed run is missing; all stages will be rerun\n")
+        temp_working_dir = tempfile.mkdtemp(dir=os.getcwd())
+        checkpoints = CheckpointManifest(basename + checkpoint_suffix, working_directory = temp_working_dir, seed = input_args.seed)
+    # Open the cache of results shared between runs, in which commands are compared without the directories,
+    # names and output redirection specific to this run
+    result_cache = ResultCache(None if input_args.cache_dir is None else os.path.abspath(input_args.cache_dir),
+                                int(input_args.cache_size*2**30),
+                                substitutions = {temp_working_dir: '{working_directory}',
+                                                current_directory: '{current_directory}',
+                                                base_filename: '{base_filename}',
+                                                basename: '{basename}',
+                                                ' > /dev/null 2>&1': ''})
 
     # Check if the input files exist and have the right format
     printer.print("\nChecking input alignment file...")
@@ -226,17 +258,60 @@ def parse_and_run(input_args, program_description=""):
     printer.print("...done. Run time: {:.2f} s".format(time.time() - start_time))
 
     # Find all SNP sites with Gubbins
-    gubbins_command = f"{gubbins_exec} \"{input_args.alignment_filename}\""
-    printer.print(["\nRunning Gubbins to detect SNPs...", gubbins_command])
-    try:
-        subprocess.check_call(gubbins_command, shell=True)
-    except subprocess.SubprocessError:
-        sys.exit("Gubbins crashed, please ensure you have enough free memory")
-    printer.print("...done. Run time: {:.2f} s".format(time.time() - start_time))
-    reconvert_fasta_file(snp_alignment_filename, snp_alignment_filename)
-    reconvert_fasta_file(gaps_alignment_filename, base_filename + ".start")
+    gubbins_command = Command([gubbins_exec, input_args.alignment_filename])
+    if checkpoints.is_complete('snp_extraction', [input_args.alignment_filename], str(gubbins_command)):
+        printer.print("\nSkipping SNP detection completed in the checkpointed run")
+    else:
+        printer.print(["\nRunning Gubbins to detect SNPs...", gubbins_command])
+        try:
+            command_runner.check_call('snp_extraction', gubbins_command)
+        except subprocess.SubprocessError:
+            sys.exit("Gubbins crashed (" + command_runner.describe('snp_extraction') + "), please ensure you have enough"
+                     " free memory")
+        printer.print("...done. Run time: {:.2f} s".format(time.time() - start_time))
+        reconvert_fasta_file(snp_alignment_filename, snp_alignment_filename)
+        reconvert_fasta_file(gaps_alignment_filename, base_filename + ".start")
+        checkpoints.record('snp_extraction', [filename for filename in sorted(os.listdir('.'))
+                                                if filename.startswith(base_filename + '.')
+                                                and re.match(starting_files_regex(), filename[len(base_filename):])
+                                                and filename != joint_sequences_filename])
+
+    # Choose the number of threads used in each stage from the dimensions of the alignment
+    num_taxa, num_sites, num_patterns = get_base_pattern_dimensions(base_filename)
+    stage_threads = allocate_stage_threads(input_args, num_taxa, num_patterns)
+    printer.print(["\nAlignment of {} sequences with {} polymorphic sites in {} unique base patterns".format(num_taxa,
+                                                                                                            num_sites,
+                                                                                                            num_patterns),
+                    "Threads used for tree building: {}; ancestral reconstruction: {}; recombination detection: {}".format(
+                        stage_threads['tree'],
+                        stage_threads['recon'],
+                        stage_threads['detect'])])
+    methods_log['algorithm'].append("Gubbins")
+    methods_log['citation'].append("https://doi.org/10.1093/nar/gku1196")
+    methods_log['process'].append("Recombination detection")
+    methods_log['version'].append(program_version)
+    methods_log['model'].append("-")
+    methods_log['threads'].append(str(stage_threads['detect']))
+    # Initialise the algorithms of the first iteration with the threads of their stage
+    tree_builder = return_algorithm(current_tree_builder, current_model, input_args, node_labels = internal_node_label_prefix,
+                                    extra = extra_tree_arguments, threads = stage_threads['tree'])
+    alignment_suffix = tree_builder.alignment_suffix
+    methods_log = update_methods_log(methods_log, method = tree_builder, step = 'Tree constructor (1st iteration)')
+    model_fitter = return_algorithm(current_model_fitter, current_recon_model, input_args, node_labels = internal_node_label_prefix,
+                                    extra = extra_model_arguments, threads = stage_threads['tree'])
+    methods_log = update_methods_log(methods_log, method = model_fitter, step = 'Model fitter (1st iteration)')
+    if external_mar:
+        sequence_reconstructor = return_algorithm(input_args.seq_recon, current_recon_model, input_args, node_labels = internal_node_label_prefix,
+                                                    extra = input_args.seq_recon_args, threads = stage_threads['recon'])
+        methods_log = update_methods_log(methods_log, method = sequence_reconstructor, step = 'Sequence reconstructor (1st iteration)')
+    tree_dater = IQTree(threads = stage_threads['tree'],
+                            model = current_model,
+                            verbose = input_args.verbose
+                        )
+
     # Start the main loop
     printer.print("\nEntering the main loop.")
+    reconstruction_engine = None
     for i in range(starting_iteration, input_args.iterations+1):
         printer.print("\n*** Iteration " + str(i) + " ***")
 
@@ -249,7 +324,7 @@ def parse_and_run(input_args, program_description=""):
             alignment_filename = previous_tree_name + alignment_suffix
 
         # 1.1. Construct the tree-building command depending on the iteration and employed options
-        if i == 2 or input_args.resume is not None:
+        if i == 2 or (input_args.resume is not None and not resume_from_checkpoint):
             # Select the algorithms used for the subsequent iterations
             current_tree_builder, current_model_fitter, current_model, current_recon_model, extra_tree_arguments, extra_model_arguments, custom_model, custom_recon_model = return_algorithm_choices(input_args,i)
             # Pick best model through ML tests
@@ -258,13 +333,16 @@ def parse_and_run(input_args, program_description=""):
                 current_model = select_best_models(alignment_filename,
                                                     basename,
                                                     current_tree_builder,
-                                                    input_args)
+                                                    input_args,
+                                                    threads = stage_threads['tree'],
+                                                    command_runner = command_runner)
                 input_args.model = current_model
                 if current_tree_builder != 'iqtree':
-                    check_model_validity(current_model,current_tree_builder,input_args.mar,current_recon_model,current_model_fitter,custom_model, custom_recon_model)
+                    check_model_validity(current_model,current_tree_builder,external_mar,current_recon_model,current_model_fitter,custom_model, custom_recon_model)
                 printer.print("Phylogeny will be constructed with a " + current_model + " model")
             # Initialise tree builder
-            tree_builder = return_algorithm(current_tree_builder, current_model, input_args, node_labels = internal_node_label_prefix, extra = extra_tree_arguments)
+            tree_builder = return_algorithm(current_tree_builder, current_model, input_args, node_labels = internal_node_label_prefix,
+                                            extra = extra_tree_arguments, threads = stage_threads['tree'])
             alignment_suffix = tree_builder.alignment_suffix
             methods_log = update_methods_log(methods_log, method = tree_builder, step = 'Tree constructor (later iterations)')
             # Update date model (should not make a difference)
@@ -282,9 +360,24 @@ def parse_and_run(input_args, program_description=""):
         built_tree = temp_working_dir + "/" + tree_builder.tree_prefix + current_basename + tree_builder.tree_suffix
 
         # 1.2. Construct the phylogenetic tree
+        tree_building_stage = "iteration_" + str(i) + ".tree_building"
+        tree_building_inputs = [alignment_filename]
+        if previous_tree_name and input_args.first_tree_builder != "star":
+            tree_building_inputs.append(previous_tree_name)
+        tree_building_key = result_cache.get_key('tree_building', tree_building_inputs,
+                                                    [type(tree_builder).__name__, tree_builder.version, tree_building_command])
         if input_args.starting_tree is not None and i == 1:
             printer.print("\nCopying the starting tree...")
-            shutil.copyfile(input_args.starting_tree, current_tree_name)
+            source_tree = input_args.starting_tree
+        elif current_tree_builder != "star" and \
+                checkpoints.is_complete(tree_building_stage, tree_building_inputs, str(tree_building_command)):
+            printer.print("\nSkipping tree construction completed in the checkpointed run")
+            source_tree = built_tree
+        elif current_tree_builder != "star" and \
+                result_cache.restore(tree_building_key, [built_tree]):
+            printer.print("\nReusing cached tree constructed with " + tree_builder.executable)
+            checkpoints.record(tree_building_stage, [built_tree])
+            source_tree = built_tree
         else:
 
             printer.print(["\nConstructing the phylogenetic tree with " + tree_builder.executable + "...",
@@ -295,29 +388,36 @@ def parse_and_run(input_args, program_description=""):
                             built_tree)
             else:
                 try:
-                    os.chdir(temp_working_dir)
-                    subprocess.check_call(tree_building_command, shell=True)
+                    command_runner.check_call(tree_building_stage, tree_building_command, working_directory = temp_working_dir)
                 except subprocess.SubprocessError:
-                    sys.exit("Failed while building the tree.")
-                os.chdir(current_directory)
-            shutil.copyfile(built_tree, current_tree_name)
+                    sys.exit("Failed while building the tree (" + command_runner.describe(tree_building_stage) + ").")
+                checkpoints.record(tree_building_stage, [built_tree])
+                result_cache.store(tree_building_key, [built_tree])
+            source_tree = built_tree
         printer.print("...done. Run time: {:.2f} s".format(time.time() - start_time))
 
         # 2. Re-root the tree
-        reroot_tree(str(current_tree_name), input_args.outgroup)
         temp_rooted_tree = temp_working_dir + "/" + current_tree_name + ".rooted"
-        if input_args.tree_builder == "iqtree":
-            shutil.copyfile(current_tree_name, temp_rooted_tree)
+        if checkpoints.is_complete("iteration_" + str(i) + ".reroot", [source_tree],
+                                    "outgroup: " + str(input_args.outgroup) + "; tree builder: " + input_args.tree_builder):
+            printer.print("\nSkipping tree rerooting completed in the checkpointed run")
         else:
-            root_tree(current_tree_name, temp_rooted_tree)
+            shutil.copyfile(source_tree, current_tree_name)
+            reroot_tree(str(current_tree_name), input_args.outgroup)
+            if input_args.tree_builder == "iqtree":
+                shutil.copyfile(current_tree_name, temp_rooted_tree)
+            else:
+                root_tree(current_tree_name, temp_rooted_tree)
+            # Later stages read the rooted tree, while the tree file is replaced during recombination detection
+            checkpoints.record("iteration_" + str(i) + ".reroot", [temp_rooted_tree])
 
         # 3.1. Construct the command for ancestral state reconstruction depending on the iteration and employed options
         ancestral_sequence_basename = current_basename + ".internal"
         current_tree_name_with_internal_nodes = current_tree_name + ".internal"
 
-        if not input_args.mar:
+        if not external_mar:
         
-            # 3.2a. Joint ancestral reconstruction
+            # 3.2a. Joint (or marginal) ancestral reconstruction
             printer.print(["\nReconstructing ancestral sequences with pyjar..."])
             
             if i == starting_iteration:
@@ -328,68 +428,128 @@ def parse_and_run(input_args, program_description=""):
                 ordered_sequence_names, base_pattern_bases_array, base_pattern_positions_array, max_pos = \
                                                             get_base_patterns(base_filename,
                                                                                 input_args.verbose,
-                                                                                threads = input_args.threads)
+                                                                                threads = stage_threads['recon'])
+                kernel_load_time, cached_kernels = check_compiled_kernels()
+                printer.print("Loaded pyjar kernels in {:.2f} s ({} of {} from the cache in {})".format(kernel_load_time,
+                                                                                                    cached_kernels,
+                                                                                                    len(compiled_kernels),
+                                                                                                    kernel_cache_dir))
+                # Start the reconstruction workers, which are reused in every iteration
+                reconstruction_engine = ReconstructionEngine(base_patterns = base_pattern_bases_array,
+                                                                num_samples = len(ordered_sequence_names),
+                                                                base_pattern_positions = base_pattern_positions_array,
+                                                                max_pos = max_pos,
+                                                                threads = stage_threads['recon'],
+                                                                incremental = input_args.incremental_recon,
+                                                                backend = input_args.recon_backend,
+                                                                memory_budget = None if input_args.recon_memory is None \
+                                                                                    else int(input_args.recon_memory*2**30),
+                                                                temp_dir = temp_working_dir)
+                printer.print("Base patterns packed two bases per byte in {:.1f} MB ({:.1f} MB unpacked)".format(
+                                    base_pattern_bases_array.nbytes/2**20,
+                                    len(base_pattern_bases_array)*len(ordered_sequence_names)/2**20))
+                printer.print("Ancestral sequences packed two bases per byte in {:.1f} MB ({:.1f} MB unpacked)".format(
+                                    reconstruction_engine.out_aln.nbytes/2**20,
+                                    max_pos*reconstruction_engine.ancestral_node_capacity/2**20))
+                if reconstruction_engine.out_of_core:
+                    printer.print("Ancestral sequences will be memory-mapped from files in " + temp_working_dir)
                 # 3.3b. Record in methods log (just once)
-                pyjar_method = Pyjar(current_model)
+                pyjar_method = Pyjar(current_model, threads = stage_threads['recon'])
                 methods_log = update_methods_log(methods_log, method = pyjar_method, step = 'Sequence reconstructor')
 
             # 3.4a. Re-fit full polymorphism alignment to new tree
             model_fitting_command = model_fitter.model_fitting_command(snp_alignment_filename,
                                                                 os.path.abspath(temp_rooted_tree),
                                                                 temp_working_dir + '/' + current_basename)
-            printer.print(["\nFitting substitution model to tree...", model_fitting_command])
-            try:
-                subprocess.check_call(model_fitting_command, shell = True)
-            except:
-                sys.exit("Unable to fit model to data")
-
-            # 3.5a. Joint ancestral reconstruction with new tree and info file in each iteration
             info_filename = model_fitter.get_info_filename(temp_working_dir,current_basename)
             recontree_filename = model_fitter.get_recontree_filename(temp_working_dir,current_basename)
-            # If requested, use a time-calibrated tree for sequence reconstruction
+            timetree_filename = os.path.join(temp_working_dir,base_filename + '.timetree.nwk')
+            model_fitting_stage = "iteration_" + str(i) + ".model_fit"
+            model_fitting_inputs = [snp_alignment_filename, temp_rooted_tree]
+            model_fitting_parameters = [type(model_fitter).__name__, model_fitter.version, model_fitting_command]
             if input_args.date is not None and input_args.recon_with_dates:
+                model_fitting_inputs.append(input_args.date)
                 dating_command = tree_dater.run_time_tree(snp_alignment_filename,
                                                 recontree_filename,
                                                 input_args.date,
                                                 temp_working_dir,
                                                 base_filename,
                                                 outgroup = input_args.outgroup)
+                model_fitting_parameters.extend([type(tree_dater).__name__, tree_dater.version, dating_command])
+            model_fitting_key = result_cache.get_key('model_fit', model_fitting_inputs, model_fitting_parameters)
+            if checkpoints.is_complete(model_fitting_stage, model_fitting_inputs, str(model_fitting_command)):
+                printer.print("\nSkipping model fitting completed in the checkpointed run")
+                # The reconstruction tree is the time-calibrated tree if dating succeeded
+                if timetree_filename in checkpoints.get_outputs(model_fitting_stage):
+                    recontree_filename = timetree_filename
+            elif result_cache.restore(model_fitting_key, [info_filename, recontree_filename]):
+                printer.print("\nReusing cached substitution model fitted with " + model_fitter.executable)
+                checkpoints.record(model_fitting_stage, [info_filename, recontree_filename])
+            else:
+                printer.print(["\nFitting substitution model to tree...", model_fitting_command])
                 try:
-                    subprocess.check_call(dating_command, shell=True)
-                    recontree_filename = os.path.join(temp_working_dir,base_filename + '.timetree.nwk')
+                    command_runner.check_call(model_fitting_stage, model_fitting_command)
+                except:
+                    sys.exit("Unable to fit model to data (" + command_runner.describe(model_fitting_stage) + ")")
+
+                # If requested, use a time-calibrated tree for sequence reconstruction
+                if input_args.date is not None and input_args.recon_with_dates:
+                    try:
+                        command_runner.check_call("iteration_" + str(i) + ".time_calibration", dating_command)
+                        recontree_filename = timetree_filename
+                        # Set root of reconstruction tree to match that of the current tree
+                        # Cannot just midpoint root both, because the branch lengths differ between them
+                        harmonise_roots(recontree_filename, temp_rooted_tree, algorithm = model_fitter.name)
+                    except subprocess.SubprocessError:
+                        # If this fails, continue to generate rest of output
+                        sys.stderr.write("Unable to use time calibrated tree for sequence reconstruction in "
+                        " iteration " + str(i))
+                else:
                     # Set root of reconstruction tree to match that of the current tree
                     # Cannot just midpoint root both, because the branch lengths differ between them
                     harmonise_roots(recontree_filename, temp_rooted_tree, algorithm = model_fitter.name)
-                except subprocess.SubprocessError:
-                    # If this fails, continue to generate rest of output
-                    sys.stderr.write("Unable to use time calibrated tree for sequence reconstruction in "
-                    " iteration " + str(i))
+                checkpoints.record(model_fitting_stage, [info_filename, recontree_filename])
+                result_cache.store(model_fitting_key, [info_filename, recontree_filename])
+
+            # 3.5a. Joint ancestral reconstruction with new tree and info file in each iteration
+            gaps_alignment_filename = temp_working_dir + "/" + ancestral_sequence_basename + "." + pyjar_reconstruction + ".aln"
+            raw_internal_rooted_tree_filename = temp_working_dir + "/" + ancestral_sequence_basename + "." + pyjar_reconstruction + ".tre"
+            reconstruction_stage = "iteration_" + str(i) + ".reconstruction"
+            reconstruction_inputs = [base_filename + ".start", recontree_filename, info_filename, temp_rooted_tree]
+            reconstruction_parameters = "pyjar " + pyjar_reconstruction + " reconstruction; outgroup: " + str(input_args.outgroup)
+            reconstruction_outputs = [gaps_alignment_filename, current_tree_name_with_internal_nodes]
+            reconstruction_key = result_cache.get_key('reconstruction', reconstruction_inputs,
+                                                        [program_version, input_args.model_fitter, reconstruction_parameters])
+            if checkpoints.is_complete(reconstruction_stage, reconstruction_inputs, reconstruction_parameters):
+                printer.print("\nSkipping ancestral reconstruction completed in the checkpointed run")
+            elif result_cache.restore(reconstruction_key, reconstruction_outputs):
+                printer.print("\nReusing cached " + pyjar_reconstruction + " ancestral reconstruction")
+                checkpoints.record(reconstruction_stage, reconstruction_outputs)
             else:
-                # Set root of reconstruction tree to match that of the current tree
-                # Cannot just midpoint root both, because the branch lengths differ between them
-                harmonise_roots(recontree_filename, temp_rooted_tree, algorithm = model_fitter.name)
-            
-            printer.print(["\nRunning joint ancestral reconstruction with pyjar"])
-            jar(sequence_names = ordered_sequence_names, # complete polymorphism alignment
-                base_patterns = base_pattern_bases_array, # array of unique base patterns in alignment
-                base_pattern_positions = base_pattern_positions_array, # nparray of positions of unique base patterns in alignment
-                alignment_filename = base_filename + ".start", # gap and SNP alignment file name
-                tree_filename = recontree_filename, # tree generated by model fit
-                info_filename = info_filename, # file containing evolutionary model parameters
-                info_filetype = input_args.model_fitter, # model fitter - format of file containing evolutionary model parameters
-                output_prefix = temp_working_dir + "/" + ancestral_sequence_basename, # output prefix
-                outgroup_name = input_args.outgroup, # outgroup for rooting and reconstruction
-                threads = input_args.threads, # number of cores to use
-                verbose = input_args.verbose,
-                max_pos = max_pos)
-            gaps_alignment_filename = temp_working_dir + "/" + ancestral_sequence_basename + ".joint.aln"
-            raw_internal_rooted_tree_filename = temp_working_dir + "/" + ancestral_sequence_basename + ".joint.tre"
-            printer.print(["\nTransferring pyjar results onto original recombination-corrected tree"])
-            transfer_internal_node_labels_to_tree(raw_internal_rooted_tree_filename,
-                                                  temp_rooted_tree,
-                                                  current_tree_name_with_internal_nodes,
-                                                  "pyjar")
-            printer.print(["\nDone transfer"])
+                printer.print(["\nRunning " + pyjar_reconstruction + " ancestral reconstruction with pyjar"])
+                jar(sequence_names = ordered_sequence_names, # complete polymorphism alignment
+                    base_patterns = base_pattern_bases_array, # array of unique base patterns in alignment
+                    base_pattern_positions = base_pattern_positions_array, # nparray of positions of unique base patterns in alignment
+                    alignment_filename = base_filename + ".start", # gap and SNP alignment file name
+                    tree_filename = recontree_filename, # tree generated by model fit
+                    info_filename = info_filename, # file containing evolutionary model parameters
+                    info_filetype = input_args.model_fitter, # model fitter - format of file containing evolutionary model parameters
+                    output_prefix = temp_working_dir + "/" + ancestral_sequence_basename, # output prefix
+                    outgroup_name = input_args.outgroup, # outgroup for rooting and reconstruction
+                    threads = stage_threads['recon'], # number of cores to use
+                    verbose = input_args.verbose,
+                    max_pos = max_pos,
+                    engine = reconstruction_engine,
+                    reconstruction = pyjar_reconstruction,
+                    profile = input_args.verbose)
+                printer.print(["\nTransferring pyjar results onto original recombination-corrected tree"])
+                transfer_internal_node_labels_to_tree(raw_internal_rooted_tree_filename,
+                                                      temp_rooted_tree,
+                                                      current_tree_name_with_internal_nodes,
+                                                      "pyjar")
+                printer.print(["\nDone transfer"])
+                checkpoints.record(reconstruction_stage, reconstruction_outputs)
+                result_cache.store(reconstruction_key, reconstruction_outputs)
             
         else:
 
@@ -405,65 +565,94 @@ def parse_and_run(input_args, program_description=""):
                 = temp_working_dir + "/" + sequence_reconstructor.asr_tree_prefix \
                 + ancestral_sequence_basename + sequence_reconstructor.asr_tree_suffix
 
-            # 3.3b. Reconstruct the ancestral sequence
-            printer.print(["\nReconstructing ancestral sequences with " + sequence_reconstructor.executable + "...",
-                           sequence_reconstruction_command])
-            os.chdir(temp_working_dir)
-            try:
-                subprocess.check_call(sequence_reconstruction_command, shell=True)
-            except subprocess.SubprocessError:
-                sys.exit("Failed while reconstructing the ancestral sequences.")
-            os.chdir(current_directory)
-            # 3.4b. Join ancestral sequences with given sequences
-            current_tree_name_with_internal_nodes = current_tree_name + ".internal"
-            sequence_reconstructor.convert_raw_ancestral_states_to_fasta(raw_internal_sequence_filename,
-                                                                         processed_internal_sequence_filename)
-            concatenate_fasta_files([snp_alignment_filename, processed_internal_sequence_filename],
-                                    joint_sequences_filename)
-
-            if input_args.seq_recon == "raxml":
-                transfer_internal_node_labels_to_tree(raw_internal_rooted_tree_filename, temp_rooted_tree,
-                                                  current_tree_name_with_internal_nodes, sequence_reconstructor)
-            elif input_args.seq_recon == "iqtree" or input_args.seq_recon == "raxmlng":
-                # IQtree returns an unrooted tree
-                harmonise_roots(raw_internal_rooted_tree_filename, temp_rooted_tree)
-                transfer_internal_node_labels_to_tree(raw_internal_rooted_tree_filename,
-                                                 temp_rooted_tree,
-                                                  current_tree_name_with_internal_nodes,
-                                                  sequence_reconstructor,
-                                                  use_root = False)
+            reconstruction_stage = "iteration_" + str(i) + ".reconstruction"
+            reconstruction_inputs = [base_filename + alignment_suffix, temp_rooted_tree, snp_alignment_filename,
+                                        base_filename + ".start", gaps_vcf_filename]
+            reconstruction_outputs = [gaps_alignment_filename, joint_sequences_filename,
+                                        current_tree_name_with_internal_nodes]
+            reconstruction_key = result_cache.get_key('reconstruction', reconstruction_inputs,
+                                                        [type(sequence_reconstructor).__name__, sequence_reconstructor.version,
+                                                            sequence_reconstruction_command])
+            if checkpoints.is_complete(reconstruction_stage, reconstruction_inputs, str(sequence_reconstruction_command)):
+                printer.print("\nSkipping ancestral reconstruction completed in the checkpointed run")
+            elif result_cache.restore(reconstruction_key, reconstruction_outputs):
+                printer.print("\nReusing cached ancestral reconstruction from " + sequence_reconstructor.executable)
+                checkpoints.record(reconstruction_stage, reconstruction_outputs)
             else:
-                sys.stderr.write("Unrecognised sequence reconstruction command: " + input_args.seq_recon + '\n')
-                sys.exit()
-            printer.print("...done. Run time: {:.2f} s".format(time.time() - start_time))
-            # 3.5b. Reinsert gaps (cp15 note: something is wonky here, the process is at the very least terribly inefficient)
-            printer.print("\nReinserting gaps into the alignment...")
-            shutil.copyfile(base_filename + ".start", gaps_alignment_filename)
-            reinsert_gaps_into_fasta_file(joint_sequences_filename, gaps_vcf_filename, gaps_alignment_filename)
-            if not os.path.exists(gaps_alignment_filename) \
-                    or not ValidateFastaAlignment(gaps_alignment_filename).is_input_fasta_file_valid():
-                sys.exit("There is a problem with your FASTA file after running internal sequence reconstruction. "
-                         "Please check this intermediate file is valid: " + gaps_alignment_filename)
+                # 3.3b. Reconstruct the ancestral sequence
+                printer.print(["\nReconstructing ancestral sequences with " + sequence_reconstructor.executable + "...",
+                               sequence_reconstruction_command])
+                try:
+                    command_runner.check_call(reconstruction_stage, sequence_reconstruction_command,
+                                                working_directory = temp_working_dir)
+                except subprocess.SubprocessError:
+                    sys.exit("Failed while reconstructing the ancestral sequences (" + \
+                                command_runner.describe(reconstruction_stage) + ").")
+                # 3.4b. Join ancestral sequences with given sequences
+                sequence_reconstructor.convert_raw_ancestral_states_to_fasta(raw_internal_sequence_filename,
+                                                                             processed_internal_sequence_filename)
+                concatenate_fasta_files([snp_alignment_filename, processed_internal_sequence_filename],
+                                        joint_sequences_filename)
+
+                if input_args.seq_recon == "raxml":
+                    transfer_internal_node_labels_to_tree(raw_internal_rooted_tree_filename, temp_rooted_tree,
+                                                      current_tree_name_with_internal_nodes, sequence_reconstructor)
+                elif input_args.seq_recon == "iqtree" or input_args.seq_recon == "raxmlng":
+                    # IQtree returns an unrooted tree
+                    harmonise_roots(raw_internal_rooted_tree_filename, temp_rooted_tree)
+                    transfer_internal_node_labels_to_tree(raw_internal_rooted_tree_filename,
+                                                     temp_rooted_tree,
+                                                      current_tree_name_with_internal_nodes,
+                                                      sequence_reconstructor,
+                                                      use_root = False)
+                else:
+                    sys.stderr.write("Unrecognised sequence reconstruction command: " + input_args.seq_recon + '\n')
+                    sys.exit()
+                printer.print("...done. Run time: {:.2f} s".format(time.time() - start_time))
+                # 3.5b. Reinsert gaps (cp15 note: something is wonky here, the process is at the very least terribly inefficient)
+                printer.print("\nReinserting gaps into the alignment...")
+                shutil.copyfile(base_filename + ".start", gaps_alignment_filename)
+                reinsert_gaps_into_fasta_file(joint_sequences_filename, gaps_vcf_filename, gaps_alignment_filename)
+                if not os.path.exists(gaps_alignment_filename) \
+                        or not ValidateFastaAlignment(gaps_alignment_filename).is_input_fasta_file_valid():
+                    sys.exit("There is a problem with your FASTA file after running internal sequence reconstruction. "
+                             "Please check this intermediate file is valid: " + gaps_alignment_filename)
+                checkpoints.record(reconstruction_stage, reconstruction_outputs)
+                result_cache.store(reconstruction_key, reconstruction_outputs)
 
         # Ancestral reconstruction complete
         printer.print("...done. Run time: {:.2f} s".format(time.time() - start_time))
         # 4. Detect recombination sites with Gubbins (cp15 note: copy file with internal nodes back and forth to
         # ensure all created files have the desired name structure and to avoid fiddling with the Gubbins C program)
-        shutil.copyfile(current_tree_name_with_internal_nodes, current_tree_name)
         gubbins_command = create_gubbins_command(
             gubbins_exec, gaps_alignment_filename, gaps_vcf_filename, current_tree_name,
             input_args.alignment_filename, input_args.min_snps, input_args.min_window_size, input_args.max_window_size,
-            input_args.p_value, input_args.trimming_ratio, input_args.extensive_search, input_args.threads)
-        printer.print(["\nRunning Gubbins to detect recombinations...", gubbins_command])
-        try:
-            subprocess.check_call(gubbins_command, shell=True)
-        except subprocess.SubprocessError:
-            sys.exit("Failed while running Gubbins. Please ensure you have enough free memory")
-        printer.print("...done. Run time: {:.2f} s".format(time.time() - start_time))
-        shutil.copyfile(current_tree_name, current_tree_name_with_internal_nodes)
+            input_args.p_value, input_args.trimming_ratio, input_args.extensive_search, stage_threads['detect'])
+        detection_stage = "iteration_" + str(i) + ".detection"
+        if checkpoints.is_complete(detection_stage,
+                                    [gaps_alignment_filename, gaps_vcf_filename, current_tree_name_with_internal_nodes,
+                                        input_args.alignment_filename],
+                                    str(gubbins_command)):
+            printer.print("\nSkipping recombination detection completed in the checkpointed run")
+        else:
+            shutil.copyfile(current_tree_name_with_internal_nodes, current_tree_name)
+            printer.print(["\nRunning Gubbins to detect recombinations...", gubbins_command])
+            try:
+                command_runner.check_call(detection_stage, gubbins_command)
+            except subprocess.SubprocessError:
+                sys.exit("Failed while running Gubbins (" + command_runner.describe(detection_stage) + "). Please ensure"
+                         " you have enough free memory")
+            printer.print("...done. Run time: {:.2f} s".format(time.time() - start_time))
+            shutil.copyfile(current_tree_name, current_tree_name_with_internal_nodes)
+            # The tree itself is recorded once its internal node labels are removed
+            checkpoints.record(detection_stage, [filename for filename in sorted(os.listdir('.'))
+                                                    if filename.startswith(current_tree_name + '.')
+                                                    and re.match(intermediate_files_regex(), filename[len(current_tree_name):])])
         # 5. Check for convergence
         printer.print("\nChecking for convergence...")
-        remove_internal_node_labels_from_tree(current_tree_name_with_internal_nodes, current_tree_name)
+        if not checkpoints.is_complete("iteration_" + str(i) + ".convergence", [current_tree_name_with_internal_nodes]):
+            remove_internal_node_labels_from_tree(current_tree_name_with_internal_nodes, current_tree_name)
+            checkpoints.record("iteration_" + str(i) + ".convergence", [current_tree_name])
         tree_file_names.append(current_tree_name)
         if i > 1:
             if input_args.converge_method == 'recombination':
@@ -479,45 +668,61 @@ def parse_and_run(input_args, program_description=""):
     else:
         printer.print("Maximum number of iterations (" + str(input_args.iterations) + ") reached.")
     printer.print("\nExiting the main loop.")
-
-    # 6. Run bootstrap analysis if requested
+    if result_cache.directory is not None:
+        printer.print("Result cache: {} hits and {} misses; {:.1f} MB of {:.1f} GB used in {}".format(result_cache.hits,
+                                                                                                result_cache.misses,
+                                                                                                result_cache.size()/2**20,
+                                                                                                input_args.cache_size,
+                                                                                                result_cache.directory))
+    if reconstruction_engine is not None:
+        reconstruction_engine.close()
+
+    # 6. Run bootstrap analysis, node branch support analysis and time calibration of the final tree if requested;
+    # these depend only on the final alignment and tree, so are run concurrently, dividing the threads between them
     final_aln = current_basename + ".tre" + alignment_suffix # For use with bootstrap and SH tests
-    if input_args.bootstrap > 0:
-        printer.print(["\nRunning bootstrap analysis..."])
+    def get_tree_builder(threads):
+        """Get the final tree builder using the threads allocated to a stage"""
+        if threads == tree_builder.threads:
+            return tree_builder
+        return return_algorithm(current_tree_builder, current_model, input_args, node_labels = internal_node_label_prefix,
+                                extra = extra_tree_arguments, threads = threads)
+
+    def run_bootstraps(threads):
+        """Generate the bootstrap trees"""
+        printer.print(["\nRunning bootstrap analysis with " + str(threads) + " thread(s)..."])
         shutil.copyfile(final_aln, temp_working_dir + "/" + final_aln)
         # NJ bootstraps
         if current_tree_builder == "rapidnj":
             # Bootstraps for NJ tree have to be run in a single command - deterministic algorithm means tree assumed to be the same
             # as the final tree
-            bootstrap_command = tree_builder.bootstrapping_command(os.path.abspath(final_aln), os.path.abspath(current_tree_name), temp_working_dir + "/" + current_basename)
-            try:
-                subprocess.check_call(bootstrap_command, shell=True)
-            except subprocess.SubprocessError:
-                sys.exit("Failed while running bootstrap analysis.")
-            transfer_bootstraps_to_tree(temp_working_dir + "/" + current_basename + ".tre.bootstrapped",
-                                                    os.path.abspath(current_tree_name),
-                                                    current_basename + ".tre.bootstrapped",
-                                                    outgroups = input_args.outgroup)
+            bootstrap_command = get_tree_builder(threads).bootstrapping_command(os.path.abspath(final_aln), os.path.abspath(current_tree_name), temp_working_dir + "/" + current_basename)
         # ML bootstraps
         else:
-            # Define alignment and a RAxML object for bootstrapping utilities
-            bootstrap_aln = final_aln
-            if current_tree_builder == "raxmlng":
-                bootstrap_utility = tree_builder
-            else:
-                bootstrap_utility = return_algorithm("raxmlng", current_model, input_args, node_labels = "")
             # Generate alignments for bootstrapping if FastTree being used
+            bootstrap_aln = final_aln
             if current_tree_builder == "fasttree":
                 bootstrap_aln = generate_bootstrap_alignments(bootstrap_aln,
                                                                 input_args.bootstrap,
                                                                 temp_working_dir + "/" + current_basename)
-            # Generate bootstrap trees
-            bootstrap_command = tree_builder.bootstrapping_command(os.path.abspath(bootstrap_aln), os.path.abspath(current_tree_name), current_basename, os.path.abspath(temp_working_dir))
-            try:
-                subprocess.check_call(bootstrap_command, shell=True)
-            except subprocess.SubprocessError:
-                sys.exit("Failed while running bootstrap analysis.")
-            # Annotate the final tree using the bootstraps
+            bootstrap_command = get_tree_builder(threads).bootstrapping_command(os.path.abspath(bootstrap_aln), os.path.abspath(current_tree_name), current_basename, os.path.abspath(temp_working_dir))
+        try:
+            command_runner.check_call('bootstraps', bootstrap_command)
+        except subprocess.SubprocessError:
+            sys.exit("Failed while running bootstrap analysis (" + command_runner.describe('bootstraps') + ").")
+
+    def annotate_bootstraps(threads):
+        """Annotate the final tree using the bootstraps"""
+        if current_tree_builder == "rapidnj":
+            transfer_bootstraps_to_tree(temp_working_dir + "/" + current_basename + ".tre.bootstrapped",
+                                                    os.path.abspath(current_tree_name),
+                                                    current_basename + ".tre.bootstrapped",
+                                                    outgroups = input_args.outgroup)
+        else:
+            # Define a RAxML object for bootstrapping utilities
+            if current_tree_builder == "raxmlng":
+                bootstrap_utility = get_tree_builder(threads)
+            else:
+                bootstrap_utility = return_algorithm("raxmlng", current_model, input_args, node_labels = "", threads = threads)
             bootstrapped_trees_file = tree_builder.get_bootstrapped_trees_file(temp_working_dir,current_basename)
             annotation_command = bootstrap_utility.annotate_tree_using_bootstraps_command(os.path.abspath(final_aln),
                                                                                             os.path.abspath(current_tree_name),
@@ -526,40 +731,80 @@ def parse_and_run(input_args, program_description=""):
                                                                                             os.path.abspath(temp_working_dir),
                                                                                             transfer = input_args.transfer_bootstrap)
             try:
-                subprocess.check_call(annotation_command, shell=True)
+                command_runner.check_call('bootstrap_annotation', annotation_command)
             except subprocess.SubprocessError:
-                sys.exit("Failed while annotating final tree with bootstrapping results.")
-        printer.print("...done. Run time: {:.2f} s".format(time.time() - start_time))
-
-    # 7. Run node branch support analysis if requested
-    if input_args.sh_test:
-        sh_test_command = tree_builder.sh_test(final_aln,
-                                                current_tree_name,
-                                                current_basename,
-                                                os.path.abspath(temp_working_dir))
+                sys.exit("Failed while annotating final tree with bootstrapping results (" + \
+                            command_runner.describe('bootstrap_annotation') + ").")
+            shutil.copyfile(bootstrap_utility.get_annotated_tree_file(os.path.abspath(temp_working_dir), current_basename),
+                            current_basename + ".tre.bootstrapped")
+
+    def run_sh_test(threads):
+        """Run node branch support analysis"""
+        printer.print(["\nRunning SH test with " + str(threads) + " thread(s)..."])
+        sh_test_command = get_tree_builder(threads).sh_test(final_aln,
+                                                            current_tree_name,
+                                                            current_basename,
+                                                            os.path.abspath(temp_working_dir))
         try:
-            subprocess.check_call(sh_test_command, shell=True)
+            command_runner.check_call('sh_test', sh_test_command)
         except subprocess.SubprocessError:
-            sys.exit("Failed while running SH test.")
+            sys.exit("Failed while running SH test (" + command_runner.describe('sh_test') + ").")
+
+    def transfer_sh_support(threads):
+        """Write the final tree annotated with SH support values"""
         reformat_sh_support(current_tree_name,
                             os.path.abspath(temp_working_dir),
                             current_tree_name,
                             algorithm = current_tree_builder,
                             outgroup = input_args.outgroup)
 
-    # 8. Run time calibration of final tree
-    if input_args.date is not None:
-        dating_command = tree_dater.run_time_tree(final_aln,
-                                                    current_tree_name,
-                                                    input_args.date,
-                                                    temp_working_dir,
-                                                    basename,
-                                                    outgroup = input_args.outgroup)
+    def run_time_calibration(threads):
+        """Run time calibration of a copy of the final tree, returning whether it succeeded"""
+        printer.print(["\nRunning time calibration with " + str(threads) + " thread(s)..."])
+        stage_tree_dater = tree_dater if threads == tree_dater.threads \
+                            else IQTree(threads = threads, model = tree_dater.model, verbose = input_args.verbose)
+        dating_command = stage_tree_dater.run_time_tree(final_aln,
+                                                        dating_tree_name,
+                                                        input_args.date,
+                                                        temp_working_dir,
+                                                        basename,
+                                                        outgroup = input_args.outgroup)
         try:
-            subprocess.check_call(dating_command, shell=True)
+            command_runner.check_call('time_calibration', dating_command)
         except subprocess.SubprocessError:
             # If this fails, continue to generate rest of output
             sys.stderr.write("Failed running tree time calibration with LSD.")
+            return False
+        return True
+
+    # Stages reading the final tree may run while its support values are transferred, so time calibration
+    # reads a copy of the tree, and the transfers of bootstrap and SH support values are run in turn
+    dating_tree_name = os.path.join(temp_working_dir, current_tree_name + ".dating")
+
+    # The threads for tree building are divided in proportion to the number of tree searches in each stage
+    final_stages = StageGraph(stage_threads['tree'])
+    if input_args.bootstrap > 0:
+        final_stages.add_stage('bootstraps', run_bootstraps, cost = input_args.bootstrap)
+        final_stages.add_stage('bootstrap_annotation', annotate_bootstraps, dependencies = ['bootstraps'])
+    if input_args.sh_test:
+        final_stages.add_stage('sh_test', run_sh_test)
+        final_stages.add_stage('sh_support', transfer_sh_support,
+                                dependencies = ['sh_test', 'bootstrap_annotation'] if input_args.bootstrap > 0 else ['sh_test'])
+    if input_args.date is not None:
+        shutil.copyfile(current_tree_name, dating_tree_name)
+        final_stages.add_stage('time_calibration', run_time_calibration)
+    if len(final_stages.stages) > 0:
+        final_stages_start_time = time.time()
+        stage_timings = final_stages.run()
+        printer.print("\nFinal tree analyses completed in {:.2f} s:".format(time.time() - final_stages_start_time))
+        for stage_name,(stage_start_time,stage_run_time,threads_used) in stage_timings.items():
+            printer.print("  {}: {:.2f} s from {:.2f} s with {} thread(s)".format(stage_name,
+                                                                                stage_run_time,
+                                                                                stage_start_time,
+                                                                                threads_used))
+        printer.print("...done. Run time: {:.2f} s".format(time.time() - start_time))
+        # The output of time calibration is only used if it succeeded
+        if input_args.date is not None and not final_stages.results['time_calibration']:
             input_args.date = None
 
     # Create the final output
@@ -581,19 +826,108 @@ def parse_and_run(input_args, program_description=""):
         tree_dater.citation = "https://doi.org/10.1093/sysbio/syv068"
         methods_log = update_methods_log(methods_log, method = tree_dater, step = 'Time calibration of tree')
     print_log(methods_log, input_args.prefix)
+    command_runner.write_csv(input_args.prefix + ".resources.csv")
+    command_runner.write_json(input_args.prefix + ".resources.json")
+    printer.print("Resources used by {} external command(s) written to {}.resources.csv and {}.resources.json".format(
+                        len(command_runner.records),
+                        input_args.prefix,
+                        input_args.prefix))
 
     # Cleanup intermediate files
     if not input_args.no_cleanup:
         shutil.rmtree(temp_working_dir)
+        os.remove(checkpoints.filename)
         utils.delete_files(".", tree_file_names[:-1], intermediate_files_regex(), input_args.verbose)
         utils.delete_files(".", [base_filename], starting_files_regex(), input_args.verbose)
+    peak_memory, peak_subprocess_memory = utils.peak_memory_usage()
+    printer.print("Peak memory usage: {:.2f} GB (largest subprocess: {:.2f} GB)".format(peak_memory/2**30,
+                                                                                    peak_subprocess_memory/2**30))
     printer.print("...finished. Total run time: {:.2f} s".format(time.time() - start_time))
 
 #############
 # Functions #
 #############
 
+class StageGraph:
+    """Stages of an analysis with the stages on which each depends. Stages are run concurrently once their
+    dependencies are complete, dividing the available threads between the stages started at the same time"""
+
+    def __init__(self, threads):
+        """Starts an empty graph"""
+        self.threads = threads
+        self.stages = {}
+        self.results = {}
+
+    def add_stage(self, name, function, dependencies = None, cost = 1):
+        """Adds a stage run as function(threads) after the named stages on which it depends; threads are divided
+        in proportion to the relative cost of each stage"""
+        dependencies = [] if dependencies is None else dependencies
+        for dependency in dependencies:
+            if dependency not in self.stages:
+                sys.stderr.write("Stage " + name + " depends on unknown stage " + dependency + "\n")
+                sys.exit(1)
+        self.stages[name] = {'function': function, 'dependencies': dependencies, 'cost': cost}
+
+    def run(self):
+        """Runs the stages, returning the start time (relative to the start of the graph), run time and number
+        of threads of each stage in the order in which they finished; the value returned by each stage's
+        function is stored in the results of the graph, such that stages do not modify shared state"""
+        graph_start_time = time.time()
+        def run_stage(name, threads):
+            stage_start_time = time.time()
+            self.results[name] = self.stages[name]['function'](threads)
+            return stage_start_time - graph_start_time, time.time() - stage_start_time
+        timings = {}
+        started_stages = set()
+        running_stages = {}
+        free_threads = self.threads
+        with concurrent.futures.ThreadPoolExecutor(max_workers = max(len(self.stages), 1)) as executor:
+            while len(timings) < len(self.stages):
+                # Start the most costly stages for which threads are available
+                ready_stages = sorted([name for name in self.stages if name not in started_stages
+                                        and all(dependency in timings for dependency in self.stages[name]['dependencies'])],
+                                        key = lambda name: self.stages[name]['cost'],
+                                        reverse = True)[:max(free_threads, 0)]
+                if len(ready_stages) > 0:
+                    stage_threads = utils.split_threads(free_threads, [self.stages[name]['cost'] for name in ready_stages])
+                    for name,threads in zip(ready_stages,stage_threads):
+                        running_stages[executor.submit(run_stage, name, threads)] = (name, threads)
+                        started_stages.add(name)
+                        free_threads -= threads
+                # Wait for a stage to finish and return its threads
+                finished_stages, _ = concurrent.futures.wait(running_stages,
+                                                             return_when = concurrent.futures.FIRST_COMPLETED)
+                for future in finished_stages:
+                    name, threads = running_stages.pop(future)
+                    stage_start_time, stage_run_time = future.result()
+                    timings[name] = (stage_start_time, stage_run_time, threads)
+                    free_threads += threads
+        return timings
+
+def allocate_stage_threads(input_args, num_taxa, num_patterns):
+    """Chooses the number of threads for tree building, ancestral reconstruction and recombination detection,
+    up to the --threads limit, unless specified for a stage"""
+    stage_work = {'tree': (num_patterns, stage_work_per_thread['tree']),
+                    'detect': (num_taxa, stage_work_per_thread['detect'])}
+    if input_args.seq_recon == 'pyjar':
+        stage_work['recon'] = (num_patterns*num_taxa, stage_work_per_thread['recon'])
+    else:
+        stage_work['recon'] = stage_work['tree']
+    stage_threads = {}
+    for stage in ['tree','recon','detect']:
+        specified_threads = getattr(input_args, stage + '_threads')
+        if specified_threads is None:
+            stage_threads[stage] = utils.choose_threads(input_args.threads, *stage_work[stage])
+        else:
+            stage_threads[stage] = specified_threads
+    return stage_threads
+
 def process_input_arguments(input_args):
+    # Check the numbers of threads specified for each stage
+    for stage_threads in [input_args.tree_threads, input_args.recon_threads, input_args.detect_threads]:
+        if stage_threads is not None and stage_threads < 1:
+            sys.stderr.write("At least one thread is required for each stage\n")
+            sys.exit(1)
     # Alter settings if pairwise comparison of sequences
     if input_args.pairwise:
         input_args.iterations = 1
@@ -623,15 +957,9 @@ def process_input_arguments(input_args):
             else:
                 # Else use IQtree where not possible - raxml failed on some unrealistic test datasets
                 input_args.model_fitter = 'iqtree'
-        # Make sequence reconstruction consistent with tree building where possible
+        # Marginal reconstruction uses pyjar unless an external algorithm is specified
         if input_args.seq_recon is None:
-            if input_args.best_model:
-                input_args.seq_recon = "iqtree"
-            elif input_args.tree_builder in ['raxml', 'raxmlng', 'iqtree']:
-                input_args.seq_recon = input_args.tree_builder
-            else:
-                # Else use RAxML where not possible
-                input_args.seq_recon = 'iqtree'
+            input_args.seq_recon = 'pyjar'
         elif not input_args.mar:
             sys.stderr.write('Sequence reconstruction uses pyjar unless the '
             '--mar flag is specified\n')
@@ -743,18 +1071,20 @@ def return_algorithm_choices(args,i):
     # Return choices
     return current_tree_builder, current_model_fitter, current_model, current_recon_model, extra_tree_arguments, extra_recon_arguments, custom_model, current_recon_model
 
-def return_algorithm(algorithm_choice, model, input_args, node_labels = None, extra = None):
+def return_algorithm(algorithm_choice, model, input_args, node_labels = None, extra = None, threads = None):
     initialised_algorithm = None
+    if threads is None:
+        threads = input_args.threads
     if algorithm_choice == "fasttree":
-        initialised_algorithm = FastTree(threads = input_args.threads, model = model, seed = input_args.seed, bootstrap = input_args.bootstrap, verbose = input_args.verbose, additional_args = extra)
+        initialised_algorithm = FastTree(threads = threads, model = model, seed = input_args.seed, bootstrap = input_args.bootstrap, verbose = input_args.verbose, additional_args = extra)
     elif algorithm_choice == "raxml":
-        initialised_algorithm = RAxML(threads = input_args.threads, model = model, seed = input_args.seed, bootstrap = input_args.bootstrap, internal_node_prefix = node_labels, verbose = input_args.verbose, additional_args = extra)
+        initialised_algorithm = RAxML(threads = threads, model = model, seed = input_args.seed, bootstrap = input_args.bootstrap, internal_node_prefix = node_labels, verbose = input_args.verbose, additional_args = extra)
     elif algorithm_choice == "raxmlng":
-        initialised_algorithm = RAxMLNG(threads = input_args.threads, model = model, seed = input_args.seed, bootstrap = input_args.bootstrap, internal_node_prefix = node_labels, verbose = input_args.verbose, additional_args = extra)
+        initialised_algorithm = RAxMLNG(threads = threads, model = model, seed = input_args.seed, bootstrap = input_args.bootstrap, internal_node_prefix = node_labels, verbose = input_args.verbose, additional_args = extra)
     elif algorithm_choice == "iqtree":
-        initialised_algorithm = IQTree(threads = input_args.threads, model = model, seed = input_args.seed, bootstrap = input_args.bootstrap, internal_node_prefix = node_labels, verbose = input_args.verbose, use_best = (model is None and input_args.best_model), additional_args = extra)
+        initialised_algorithm = IQTree(threads = threads, model = model, seed = input_args.seed, bootstrap = input_args.bootstrap, internal_node_prefix = node_labels, verbose = input_args.verbose, use_best = (model is None and input_args.best_model), additional_args = extra)
     elif algorithm_choice == "rapidnj":
-        initialised_algorithm = RapidNJ(threads = input_args.threads, model = model, bootstrap = input_args.bootstrap, verbose = input_args.verbose, additional_args = extra)
+        initialised_algorithm = RapidNJ(threads = threads, model = model, bootstrap = input_args.bootstrap, verbose = input_args.verbose, additional_args = extra)
     elif algorithm_choice == "star":
         initialised_algorithm = Star()
     else:
@@ -762,14 +1092,14 @@ def return_algorithm(algorithm_choice, model, input_args, node_labels = None, ex
         sys.exit()
     return initialised_algorithm
 
-def select_best_models(snp_alignment_filename,basename,current_tree_builder,input_args):
-    model_tester = IQTree(threads = input_args.threads,
+def select_best_models(snp_alignment_filename,basename,current_tree_builder,input_args,threads = None,command_runner = None):
+    model_tester = IQTree(threads = input_args.threads if threads is None else threads,
                             model = 'GTR',
                             verbose = input_args.verbose
                     )
     model_test_command = model_tester.run_model_comparison(snp_alignment_filename,basename)
     try:
-        subprocess.check_call(model_test_command, shell=True)
+        (CommandRunner() if command_runner is None else command_runner).check_call('model_selection', model_test_command)
     except subprocess.SubprocessError:
         sys.exit("Unable to identify best-fitting model")
     current_model = None
@@ -805,7 +1135,7 @@ def create_gubbins_command(gubbins_exec, alignment_filename, vcf_filename, curre
     if extensive_search:
             command.append("-x")
     command.append(alignment_filename)
-    return " ".join(command)
+    return Command(command)
 
 def number_of_sequences_in_alignment(filename):
     return len(get_sequence_names_from_alignment(filename))
@@ -822,10 +1152,14 @@ def get_sequence_names_from_alignment(filename):
 def is_starting_tree_valid(starting_tree):
     try:
         Phylo.read(starting_tree, 'newick')
-        dendropy.Tree.get_from_path(starting_tree, 'newick', preserve_underscores=True)
-    except Exception:
+        tree_arrays = TreeArrays.from_newick(starting_tree)
+    except (Exception, SystemExit):
         print("Error with the input starting tree: Is it a valid Newick file?")
         return False
+    leaf_names = [tree_arrays.taxon_labels[leaf_node] for leaf_node in tree_arrays.leaf_nodes.tolist()]
+    if len(set(leaf_names)) < len(leaf_names):
+        print("Error with the input starting tree: the taxon names are not unique")
+        return False
     return True
 
 
@@ -840,16 +1174,16 @@ def do_the_names_match_the_fasta_file(starting_tree, alignment_filename):
                 sequence_names.add(record.name)
 
     # Extract sequence names from tree
-    tree = dendropy.Tree.get_from_path(starting_tree, 'newick', preserve_underscores=True)
-    leaf_names = set()
-    for lf in tree.leaf_nodes():
-        lf.taxon.label = utils.process_sequence_names(lf.taxon.label)
-        leaf_names.add(lf.taxon.label)
+    tree_arrays = TreeArrays.from_newick(starting_tree)
+    taxon_labels = list(tree_arrays.taxon_labels)
+    for leaf_node in tree_arrays.leaf_nodes.tolist():
+        taxon_labels[leaf_node] = utils.process_sequence_names(taxon_labels[leaf_node])
+    leaf_names = set(taxon_labels[leaf_node] for leaf_node in tree_arrays.leaf_nodes.tolist())
 
     # Write out modified tree
-    output_tree_string = tree_as_string(tree, suppress_internal=False)
+    output_tree_string = tree_arrays.as_string(taxon_labels=taxon_labels)
     with open(starting_tree, 'w+') as output_file:
-        output_file.write(output_tree_string.replace('\'', ''))
+        output_file.write(output_tree_string)
 
     # Check if alignment names are a subset of the tree names
     # Superfluous taxa can be pruned from the tree
@@ -1133,10 +1467,11 @@ def transfer_internal_node_labels_to_tree(source_tree_filename, destination_tree
                  end='')
 
 def remove_internal_node_labels_from_tree(input_filename, output_filename):
-    tree = dendropy.Tree.get_from_path(input_filename, 'newick', preserve_underscores=True)
-    output_tree_string = tree_as_string(tree)
+    # The topology is unchanged, so the tree is rewritten from its arrays without building a dendropy tree
+    tree_arrays = TreeArrays.from_newick(input_filename)
+    output_tree_string = tree_arrays.as_string(suppress_internal=True)
     with open(output_filename, 'w+') as output_file:
-        output_file.write(output_tree_string.replace('\'', ''))
+        output_file.write(output_tree_string)
 
 
 def reinsert_gaps_into_fasta_file(input_fasta_filename, input_vcf_file, output_fasta_filename):
@@ -1361,15 +1696,16 @@ def update_methods_log(log, method = None, step = ''):
     log['version'].append(method.version)
     log['algorithm'].append(method.executable)
     log['model'].append(method.model)
+    log['threads'].append(str(getattr(method, 'threads', '-')))
     return log
 
 def print_log(log, prefix):
     """Print a records of the methods used"""
     log_file_name = prefix + ".log"
     with open(log_file_name,'w') as log_file:
-        log_file.write("Process,Algorithm,Version,Model,Citation\n")
+        log_file.write("Process,Algorithm,Version,Model,Citation,Threads\n")
         for index,process in enumerate(log['process']):
-            log_file.write(process + "," + log['algorithm'][index] + "," + log['version'][index] + "," + log['model'][index] + "," + log['citation'][index] + "\n")
+            log_file.write(process + "," + log['algorithm'][index] + "," + log['version'][index] + "," + log['model'][index] + "," + log['citation'][index] + "," + log['threads'][index] + "\n")
 
 def translation_of_filenames_to_final_filenames(input_prefix, output_prefix):
     input_names_to_output_names = {
@@ -0,0 +1,178 @@
+#!/usr/bin/env python
+# encoding: utf-8
+#
+# Wellcome Trust Sanger Institute
+# Copyright (C) 2013  Wellcome Trust Sanger Institute
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+#
+
+import os
+import re
+import sys
+
+# Newick tokens: quoted labels (with doubled quotes as escapes), comments, punctuation and unquoted labels
+newick_token = re.compile(r"""\s*(?:('(?:[^']|'')*')|(\[[^\]]*\])|([(),:;])|([^\s()[\],:;']+))""")
+
+# Characters for which labels are quoted when trees are written by dendropy
+protected_label_characters = re.compile(r'''[()[\]{},;:'"\0\t\n]''')
+
+####################################
+# Read Newick trees as flat arrays #
+####################################
+
+def parse_newick(tree_string):
+    """Parses the first tree in a Newick string as it would be read by dendropy with underscores preserved,
+    returning the taxon labels, internal node labels, parent node indices (-1 for the root) and edge lengths
+    (NaN where missing) of the nodes indexed in postorder"""
+    taxon_labels = []
+    node_labels = []
+    parent_nodes = []
+    edge_lengths = []
+    # Children of the nodes that are still open, with the top level at the bottom of the stack
+    open_children = [[]]
+    # The most recently completed node, to which labels and edge lengths are assigned
+    last_node = -1
+    last_node_is_leaf = False
+    reading_edge_length = False
+    position = 0
+    string_length = len(tree_string)
+    while position < string_length:
+        token_match = newick_token.match(tree_string, position)
+        if token_match is None:
+            if tree_string[position:].strip() == '':
+                break
+            sys.stderr.write('Unable to parse Newick tree at character ' + str(position) + '\n')
+            sys.exit(1)
+        position = token_match.end()
+        quoted_label, comment, punctuation, unquoted_label = token_match.groups()
+        if comment is not None:
+            continue
+        elif punctuation is not None:
+            if reading_edge_length:
+                sys.stderr.write('Missing edge length in Newick tree at character ' + str(position) + '\n')
+                sys.exit(1)
+            if punctuation == '(':
+                if last_node != -1:
+                    sys.stderr.write('Unexpected node in Newick tree at character ' + str(position) + '\n')
+                    sys.exit(1)
+                open_children.append([])
+                continue
+            # Nodes without labels are unlabelled leaves
+            if last_node == -1:
+                last_node = len(parent_nodes)
+                last_node_is_leaf = True
+                taxon_labels.append('')
+                node_labels.append('')
+                parent_nodes.append(-1)
+                edge_lengths.append(float('nan'))
+            if punctuation == ':':
+                reading_edge_length = True
+                continue
+            open_children[-1].append(last_node)
+            last_node = -1
+            if punctuation == ')':
+                if len(open_children) == 1:
+                    sys.stderr.write('Unbalanced parentheses in Newick tree\n')
+                    sys.exit(1)
+                last_node = len(parent_nodes)
+                last_node_is_leaf = False
+                for child_node in open_children.pop():
+                    parent_nodes[child_node] = last_node
+                taxon_labels.append('')
+                node_labels.append('')
+                parent_nodes.append(-1)
+                edge_lengths.append(float('nan'))
+            elif punctuation == ';':
+                break
+        else:
+            if quoted_label is not None:
+                label = quoted_label[1:-1].replace("''", "'")
+            else:
+                label = unquoted_label
+            if reading_edge_length:
+                try:
+                    edge_lengths[last_node] = float(label)
+                except ValueError:
+                    sys.stderr.write('Invalid edge length in Newick tree: ' + label + '\n')
+                    sys.exit(1)
+                reading_edge_length = False
+            elif last_node == -1:
+                last_node = len(parent_nodes)
+                last_node_is_leaf = True
+                taxon_labels.append(label)
+                node_labels.append('')
+                parent_nodes.append(-1)
+                edge_lengths.append(float('nan'))
+            elif not last_node_is_leaf and node_labels[last_node] == '':
+                node_labels[last_node] = label
+            else:
+                sys.stderr.write('Unexpected label in Newick tree: ' + label + '\n')
+                sys.exit(1)
+    # Trees without a terminating semicolon are closed at the end of the string
+    if last_node != -1:
+        open_children[-1].append(last_node)
+    if len(open_children) != 1 or len(open_children[0]) != 1:
+        sys.stderr.write('Unbalanced parentheses in Newick tree\n')
+        sys.exit(1)
+    return taxon_labels, node_labels, parent_nodes, edge_lengths
+
+def read_newick(tree_filename):
+    """Parses the first tree in a Newick file"""
+    if not os.path.isfile(tree_filename):
+        print("Error: tree file does not exist")
+        sys.exit(204)
+    with open(tree_filename, 'r') as tree_file:
+        return parse_newick(tree_file.read())
+
+###############################
+# Write flat arrays as Newick #
+###############################
+
+def format_newick_label(label):
+    """Formats a label as by tree_as_string with quotes removed: spaces are replaced by underscores unless
+    the label contains an underscore, or a character for which it would have been quoted"""
+    if '_' not in label and not protected_label_characters.search(label):
+        label = label.replace(' ','_')
+    return label.replace("'",'')
+
+def write_newick(child_nodes, seed_node, labels, edge_lengths):
+    """Returns the Newick string of a tree described by the padded array of the children of each node, with
+    the label and edge length (NaN where missing) of each node"""
+    child_lists = child_nodes.tolist()
+    node_strings = []
+    for label,edge_length in zip(labels,edge_lengths):
+        node_string = format_newick_label(label)
+        if edge_length == edge_length:
+            node_string += ':' + str(edge_length)
+        node_strings.append(node_string)
+    # Write the nodes in preorder, closing each internal node after its descendants
+    tokens = []
+    stack = [seed_node]
+    while len(stack) > 0:
+        item = stack.pop()
+        if isinstance(item, str):
+            tokens.append(item)
+        elif child_lists[item][0] == -1:
+            tokens.append(node_strings[item])
+        else:
+            tokens.append('(')
+            stack.append(')' + node_strings[item])
+            children = [child for child in child_lists[item] if child > -1]
+            for i,child in enumerate(reversed(children)):
+                if i > 0:
+                    stack.append(',')
+                stack.append(child)
+    return ''.join(tokens) + ';\n'
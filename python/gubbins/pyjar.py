@@ -13,31 +13,70 @@ import dendropy
 import sys
 import os
 import time
+import tempfile
 from Bio import AlignIO
 from math import log, exp
 from functools import partial
+# The time taken to load the kernels includes that taken to import numba
+kernel_load_start = time.perf_counter()
 import numba
 from numba import jit, njit, types, from_dtype
 from math import ceil
 import collections
 import datetime
 import multiprocessing
+import queue
+import hashlib
+import json
 try:
     from multiprocessing import Pool, shared_memory
+    from multiprocessing.pool import ThreadPool
     from multiprocessing.managers import SharedMemoryManager
     NumpyShared = collections.namedtuple('NumpyShared', ('name', 'shape', 'dtype'))
 except ImportError as e:
     sys.stderr.write("This version of Gubbins requires the multiprocessing library and python v3.8 or higher for memory management\n")
     sys.exit(201)
 
-from gubbins.utils import generate_shared_mem_array
+from gubbins.utils import generate_shared_mem_array, generate_mapped_array, create_mapped_array, attach_mapped_array, \
+                            NumpyMapped, PhaseProfile, peak_memory_usage
+from gubbins.transition_probabilities import transition_probability_cache
+from gubbins.tree_arrays import TreeArrays
+
+# Compiled kernels are cached alongside this module if possible; otherwise, a user or temporary
+# directory is used, with NUMBA_CACHE_DIR set such that worker processes use the same location
+def is_writable_directory(directory):
+    """Checks whether files can be created in a directory, creating it if necessary"""
+    try:
+        os.makedirs(directory, exist_ok = True)
+        tempfile.TemporaryFile(dir = directory).close()
+        return True
+    except OSError:
+        return False
+
+def configure_kernel_cache():
+    """Selects a writable directory for the compiled kernel cache, returning its location"""
+    if os.environ.get('NUMBA_CACHE_DIR'):
+        return os.environ['NUMBA_CACHE_DIR']
+    module_cache_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '__pycache__')
+    if is_writable_directory(module_cache_dir):
+        return module_cache_dir
+    user_cache_dir = os.environ.get('XDG_CACHE_HOME', os.path.join(os.path.expanduser('~'), '.cache'))
+    for cache_dir in [os.path.join(user_cache_dir, 'gubbins', 'numba'),
+                        os.path.join(tempfile.gettempdir(), 'gubbins-numba-' + str(os.getuid()))]:
+        if is_writable_directory(cache_dir):
+            os.environ['NUMBA_CACHE_DIR'] = cache_dir
+            numba.config.CACHE_DIR = cache_dir
+            return cache_dir
+    return None
+
+kernel_cache_dir = configure_kernel_cache()
 
 ###########################
 # Python-native functions #
 ###########################
 
 class Pyjar:
-    def __init__(self, model: str):
+    def __init__(self, model: str, threads = 1):
         """Initialises the object"""
         self.citation = "https://doi.org/10.1093/oxfordjournals.molbev.a026369"
         self.process = "Sequence reconstructor"
@@ -45,6 +84,7 @@ class Pyjar:
         self.algorithm = "pyjar"
         self.executable = "pyjar"
         self.model = model
+        self.threads = threads
 
 # Split a list into chunks for multiprocessing
 # from https://stackoverflow.com/questions/2130016/splitting-a-list-into-n-parts-of-approximately-equal-length/37414115#37414115
@@ -205,6 +245,9 @@ def get_unique_columns(data):
 # JIT-compiled functions #
 ##########################
 
+# Each kernel has an explicit signature, so is compiled (or loaded from the cache) when this module
+# is imported, rather than on first use
+
 # Convert bases to integers
 ###########################
 @njit(numba.void(numba.typeof(numpy.dtype('U1'))[:],
@@ -334,9 +377,35 @@ def reconstruct_alleles(reconstructed_alleles,
             else:
                 reconstructed_alleles[node_index] = numpy.uint8(4)
 
+# Store a base in an alignment packed with two bases per byte
+#############################################################
+@njit(numba.void(numba.uint8[:,:],
+                numba.int64,
+                numba.int64,
+                numba.int64),
+                nogil=True,
+                cache=True)
+def set_packed_base(packed_aln, row, index, base):
+    # Even indices are stored in the low four bits of each byte, and odd indices in the high four bits
+    byte_index = index >> 1
+    if index & 1:
+        packed_aln[row,byte_index] = (packed_aln[row,byte_index] & 0x0F) | (base << 4)
+    else:
+        packed_aln[row,byte_index] = (packed_aln[row,byte_index] & 0xF0) | base
+
+# Read a base from an array packed with two bases per byte
+##########################################################
+@njit(numba.uint8(numba.uint8[:,:],
+                numba.int64,
+                numba.int64),
+                nogil=True,
+                cache=True)
+def get_packed_base(packed_aln, row, index):
+    return (packed_aln[row,index >> 1] >> ((index & 1) << 2)) & 0x0F
+
 # Transfer reconstructed alleles into alignment
 ###############################################
-@njit(numba.void(numba.typeof(numpy.dtype('i1'))[:,:],
+@njit(numba.void(numba.uint8[:,:],
                 numba.uint8[:],
                 numba.typeof(numpy.dtype('i1'))[:],
                 numba.int32[:],
@@ -348,7 +417,7 @@ def fill_out_aln(out_aln,reconstructed_alleles,ordered_bases,ancestral_node_orde
         base_index = reconstructed_alleles[node_index]
         base = ordered_bases[base_index]
         for column in base_pattern_columns:
-            out_aln[column,index] = base
+            set_packed_base(out_aln, column, index, base)
 
 # Reconstruct each base pattern
 ###############################
@@ -356,7 +425,7 @@ def fill_out_aln(out_aln,reconstructed_alleles,ordered_bases,ancestral_node_orde
                 numba.int32[:],
                 numba.float32[:,:],
                 numba.uint8[:,:],
-                numba.typeof(numpy.dtype('i1'))[:,:],
+                numba.uint8[:,:],
                 numba.typeof(numpy.dtype('i1'))[:],
                 numba.int32[:],
                 numba.int32[:],
@@ -404,7 +473,7 @@ def iterate_over_base_patterns(column,
     # will all be the observed base, as no ancestral node will have two child nodes with unknown bases at this site
     if unknown_base_count == 1 and column_base_indices.size == 1:
         # If site is monomorphic - replace entire column
-        tmp_out_aln[base_pattern_columns,:] = ordered_bases[column_base_indices[0]]
+        tmp_out_aln[base_pattern_columns,:] = 17*ordered_bases[column_base_indices[0]]
     else:
         # Otherwise perform a full ML inference
         #1 For each OTU y perform the following:
@@ -478,6 +547,720 @@ def iterate_over_base_patterns(column,
                         base_pattern_columns,
                         )
 
+# Identify the bases for which monomorphic patterns have an analytic reconstruction
+##################################################################################
+@njit(numba.uint8(numba.int32[:],
+                numba.int32,
+                numba.float32[:,:],
+                numba.float32[:]),
+                nogil=True,
+                cache=True)
+def find_monomorphic_bases(postordered_nodes, seed_node, node_pij, base_frequencies):
+    # Only the bases observed in a pattern are considered in the likelihood calculation,
+    # so every ancestor in a monomorphic pattern is reconstructed as the observed base,
+    # unless the likelihood at the root is not finite
+    monomorphic_bases = 0
+    for base in range(4):
+        valid = base_frequencies[base] > 0
+        for node_index in postordered_nodes:
+            if node_index != seed_node and not node_pij[node_index,base*5] > numpy.NINF:
+                valid = False
+        if valid:
+            monomorphic_bases = monomorphic_bases | (1 << base)
+    return monomorphic_bases
+
+# Calculate likelihoods for subtrees in which every sequence has the same base
+##############################################################################
+@njit(numba.void(numba.int64,
+                numba.int64,
+                numba.int32[:],
+                numba.int32[:,:],
+                numba.int32,
+                numba.float32[:,:],
+                numba.int32[:],
+                numba.float32[:,:,::1],
+                numba.uint8[:,:,::1],
+                numba.uint8[:,::1]),
+                nogil=True,
+                cache=True)
+def calculate_singleton_background(majority_base,
+                                    derived_base,
+                                    postordered_nodes,
+                                    child_nodes,
+                                    seed_node,
+                                    node_pij,
+                                    node_index_to_aln_row,
+                                    singleton_L,
+                                    singleton_C,
+                                    singleton_uniform):
+    # Subtrees not containing the derived base of a singleton pattern have the same likelihoods
+    # in every such pattern (calculated as in reconstruct_base_pattern_block), and are
+    # reconstructed as the majority base throughout if singleton_uniform is set for their root
+    pair = majority_base*4 + derived_base
+    mask = (1 << majority_base) | (1 << derived_base)
+    for node_index in postordered_nodes:
+        if node_index == seed_node:
+            continue
+        if node_index_to_aln_row[node_index] > -1:
+            for i in range(4):
+                singleton_L[pair,node_index,i] = node_pij[node_index,i*4+majority_base]
+                singleton_C[pair,node_index,i] = majority_base
+            singleton_uniform[pair,node_index] = 1
+        else:
+            for i in range(4):
+                singleton_L[pair,node_index,i] = numpy.NINF
+                singleton_C[pair,node_index,i] = i
+            for end_index in range(4):
+                if mask & (1 << end_index):
+                    c = numpy.float32(0.0)
+                    for child_node_index in child_nodes[node_index,:]:
+                        if child_node_index > -1:
+                            c += singleton_L[pair,child_node_index,end_index]
+                    for start_index in range(4):
+                        if mask & (1 << start_index):
+                            j = node_pij[node_index,start_index*4+end_index] + c
+                            if j > singleton_L[pair,node_index,start_index]:
+                                singleton_L[pair,node_index,start_index] = j
+                                singleton_C[pair,node_index,start_index] = end_index
+            uniform = singleton_C[pair,node_index,majority_base] == majority_base
+            for child_node_index in child_nodes[node_index,:]:
+                if child_node_index > -1 and singleton_uniform[pair,child_node_index] == 0:
+                    uniform = False
+            singleton_uniform[pair,node_index] = uniform
+
+# Estimate the relative cost of reconstructing each base pattern
+################################################################
+@njit(numba.void(numba.uint8[:,:],
+                numba.int64,
+                numba.int64[:],
+                numba.float64,
+                numba.float64,
+                numba.float64[:]),
+                nogil=True,
+                cache=True)
+def estimate_pattern_costs(base_patterns, num_samples, pattern_position_offsets, singleton_cost, full_cost, pattern_costs):
+    # Every pattern is written to the output alignment at each of its positions; in addition, singleton
+    # patterns without gaps are resolved on a single path through the tree, and other polymorphic patterns
+    # require the full likelihood calculation. Costs are relative to writing a single position.
+    base_counts = numpy.zeros(6, dtype = numpy.int64)
+    for pattern_index in range(base_patterns.shape[0]):
+        base_counts[:] = 0
+        for alignment_index in range(num_samples):
+            base_counts[get_packed_base(base_patterns, pattern_index, alignment_index)] += 1
+        observed_bases = 0
+        majority_count = 0
+        for base in range(4):
+            if base_counts[base] > 0:
+                observed_bases += 1
+                majority_count = max(majority_count,base_counts[base])
+        pattern_costs[pattern_index] = pattern_position_offsets[pattern_index + 1] - pattern_position_offsets[pattern_index]
+        if observed_bases > 1:
+            if observed_bases == 2 and majority_count == num_samples - 1:
+                pattern_costs[pattern_index] += singleton_cost
+            else:
+                pattern_costs[pattern_index] += full_cost
+
+# Classify base patterns, resolving those with analytic reconstructions
+#######################################################################
+@njit(numba.int64(numba.uint8[:,:],
+                numba.int64,
+                numba.int32[:],
+                numba.int64[:],
+                numba.int64,
+                numba.int64,
+                numba.int32[::1],
+                numba.uint8[::1],
+                numba.int64[::1],
+                numba.uint8[:,:],
+                numba.int32[:],
+                numba.int32[:],
+                numba.int32[:,:],
+                numba.int32,
+                numba.int32[:],
+                numba.float32[:,:],
+                numba.float32[:],
+                numba.int32[:],
+                numba.int64[:],
+                numba.boolean,
+                numba.uint8[::1],
+                numba.int32[::1],
+                numba.float32[:,:,::1],
+                numba.uint8[:,:,::1],
+                numba.uint8[:,::1],
+                numba.uint8[::1],
+                numba.float32[:,::1],
+                numba.uint8[:,::1]),
+                nogil=True,
+                cache=True)
+def classify_base_patterns(base_patterns,
+                            num_samples,
+                            pattern_positions,
+                            pattern_position_offsets,
+                            block_start,
+                            block_end,
+                            full_patterns,
+                            base_masks,
+                            pattern_class_counts,
+                            out_aln,
+                            postordered_nodes,
+                            parent_nodes,
+                            child_nodes,
+                            seed_node,
+                            ancestral_node_order,
+                            node_pij,
+                            base_frequencies,
+                            node_index_to_aln_row,
+                            node_snps,
+                            resolve_singletons,
+                            node_known,
+                            aln_row_nodes,
+                            singleton_L,
+                            singleton_C,
+                            singleton_uniform,
+                            singleton_ready,
+                            path_L,
+                            path_C):
+    # Patterns are resolved without the full likelihood calculation if they are either:
+    # (i) monomorphic, with any number of gaps, in which case each ancestor is reconstructed as
+    # the observed base, unless only gaps descend from it; or
+    # (ii) singletons, with one sequence differing from the rest and no gaps, in which case the
+    # likelihoods only differ from those of a monomorphic pattern on the path from the derived
+    # sequence to the root. The pattern is resolved if this path, and the subtrees attached to
+    # it, are reconstructed as the majority base, as would be the case under parsimony.
+    # The indices of the remaining patterns are stored in full_patterns, and their number returned.
+    # Counts of patterns in each class are added to pattern_class_counts (monomorphic, singleton, full)
+    monomorphic_bases = find_monomorphic_bases(postordered_nodes, seed_node, node_pij, base_frequencies)
+    if resolve_singletons:
+        for i in range(aln_row_nodes.size):
+            aln_row_nodes[i] = -1
+        for node_index in postordered_nodes:
+            if node_index_to_aln_row[node_index] > -1:
+                aln_row_nodes[node_index_to_aln_row[node_index]] = node_index
+    num_full = 0
+    for p in range(block_end - block_start):
+        pattern_index = block_start + p
+        mask = 0
+        unknown_base_count = 0
+        num_bases = 0
+        first_base = 0
+        first_base_count = 0
+        second_base = 0
+        second_base_count = 0
+        second_base_row = 0
+        for alignment_index in range(num_samples):
+            taxon_base_index = get_packed_base(base_patterns, pattern_index, alignment_index)
+            if taxon_base_index < 4:
+                if not mask & (1 << taxon_base_index):
+                    mask = mask | (1 << taxon_base_index)
+                    num_bases += 1
+                    if num_bases == 1:
+                        first_base = taxon_base_index
+                    elif num_bases == 2:
+                        second_base = taxon_base_index
+                        second_base_row = alignment_index
+                if taxon_base_index == first_base:
+                    first_base_count += 1
+                elif taxon_base_index == second_base:
+                    second_base_count += 1
+            else:
+                unknown_base_count += 1
+        base_masks[p] = mask
+        if num_bases < 2:
+            base = 0
+            for i in range(4):
+                if mask & (1 << i):
+                    base = i
+            if unknown_base_count == 1 and num_bases == 1:
+                # Monomorphic with a gap in only one sequence (see iterate_over_base_patterns)
+                for k in range(pattern_position_offsets[pattern_index], pattern_position_offsets[pattern_index+1]):
+                    out_aln[pattern_positions[k],:] = 17*base
+                pattern_class_counts[0] += 1
+                continue
+            elif num_bases == 0 or monomorphic_bases & mask:
+                # Monomorphic with gaps, with ancestors reconstructed as gaps if only gaps descend from them
+                for node_index in postordered_nodes:
+                    alignment_index = node_index_to_aln_row[node_index]
+                    if alignment_index > -1:
+                        node_known[node_index] = get_packed_base(base_patterns, pattern_index, alignment_index) < 4
+                    else:
+                        node_known[node_index] = 0
+                        for child_node_index in child_nodes[node_index,:]:
+                            if child_node_index > -1 and node_known[child_node_index]:
+                                node_known[node_index] = 1
+                for k in range(pattern_position_offsets[pattern_index], pattern_position_offsets[pattern_index+1]):
+                    position = pattern_positions[k]
+                    for index in range(ancestral_node_order.size):
+                        if node_known[ancestral_node_order[index]]:
+                            set_packed_base(out_aln, position, index, base)
+                        else:
+                            set_packed_base(out_aln, position, index, 4)
+                pattern_class_counts[0] += 1
+                continue
+        elif resolve_singletons and num_bases == 2 and unknown_base_count == 0:
+            # The derived base is found in only one sequence
+            majority_base = -1
+            if second_base_count == 1 and first_base_count > 1:
+                majority_base = first_base
+                derived_base = second_base
+                derived_row = second_base_row
+            elif first_base_count == 1 and second_base_count > 1:
+                majority_base = second_base
+                derived_base = first_base
+                derived_row = 0
+            if majority_base > -1 and aln_row_nodes[derived_row] > -1:
+                pair = majority_base*4 + derived_base
+                if not singleton_ready[pair]:
+                    calculate_singleton_background(majority_base,
+                                                    derived_base,
+                                                    postordered_nodes,
+                                                    child_nodes,
+                                                    seed_node,
+                                                    node_pij,
+                                                    node_index_to_aln_row,
+                                                    singleton_L,
+                                                    singleton_C,
+                                                    singleton_uniform)
+                    singleton_ready[pair] = 1
+                # Calculate the likelihoods on the path from the derived sequence to the root
+                derived_node_index = aln_row_nodes[derived_row]
+                for i in range(4):
+                    path_L[derived_node_index,i] = node_pij[derived_node_index,i*4+derived_base]
+                    path_C[derived_node_index,i] = derived_base
+                parsimonious = True
+                path_node_index = derived_node_index
+                node_index = parent_nodes[derived_node_index]
+                while node_index > -1:
+                    is_root = node_index == seed_node
+                    for i in range(4):
+                        path_L[node_index,i] = numpy.NINF
+                        path_C[node_index,i] = i
+                    for end_index in range(4):
+                        if mask & (1 << end_index):
+                            c = numpy.float32(0.0)
+                            for child_node_index in child_nodes[node_index,:]:
+                                if child_node_index == path_node_index:
+                                    c += path_L[child_node_index,end_index]
+                                elif child_node_index > -1:
+                                    c += singleton_L[pair,child_node_index,end_index]
+                            for start_index in range(4):
+                                if mask & (1 << start_index):
+                                    if is_root:
+                                        j = log(base_frequencies[end_index]) + c
+                                    else:
+                                        j = node_pij[node_index,start_index*4+end_index] + c
+                                    if j > path_L[node_index,start_index]:
+                                        path_L[node_index,start_index] = j
+                                        path_C[node_index,start_index] = end_index
+                    for child_node_index in child_nodes[node_index,:]:
+                        if child_node_index > -1 and child_node_index != path_node_index and \
+                                singleton_uniform[pair,child_node_index] == 0:
+                            parsimonious = False
+                    if not is_root and path_C[node_index,majority_base] != majority_base:
+                        parsimonious = False
+                    path_node_index = node_index
+                    node_index = parent_nodes[node_index]
+                max_root_index = 0
+                for i in range(1,4):
+                    if path_L[seed_node,i] > path_L[seed_node,max_root_index]:
+                        max_root_index = i
+                if path_C[seed_node,max_root_index] != majority_base:
+                    parsimonious = False
+                if parsimonious:
+                    for k in range(pattern_position_offsets[pattern_index], pattern_position_offsets[pattern_index+1]):
+                        out_aln[pattern_positions[k],:] = 17*majority_base
+                    node_snps[derived_node_index] += pattern_position_offsets[pattern_index+1] - pattern_position_offsets[pattern_index]
+                    pattern_class_counts[1] += 1
+                    continue
+        full_patterns[num_full] = p
+        num_full += 1
+        pattern_class_counts[2] += 1
+    return num_full
+
+# Subtrees in which every sequence has the same base are cached for each node under the key
+# subtree_base*16 + mask, where subtree_base is a base or gap (0-4) and mask is the set of bases
+# present in the pattern (0-15); each node therefore has at most this many cached subtrees
+subtree_cache_keys = 5*16
+
+# Reconstruct a block of base patterns in one pass over the tree
+################################################################
+@njit(numba.void(numba.uint8[:,:],
+                numba.int32[:],
+                numba.int64[:],
+                numba.int64,
+                numba.int64,
+                numba.int32[:,::1],
+                numba.uint8[:,::1],
+                numba.uint8[:,::1],
+                numba.int32[::1],
+                numba.int64,
+                numba.uint8[::1],
+                numba.int32[::1],
+                numba.float32[:,::1],
+                numba.uint8[:,::1],
+                numba.int32[:,::1],
+                numba.int64[::1],
+                numba.uint8[:,:],
+                numba.int32[:],
+                numba.int32[:],
+                numba.int32[:],
+                numba.int32[:,:],
+                numba.int32,
+                numba.int32[:],
+                numba.float32[:,:],
+                numba.float32[:],
+                numba.int32[:],
+                numba.int64[:],
+                numba.boolean,
+                numba.int64,
+                numba.int32[:],
+                numba.uint8[:],
+                numba.uint8[:,:]),
+                nogil=True,
+                cache=True)
+def reconstruct_base_pattern_block(base_patterns,
+                                    pattern_positions,
+                                    pattern_position_offsets,
+                                    block_start,
+                                    block_end,
+                                    node_rows,
+                                    subtree_bases,
+                                    reconstructed_alleles,
+                                    full_patterns,
+                                    num_full,
+                                    base_masks,
+                                    pattern_weights,
+                                    Lmat,
+                                    Cmat,
+                                    subtree_cache,
+                                    cache_counts,
+                                    out_aln,
+                                    postordered_nodes,
+                                    preordered_nodes,
+                                    parent_nodes,
+                                    child_nodes,
+                                    seed_node,
+                                    ancestral_node_order,
+                                    node_pij,
+                                    base_frequencies,
+                                    node_index_to_aln_row,
+                                    node_snps,
+                                    persistent,
+                                    store_start,
+                                    node_slots,
+                                    node_reused,
+                                    stored_bases):
+    # Likelihoods and traceback information are stored in rows of Lmat and Cmat, with node_rows
+    # recording the row used by each node for each pattern. The first (nodes x patterns) rows
+    # are used for subtrees containing different bases, and the remaining rows cache subtrees
+    # in which every sequence has the same base (or is a gap), which are identical for all
+    # patterns containing the same set of bases. The arithmetic and the order in which bases
+    # are compared match iterate_over_base_patterns, such that the reconstructions are identical.
+    # Only the num_full patterns listed in full_patterns (see classify_base_patterns) are reconstructed
+    batch_size = node_rows.shape[1]
+    if persistent:
+        # Each node slot has a row for every pattern in the block (starting at store_start),
+        # such that the results persist for reuse with the next tree
+        row_stride = stored_bases.shape[1]
+        first_cache_row = stored_bases.shape[0]*row_stride
+    else:
+        row_stride = batch_size
+        first_cache_row = node_rows.shape[0]*batch_size
+    cache_size = Lmat.shape[0] - first_cache_row
+    column_offset = block_start - store_start
+
+    # Empty the cache if it cannot hold every subtree that could be added for this block
+    if cache_counts[0] + node_rows.shape[0]*min(num_full,subtree_cache_keys) > cache_size:
+        subtree_cache[:,:] = -1
+        cache_counts[0] = 0
+        cache_counts[3] += 1
+
+    # Postorder traversal calculating the likelihood of each base at every node for all patterns
+    cached_rows = cache_counts[0]
+    cache_lookups = 0
+    cache_hits = 0
+    for node_index in postordered_nodes:
+        alignment_index = node_index_to_aln_row[node_index]
+        slot = node_slots[node_index]
+        if node_reused[node_index]:
+            # Subtrees unchanged since the previous tree use the stored results
+            for q in range(num_full):
+                column = column_offset + full_patterns[q]
+                node_rows[node_index,q] = slot*row_stride + column
+                subtree_bases[node_index,q] = stored_bases[slot,column]
+            continue
+        children = child_nodes[node_index,:]
+        num_children = 0
+        for child_node_index in children:
+            if child_node_index > -1:
+                num_children += 1
+        is_root = node_index == seed_node
+        for q in range(num_full):
+            mask = base_masks[full_patterns[q]]
+            # Identify whether all sequences descending from the node share a base
+            if alignment_index > -1:
+                subtree_base = min(get_packed_base(base_patterns, block_start + full_patterns[q], alignment_index), 4)
+            else:
+                subtree_base = subtree_bases[children[0],q]
+                for k in range(1,num_children):
+                    if subtree_bases[children[k],q] != subtree_base:
+                        subtree_base = 6
+            subtree_bases[node_index,q] = subtree_base
+            if persistent:
+                column = column_offset + full_patterns[q]
+                stored_bases[slot,column] = subtree_base
+            else:
+                column = q
+            stored_row = slot*row_stride + column
+            # Look up subtrees with a single base in the cache
+            if subtree_base < 5:
+                cache_lookups += 1
+                cache_key = subtree_base*16 + mask
+                row = subtree_cache[node_index,cache_key]
+                if row > -1:
+                    cache_hits += 1
+                    if persistent:
+                        for i in range(4):
+                            Lmat[stored_row,i] = Lmat[row,i]
+                            Cmat[stored_row,i] = Cmat[row,i]
+                        row = stored_row
+                    node_rows[node_index,q] = row
+                    continue
+                row = first_cache_row + cached_rows
+                cached_rows += 1
+                subtree_cache[node_index,cache_key] = row
+            else:
+                row = stored_row
+            if alignment_index > -1:
+                # Leaves
+                if subtree_base < 4:
+                    for i in range(4):
+                        Lmat[row,i] = node_pij[node_index,i*4+subtree_base]
+                        Cmat[row,i] = subtree_base
+                else:
+                    for i in range(4):
+                        Lmat[row,i] = node_pij[node_index,i*5]
+                        Cmat[row,i] = i
+            else:
+                # Internal nodes
+                for i in range(4):
+                    Lmat[row,i] = numpy.NINF
+                    Cmat[row,i] = i
+                for end_index in range(4):
+                    if mask & (1 << end_index):
+                        c = numpy.float32(0.0)
+                        for k in range(num_children):
+                            c += Lmat[node_rows[children[k],q],end_index]
+                        for start_index in range(4):
+                            if mask & (1 << start_index):
+                                if is_root:
+                                    # Calculate likelihood of base at root node
+                                    j = log(base_frequencies[end_index]) + c
+                                else:
+                                    j = node_pij[node_index,start_index*4+end_index] + c
+                                if j > Lmat[row,start_index]:
+                                    Lmat[row,start_index] = j
+                                    Cmat[row,start_index] = end_index
+            if persistent and row != stored_row:
+                for i in range(4):
+                    Lmat[stored_row,i] = Lmat[row,i]
+                    Cmat[stored_row,i] = Cmat[row,i]
+                row = stored_row
+            node_rows[node_index,q] = row
+    cache_counts[0] = cached_rows
+    cache_counts[1] += cache_lookups
+    cache_counts[2] += cache_hits
+
+    # Identify the most likely base at the root node; an ancestor is a gap if only gaps
+    # descend from it, which is the case if the subtree has a single base that is a gap
+    for q in range(num_full):
+        if subtree_bases[seed_node,q] == 4:
+            reconstructed_alleles[seed_node,q] = 4
+        else:
+            row = node_rows[seed_node,q]
+            max_root_index = 0
+            for i in range(1,4):
+                if Lmat[row,i] > Lmat[row,max_root_index]:
+                    max_root_index = i
+            reconstructed_alleles[seed_node,q] = Cmat[row,max_root_index]
+        pattern_index = block_start + full_patterns[q]
+        pattern_weights[q] = pattern_position_offsets[pattern_index+1] - pattern_position_offsets[pattern_index]
+
+    # Traverse the tree from the root in the direction of the OTUs, putting the gaps back in
+    # and counting substitutions on each branch
+    # Note that preordered node list does not include the root
+    for node_index in preordered_nodes:
+        parent_node_index = parent_nodes[node_index]
+        alignment_index = node_index_to_aln_row[node_index]
+        for q in range(num_full):
+            if alignment_index > -1:
+                base = get_packed_base(base_patterns, block_start + full_patterns[q], alignment_index)
+            elif subtree_bases[node_index,q] == 4:
+                base = 4
+            else:
+                base = Cmat[node_rows[node_index,q],reconstructed_alleles[parent_node_index,q]]
+            reconstructed_alleles[node_index,q] = base
+            parent_base = reconstructed_alleles[parent_node_index,q]
+            if base < 4 and parent_base < 4 and base != parent_base:
+                node_snps[node_index] += pattern_weights[q]
+
+    # Transfer reconstructed alleles into alignment
+    for q in range(num_full):
+        pattern_index = block_start + full_patterns[q]
+        for k in range(pattern_position_offsets[pattern_index], pattern_position_offsets[pattern_index+1]):
+            column = pattern_positions[k]
+            for index in range(ancestral_node_order.size):
+                set_packed_base(out_aln, column, index, reconstructed_alleles[ancestral_node_order[index],q])
+
+# Reconstruct a block of base patterns maximising the marginal posterior probability at each node
+#################################################################################################
+@njit(numba.void(numba.uint8[:,:],
+                numba.int32[:],
+                numba.int64[:],
+                numba.int64,
+                numba.int64,
+                numba.float64[:,:,::1],
+                numba.float64[:,:,::1],
+                numba.float64[:,:,::1],
+                numba.uint8[:,::1],
+                numba.uint8[:,::1],
+                numba.uint8[:,:],
+                numba.int32[:],
+                numba.int32[:],
+                numba.int32[:],
+                numba.int32[:,:],
+                numba.int32,
+                numba.int32[:],
+                numba.float64[:,:],
+                numba.float32[:],
+                numba.int32[:],
+                numba.int64[:]),
+                cache=True,
+                nogil=True)
+def reconstruct_marginal_pattern_block(base_patterns,
+                                        pattern_positions,
+                                        pattern_position_offsets,
+                                        block_start,
+                                        block_end,
+                                        partials,
+                                        branch_partials,
+                                        outside_partials,
+                                        gap_subtrees,
+                                        reconstructed_alleles,
+                                        out_aln,
+                                        postordered_nodes,
+                                        preordered_nodes,
+                                        parent_nodes,
+                                        child_nodes,
+                                        seed_node,
+                                        ancestral_node_order,
+                                        node_probabilities,
+                                        base_frequencies,
+                                        node_index_to_aln_row,
+                                        node_snps):
+    # The partial likelihoods of the sequences descending from each node (partials), the same
+    # likelihoods conditioned on the base at the start of the branch above the node (branch_partials),
+    # and the likelihoods of all other sequences (outside_partials) are calculated for every pattern.
+    # Each is rescaled to a maximum of one, as only the relative probabilities of the bases are required
+    num_patterns = block_end - block_start
+    parent_partials = numpy.empty(4, dtype = numpy.float64)
+
+    # Postorder traversal calculating the partial likelihoods, with gaps and unknown bases
+    # treated as missing data
+    for node_index in postordered_nodes:
+        alignment_index = node_index_to_aln_row[node_index]
+        for q in range(num_patterns):
+            if alignment_index > -1:
+                taxon_base_index = get_packed_base(base_patterns, block_start + q, alignment_index)
+                for i in range(4):
+                    if taxon_base_index > 3 or taxon_base_index == i:
+                        partials[node_index,q,i] = 1.0
+                    else:
+                        partials[node_index,q,i] = 0.0
+                gap_subtrees[node_index,q] = taxon_base_index > 3
+            else:
+                gap_subtree = True
+                for i in range(4):
+                    partials[node_index,q,i] = 1.0
+                for child_node_index in child_nodes[node_index,:]:
+                    if child_node_index > -1:
+                        if not gap_subtrees[child_node_index,q]:
+                            gap_subtree = False
+                        for i in range(4):
+                            partials[node_index,q,i] *= branch_partials[child_node_index,q,i]
+                scale = max(partials[node_index,q,0], partials[node_index,q,1], partials[node_index,q,2], partials[node_index,q,3])
+                if scale > 0.0:
+                    for i in range(4):
+                        partials[node_index,q,i] /= scale
+                gap_subtrees[node_index,q] = gap_subtree
+            if node_index != seed_node:
+                for start_index in range(4):
+                    branch_partial = 0.0
+                    for end_index in range(4):
+                        branch_partial += node_probabilities[node_index,start_index*4+end_index]*partials[node_index,q,end_index]
+                    branch_partials[node_index,q,start_index] = branch_partial
+
+    # Preorder traversal calculating the likelihoods outside of each subtree, starting from the
+    # base frequencies at the root
+    # Note that preordered node list does not include the root
+    for q in range(num_patterns):
+        for i in range(4):
+            outside_partials[seed_node,q,i] = base_frequencies[i]
+    for node_index in preordered_nodes:
+        parent_node_index = parent_nodes[node_index]
+        for q in range(num_patterns):
+            for start_index in range(4):
+                parent_partials[start_index] = outside_partials[parent_node_index,q,start_index]
+                for sibling_node_index in child_nodes[parent_node_index,:]:
+                    if sibling_node_index > -1 and sibling_node_index != node_index:
+                        parent_partials[start_index] *= branch_partials[sibling_node_index,q,start_index]
+            scale = 0.0
+            for end_index in range(4):
+                outside_partial = 0.0
+                for start_index in range(4):
+                    outside_partial += parent_partials[start_index]*node_probabilities[node_index,start_index*4+end_index]
+                outside_partials[node_index,q,end_index] = outside_partial
+                scale = max(scale, outside_partial)
+            if scale > 0.0:
+                for i in range(4):
+                    outside_partials[node_index,q,i] /= scale
+
+    # Identify the base with the highest posterior probability at each ancestral node; an ancestor
+    # is a gap if only gaps descend from it
+    for node_index in postordered_nodes:
+        alignment_index = node_index_to_aln_row[node_index]
+        for q in range(num_patterns):
+            if alignment_index > -1:
+                reconstructed_alleles[node_index,q] = get_packed_base(base_patterns, block_start + q, alignment_index)
+            elif gap_subtrees[node_index,q]:
+                reconstructed_alleles[node_index,q] = 4
+            else:
+                max_posterior_index = 0
+                max_posterior = partials[node_index,q,0]*outside_partials[node_index,q,0]
+                for i in range(1,4):
+                    posterior = partials[node_index,q,i]*outside_partials[node_index,q,i]
+                    if posterior > max_posterior:
+                        max_posterior_index = i
+                        max_posterior = posterior
+                reconstructed_alleles[node_index,q] = max_posterior_index
+
+    # Count substitutions on each branch
+    for node_index in preordered_nodes:
+        parent_node_index = parent_nodes[node_index]
+        for q in range(num_patterns):
+            base = reconstructed_alleles[node_index,q]
+            parent_base = reconstructed_alleles[parent_node_index,q]
+            if base < 4 and parent_base < 4 and base != parent_base:
+                pattern_index = block_start + q
+                node_snps[node_index] += pattern_position_offsets[pattern_index+1] - pattern_position_offsets[pattern_index]
+
+    # Transfer reconstructed alleles into alignment
+    for q in range(num_patterns):
+        pattern_index = block_start + q
+        for k in range(pattern_position_offsets[pattern_index], pattern_position_offsets[pattern_index+1]):
+            column = pattern_positions[k]
+            for index in range(ancestral_node_order.size):
+                set_packed_base(out_aln, column, index, reconstructed_alleles[ancestral_node_order[index],q])
+
 # Convert integers to bases
 ###########################
 
@@ -502,6 +1285,40 @@ def int_to_seq(seq,out_seq):
         else:
             print('Unable to process integer')
 
+kernel_load_time = time.perf_counter() - kernel_load_start
+compiled_kernels = [seq_to_int,
+                    find_most_likely_base_given_descendents,
+                    calculate_root_likelihood,
+                    process_leaf,
+                    count_node_snps,
+                    reconstruct_alleles,
+                    set_packed_base,
+                    get_packed_base,
+                    fill_out_aln,
+                    iterate_over_base_patterns,
+                    find_monomorphic_bases,
+                    calculate_singleton_background,
+                    estimate_pattern_costs,
+                    classify_base_patterns,
+                    reconstruct_base_pattern_block,
+                    reconstruct_marginal_pattern_block,
+                    int_to_seq]
+
+def check_compiled_kernels():
+    """Checks that every kernel was compiled, or loaded from the cache, when this module was imported, such
+    that worker processes do not compile them. Returns the time taken to import numba and load the kernels,
+    and the number of kernels loaded from the cache rather than compiled"""
+    cached_kernels = 0
+    for kernel in compiled_kernels:
+        # Kernels are Python functions if JIT compilation is disabled
+        if hasattr(kernel, 'overloads'):
+            if len(kernel.overloads) == 0:
+                sys.stderr.write("Unable to compile pyjar kernel " + kernel.__name__ + "\n")
+                sys.exit(1)
+            if sum(kernel.stats.cache_hits.values()) > 0:
+                cached_kernels += 1
+    return kernel_load_time, cached_kernels
+
 ##################
 # Main functions #
 ##################
@@ -510,18 +1327,78 @@ def int_to_seq(seq,out_seq):
 # Function for converting alignment to numpy array #
 ####################################################
 
+# Identifier at the start of binary base pattern files written by the C SNP finder, in which the
+# bases of each pattern are packed two per byte (see pack_bases)
+base_patterns_magic = b'GUBBPAT2'
+
+def map_binary_section(filename, dtype, offset, shape):
+    # Map a section of a binary file into a writeable (copy-on-write) array without reading it
+    if numpy.prod(shape) == 0:
+        return numpy.empty(shape, dtype = dtype)
+    return numpy.asarray(numpy.memmap(filename, dtype = dtype, mode = 'c', offset = offset, shape = shape))
+
+def read_binary_base_patterns(base_patterns_fn):
+    # Read the header recording the numbers of patterns, samples and positions, and the length of the names
+    with open(base_patterns_fn,'rb') as binary_file:
+        if binary_file.read(len(base_patterns_magic)) != base_patterns_magic:
+            sys.exit("Unable to read base patterns file " + base_patterns_fn + "\n")
+        num_patterns,num_samples,num_positions,names_length = \
+            numpy.frombuffer(binary_file.read(32), dtype = numpy.int64).tolist()
+    # Each section starts at a multiple of eight bytes
+    offset = len(base_patterns_magic) + 32
+    base_patterns = map_binary_section(base_patterns_fn, numpy.uint8, offset, (num_patterns,packed_width(num_samples)))
+    offset += -(-num_patterns*packed_width(num_samples)//8)*8
+    pattern_position_offsets = map_binary_section(base_patterns_fn, numpy.int64, offset, (num_patterns + 1,))
+    offset += 8*(num_patterns + 1)
+    pattern_positions = map_binary_section(base_patterns_fn, numpy.int32, offset, (num_positions,))
+    offset += -(-4*num_positions//8)*8
+    with open(base_patterns_fn,'rb') as binary_file:
+        binary_file.seek(offset)
+        sequence_names = binary_file.read(names_length).decode().splitlines()
+    base_pattern_positions = numpy.split(pattern_positions, pattern_position_offsets[1:-1])
+    array_max = int(pattern_positions.max()) + 1 if num_positions > 0 else 0
+    return sequence_names,base_patterns,base_pattern_positions,array_max
+
+def get_base_pattern_dimensions(prefix):
+    # Count the sequences, polymorphic sites and unique base patterns without loading the patterns
+    base_patterns_bin_fn = prefix + '.gaps.base_patterns.bin'
+    if os.path.isfile(base_patterns_bin_fn):
+        with open(base_patterns_bin_fn,'rb') as binary_file:
+            if binary_file.read(len(base_patterns_magic)) != base_patterns_magic:
+                sys.exit("Unable to read base patterns file " + base_patterns_bin_fn + "\n")
+            num_patterns,num_samples,num_positions,_ = \
+                numpy.frombuffer(binary_file.read(32), dtype = numpy.int64).tolist()
+        return num_samples,num_positions,num_patterns
+    counts = []
+    for suffix in ['.gaps.sequence_names.csv','.gaps.base_positions.csv']:
+        if not os.path.isfile(prefix + suffix):
+            sys.exit("Unable to open file " + prefix + suffix + "\n")
+        num_lines = 0
+        num_entries = 0
+        with open(prefix + suffix,'r') as csv_file:
+            for line in csv_file:
+                num_lines += 1
+                num_entries += line.count(',') + 1
+        counts.append((num_lines,num_entries))
+    # Each line of the positions file lists the positions of one pattern
+    return counts[0][0],counts[1][1],counts[1][0]
+
 def get_base_patterns(prefix, verbose, threads = 1):
     
     # Identify unique base patterns
     if verbose:
         print("Finding unique base patterns")
     t1=time.process_time()
-    
-    # Check njit function is compiled before multiprocessing
-    try:
-        seq_to_int()
-    except:
-        pass
+
+    # Use the memory-mapped binary output of the SNP finder if available
+    base_patterns_bin_fn = prefix + '.gaps.base_patterns.bin'
+    if os.path.isfile(base_patterns_bin_fn):
+        sequence_names,base_patterns,base_pattern_positions,array_max = read_binary_base_patterns(base_patterns_bin_fn)
+        t2=time.process_time()
+        if verbose:
+            print("Time taken to load unique base patterns:", t2-t1, "seconds")
+            print("Unique base patterns: ", array_max)
+        return sequence_names,base_patterns,base_pattern_positions,array_max
 
     # Read in ordered sequence names
     sequence_names_fn = prefix + '.gaps.sequence_names.csv'
@@ -534,7 +1411,7 @@ def get_base_patterns(prefix, verbose, threads = 1):
 
     # Convert alignment to Numpy array
     codec = 'utf-32-le' if sys.byteorder == 'little' else 'utf-32-be'
-    # Read in the unique base patterns
+    # Read in the unique base patterns, packing the bases two per byte
     base_patterns_fn = prefix + '.gaps.base_patterns.csv'
     if not os.path.isfile(base_patterns_fn):
         sys.exit("Unable to open base patterns file " + base_patterns_fn + "\n")
@@ -544,7 +1421,7 @@ def get_base_patterns(prefix, verbose, threads = 1):
             unicode_seq = numpy.frombuffer(bytearray(line.rstrip(), codec), dtype = 'U1')
             out_array = numpy.ndarray(unicode_seq.shape, dtype = numpy.uint8)
             seq_to_int(unicode_seq,out_array)
-            array_of_pattern_arrays.append(out_array)
+            array_of_pattern_arrays.append(pack_bases(out_array))
     vstacked_patterns = numpy.vstack(array_of_pattern_arrays)
     # Read in base positions
     array_of_position_arrays = []
@@ -571,13 +1448,712 @@ def get_base_patterns(prefix, verbose, threads = 1):
     # Return output
     return sequence_names,vstacked_patterns,array_of_position_arrays,array_max
 
+###################################################
+# Functions for writing reconstructed sequences   #
+###################################################
+
+# Characters corresponding to the integer encoding of bases
+reconstruction_encoding = b'ACGT-N'
+# Identifier at the start of binary reconstruction files
+reconstruction_magic = b'PYJARREC'
+# Alignment of the sequence matrix within binary reconstruction files
+reconstruction_data_alignment = 64
+
+def packed_width(num_bases):
+    # Number of bytes required to store bases packed two per byte
+    return (num_bases + 1)//2
+
+def pack_bases(bases):
+    # Pack the last axis of an array of base indices two per byte, with even indices in the low four
+    # bits; an odd number of bases is padded with an unknown base
+    bases = numpy.asarray(bases, dtype = numpy.uint8)
+    if bases.shape[-1] % 2 == 1:
+        bases = numpy.concatenate((bases, numpy.full(bases.shape[:-1] + (1,), 5, dtype = numpy.uint8)), axis = -1)
+    return bases[...,0::2] | (bases[...,1::2] << 4)
+
+def unpack_bases(packed_bases, num_bases):
+    # Unpack the last axis of an array of packed base indices
+    packed_bases = numpy.asarray(packed_bases, dtype = numpy.uint8)
+    bases = numpy.empty(packed_bases.shape[:-1] + (2*packed_bases.shape[-1],), dtype = numpy.uint8)
+    numpy.bitwise_and(packed_bases, 0x0F, out = bases[...,0::2])
+    numpy.right_shift(packed_bases, 4, out = bases[...,1::2])
+    return bases[...,:num_bases]
+
+def unpack_node_block(packed_aln, start, end):
+    # Unpack the bases of nodes start to end (start being even) as a (nodes x sites) array
+    return numpy.ascontiguousarray(unpack_bases(packed_aln[:,start//2:packed_width(end)], end - start).T)
+
+def write_reconstruction_fasta(out_aln, node_names, alignment_filename, output_filename, chunk_size = 256):
+    # Copy the input alignment, then append the reconstructed sequences, unpacking blocks of
+    # nodes from the packed (sites x nodes) matrix and translating these to bytes with a lookup table
+    lookup_table = numpy.frombuffer(reconstruction_encoding, dtype = numpy.uint8)
+    shutil.copy(alignment_filename, output_filename)
+    chunk_size += chunk_size % 2
+    with open(output_filename, 'ab') as asr_output:
+        for start in range(0, len(node_names), chunk_size):
+            sequences = lookup_table[unpack_node_block(out_aln, start, min(start + chunk_size, len(node_names)))]
+            for node_name,sequence in zip(node_names[start:start+chunk_size],sequences):
+                asr_output.write(b'>' + node_name.encode() + b'\n')
+                asr_output.write(sequence.tobytes())
+                asr_output.write(b'\n')
+
+def choose_node_chunk_size(num_sites, memory_budget = None, max_chunk_size = 256):
+    # Limit the blocks of nodes unpacked for output to a quarter of the memory budget
+    if memory_budget is None or num_sites == 0:
+        return max_chunk_size
+    return int(min(max(memory_budget//(8*num_sites),1),max_chunk_size))
+
+def get_reconstruction_data_offset(header_length):
+    # Start the sequence matrix at an aligned position after the magic, header length and header
+    header_end = len(reconstruction_magic) + 8 + header_length
+    return -(-header_end//reconstruction_data_alignment)*reconstruction_data_alignment
+
+def write_reconstruction_binary(out_aln, node_names, output_filename, chunk_size = 256):
+    # Write a JSON header describing the nodes, sites and encoding, followed by a
+    # (nodes x sites) matrix of base indices unpacked from the (sites x nodes) matrix
+    # and written through a memory map
+    num_sites = out_aln.shape[0]
+    header = json.dumps({'encoding': reconstruction_encoding.decode(),
+                         'sites': int(num_sites),
+                         'nodes': list(node_names)}).encode()
+    data_offset = get_reconstruction_data_offset(len(header))
+    with open(output_filename, 'wb') as binary_output:
+        binary_output.write(reconstruction_magic)
+        binary_output.write(numpy.array(len(header), dtype = '<u8').tobytes())
+        binary_output.write(header)
+        binary_output.truncate(data_offset + len(node_names)*num_sites)
+    if len(node_names)*num_sites > 0:
+        sequences = numpy.memmap(output_filename,
+                                 dtype = numpy.uint8,
+                                 mode = 'r+',
+                                 offset = data_offset,
+                                 shape = (len(node_names),num_sites))
+        # Transpose blocks of nodes so each sequence is contiguous in the file
+        chunk_size += chunk_size % 2
+        for start in range(0, len(node_names), chunk_size):
+            end = min(start + chunk_size, len(node_names))
+            sequences[start:end,:] = unpack_node_block(out_aln, start, end)
+        sequences.flush()
+        del sequences
+
+def read_reconstruction_binary(filename):
+    # Return the node names and a read-only memory map of the (nodes x sites) matrix
+    # of base indices, which can be converted to bases with the encoding
+    with open(filename, 'rb') as binary_input:
+        if binary_input.read(len(reconstruction_magic)) != reconstruction_magic:
+            sys.exit("Unable to read binary reconstruction file " + filename + "\n")
+        header_length = int(numpy.frombuffer(binary_input.read(8), dtype = '<u8')[0])
+        header = json.loads(binary_input.read(header_length).decode())
+    shape = (len(header['nodes']),header['sites'])
+    if shape[0]*shape[1] > 0:
+        sequences = numpy.memmap(filename,
+                                 dtype = numpy.uint8,
+                                 mode = 'r',
+                                 offset = get_reconstruction_data_offset(header_length),
+                                 shape = shape)
+    else:
+        sequences = numpy.empty(shape, dtype = numpy.uint8)
+    return header['nodes'],sequences
+
+##############################################################
+# Functions for reconstructing blocks of base patterns using #
+# data installed once per worker process                     #
+##############################################################
+
+# Data shared by all reconstruction tasks run within a process
+reconstruction_worker_state = {}
+
+class ReconstructionWorkspace:
+    """Scratch arrays for reconstructing blocks of base patterns, allocated once per worker
+    and only enlarged when a tree or block of patterns requires more space"""
+
+    def __init__(self):
+        """Initialises an empty workspace"""
+        self.buffers = {}
+        self.allocations = 0
+
+    def get_array(self, name, shape, dtype):
+        """Returns an uninitialised C-contiguous array, reusing the buffer of the same name if it is large enough"""
+        size = int(numpy.prod(shape))
+        buffer = self.buffers.get(name)
+        if buffer is None or buffer.size < size or buffer.dtype != dtype:
+            buffer = numpy.empty(max(size,1), dtype = dtype)
+            self.buffers[name] = buffer
+            self.allocations += 1
+        return buffer[:size].reshape(shape)
+
+    def get_index_array(self, name, size):
+        """Returns an array of the integers up to size, which are only generated when the buffer is enlarged"""
+        allocations = self.allocations
+        index_array = self.get_array(name, (size,), numpy.int32)
+        if self.allocations > allocations:
+            self.buffers[name][:] = numpy.arange(self.buffers[name].size, dtype = numpy.int32)
+        return index_array
+
+def initialise_reconstruction_worker(base_patterns = None,
+                                    new_aln = None,
+                                    pattern_positions = None,
+                                    pattern_position_offsets = None,
+                                    node_snp_counts = None,
+                                    state = reconstruction_worker_state):
+    """Attaches shared memory arrays for the lifetime of a worker"""
+    release_reconstruction_worker(state = state)
+    shared_memory_handles = []
+    for key,shared_array in [('base_patterns',base_patterns),
+                                ('out_aln',new_aln),
+                                ('pattern_positions',pattern_positions),
+                                ('pattern_position_offsets',pattern_position_offsets),
+                                ('node_snp_counts',node_snp_counts)]:
+        if isinstance(shared_array, NumpyMapped):
+            state[key] = attach_mapped_array(shared_array)
+            continue
+        shm = shared_memory.SharedMemory(name = shared_array.name)
+        shared_memory_handles.append(shm)
+        state[key] = numpy.ndarray(shared_array.shape,
+                                    dtype = shared_array.dtype,
+                                    buffer = shm.buf)
+    state['shared_memory_handles'] = shared_memory_handles
+
+def attach_shared_array(shared_array, state = reconstruction_worker_state):
+    """Attaches a shared memory or memory-mapped array within a worker, retaining it for subsequent
+    tasks; arrays in the memory of the calling process are used directly"""
+    if isinstance(shared_array, numpy.ndarray):
+        return shared_array
+    attached_arrays = state.setdefault('attached_arrays',{})
+    if isinstance(shared_array, NumpyMapped):
+        if shared_array.filename not in attached_arrays:
+            attached_arrays[shared_array.filename] = attach_mapped_array(shared_array)
+        return attached_arrays[shared_array.filename]
+    if shared_array.name not in attached_arrays:
+        shm = shared_memory.SharedMemory(name = shared_array.name)
+        state['shared_memory_handles'].append(shm)
+        attached_arrays[shared_array.name] = numpy.ndarray(shared_array.shape,
+                                                            dtype = shared_array.dtype,
+                                                            buffer = shm.buf)
+    return attached_arrays[shared_array.name]
+
+def install_reconstruction_arrays(base_patterns = None,
+                                    new_aln = None,
+                                    pattern_positions = None,
+                                    pattern_position_offsets = None,
+                                    node_snp_counts = None,
+                                    state = reconstruction_worker_state):
+    """Installs arrays in the memory of the calling process for reconstruction within a thread"""
+    release_reconstruction_worker(state = state)
+    state.update(base_patterns = base_patterns,
+                    out_aln = new_aln,
+                    pattern_positions = pattern_positions,
+                    pattern_position_offsets = pattern_position_offsets,
+                    node_snp_counts = node_snp_counts)
+
+def release_reconstruction_worker(state = reconstruction_worker_state):
+    """Closes any shared memory attached by the worker"""
+    shared_memory_handles = state.get('shared_memory_handles',[])
+    state.clear()
+    for shm in shared_memory_handles:
+        shm.close()
+
+def reconstruct_pattern_block(block_index, block_start, block_end, topology = None, block_store = None, state = reconstruction_worker_state):
+    """Reconstructs a contiguous block of base patterns on a tree using the worker data, adding the substitutions
+    on each branch to the row of the shared counts for the block, and storing the results for every node in the
+    shared memory arrays of block_store if these are provided"""
+    if topology is not None:
+        state.update(topology)
+    if state.get('reconstruction') == 'marginal':
+        return reconstruct_marginal_block(block_index, block_start, block_end, state = state)
+    num_nodes = state['postordered_nodes'].size
+    batch_size = choose_pattern_batch_size(num_nodes, block_end - block_start)
+    cache_size = max(state['subtree_cache_size'], num_nodes*min(batch_size,subtree_cache_keys))
+
+    # Data structures are reused for every batch of patterns within the block, and for every
+    # block and tree reconstructed by the worker
+    workspace = state.setdefault('workspace', ReconstructionWorkspace())
+    node_rows = workspace.get_array('node_rows', (num_nodes,batch_size), numpy.int32)
+    subtree_bases = workspace.get_array('subtree_bases', (num_nodes,batch_size), numpy.uint8)
+    reconstructed_alleles = workspace.get_array('reconstructed_alleles', (num_nodes,batch_size), numpy.uint8)
+    full_patterns = workspace.get_array('full_patterns', (batch_size,), numpy.int32)
+    base_masks = workspace.get_array('base_masks', (batch_size,), numpy.uint8)
+    pattern_weights = workspace.get_array('pattern_weights', (batch_size,), numpy.int32)
+    node_snps = state['node_snp_counts'][block_index,:num_nodes]
+    node_snps.fill(0)
+
+    # Patterns with analytic reconstructions are resolved before the likelihood calculation; singleton
+    # patterns are only resolved if the results are not stored for reuse with subsequent trees, as their
+    # classification depends on the branch lengths
+    resolve_singletons = block_store is None
+    node_known = workspace.get_array('node_known', (num_nodes,), numpy.uint8)
+    aln_row_nodes = workspace.get_array('aln_row_nodes', (state['num_samples'],), numpy.int32)
+    singleton_L = workspace.get_array('singleton_L', (16,num_nodes,4), numpy.float32)
+    singleton_C = workspace.get_array('singleton_C', (16,num_nodes,4), numpy.uint8)
+    singleton_uniform = workspace.get_array('singleton_uniform', (16,num_nodes), numpy.uint8)
+    singleton_ready = workspace.get_array('singleton_ready', (16,), numpy.uint8)
+    singleton_ready.fill(0)
+    path_L = workspace.get_array('path_L', (num_nodes,4), numpy.float32)
+    path_C = workspace.get_array('path_C', (num_nodes,4), numpy.uint8)
+    pattern_class_counts = workspace.get_array('pattern_class_counts', (3,), numpy.int64) # monomorphic, singleton, full
+    pattern_class_counts.fill(0)
+
+    # Rows of likelihoods for each pattern are followed by the rows of the subtree cache,
+    # which persists across batches until it is full; the cache is indexed by node and by
+    # the shared base of the subtree combined with the bases present in the pattern
+    subtree_cache = workspace.get_array('subtree_cache', (num_nodes,subtree_cache_keys), numpy.int32)
+    subtree_cache.fill(-1)
+    cache_counts = workspace.get_array('cache_counts', (4,), numpy.int64) # cached rows, lookups, hits, flushes
+    cache_counts.fill(0)
+    if block_store is None:
+        Lmat = workspace.get_array('Lmat', (num_nodes*batch_size + cache_size,4), numpy.float32)
+        Cmat = workspace.get_array('Cmat', (num_nodes*batch_size + cache_size,4), numpy.uint8)
+        node_slots = workspace.get_index_array('node_slots', num_nodes)
+        node_reused = workspace.get_array('node_reused', (num_nodes,), numpy.uint8)
+        node_reused.fill(0)
+        stored_bases = workspace.get_array('stored_bases', (1,1), numpy.uint8)
+    else:
+        Lmat, Cmat, stored_bases = [attach_shared_array(shared_array, state = state) for shared_array in block_store]
+        node_slots = state['node_slots']
+        node_reused = state['node_reused']
+
+    for batch_start in range(block_start, block_end, batch_size):
+        batch_end = min(batch_start + batch_size, block_end)
+        num_full = classify_base_patterns(state['base_patterns'],
+                                            state['num_samples'],
+                                            state['pattern_positions'],
+                                            state['pattern_position_offsets'],
+                                            batch_start,
+                                            batch_end,
+                                            full_patterns,
+                                            base_masks,
+                                            pattern_class_counts,
+                                            state['out_aln'],
+                                            state['postordered_nodes'],
+                                            state['parent_nodes'],
+                                            state['child_nodes'],
+                                            state['seed_node'],
+                                            state['ancestral_node_order'],
+                                            state['node_pij'],
+                                            state['base_frequencies'],
+                                            state['node_index_to_aln_row'],
+                                            node_snps,
+                                            resolve_singletons,
+                                            node_known,
+                                            aln_row_nodes,
+                                            singleton_L,
+                                            singleton_C,
+                                            singleton_uniform,
+                                            singleton_ready,
+                                            path_L,
+                                            path_C)
+        reconstruct_base_pattern_block(state['base_patterns'],
+                                        state['pattern_positions'],
+                                        state['pattern_position_offsets'],
+                                        batch_start,
+                                        batch_end,
+                                        node_rows,
+                                        subtree_bases,
+                                        reconstructed_alleles,
+                                        full_patterns,
+                                        num_full,
+                                        base_masks,
+                                        pattern_weights,
+                                        Lmat,
+                                        Cmat,
+                                        subtree_cache,
+                                        cache_counts,
+                                        state['out_aln'],
+                                        state['postordered_nodes'],
+                                        state['preordered_nodes'],
+                                        state['parent_nodes'],
+                                        state['child_nodes'],
+                                        state['seed_node'],
+                                        state['ancestral_node_order'],
+                                        state['node_pij'],
+                                        state['base_frequencies'],
+                                        state['node_index_to_aln_row'],
+                                        node_snps,
+                                        block_store is not None,
+                                        block_start,
+                                        node_slots,
+                                        node_reused,
+                                        stored_bases)
+
+    return cache_counts[1:].copy(), pattern_class_counts.copy()
+
+def reconstruct_marginal_block(block_index, block_start, block_end, state = reconstruction_worker_state):
+    """Reconstructs a contiguous block of base patterns on a tree by maximising the marginal posterior probability
+    of the base at each node, returning counts in the same form as reconstruct_pattern_block"""
+    num_nodes = state['postordered_nodes'].size
+    # Each node and pattern requires three rows of double-precision partial likelihoods
+    batch_size = choose_pattern_batch_size(num_nodes, block_end - block_start, max_bytes = 2**25//6)
+    workspace = state.setdefault('workspace', ReconstructionWorkspace())
+    partials = workspace.get_array('partials', (num_nodes,batch_size,4), numpy.float64)
+    branch_partials = workspace.get_array('branch_partials', (num_nodes,batch_size,4), numpy.float64)
+    outside_partials = workspace.get_array('outside_partials', (num_nodes,batch_size,4), numpy.float64)
+    gap_subtrees = workspace.get_array('gap_subtrees', (num_nodes,batch_size), numpy.uint8)
+    reconstructed_alleles = workspace.get_array('reconstructed_alleles', (num_nodes,batch_size), numpy.uint8)
+    node_snps = state['node_snp_counts'][block_index,:num_nodes]
+    node_snps.fill(0)
+    for batch_start in range(block_start, block_end, batch_size):
+        reconstruct_marginal_pattern_block(state['base_patterns'],
+                                            state['pattern_positions'],
+                                            state['pattern_position_offsets'],
+                                            batch_start,
+                                            min(batch_start + batch_size, block_end),
+                                            partials,
+                                            branch_partials,
+                                            outside_partials,
+                                            gap_subtrees,
+                                            reconstructed_alleles,
+                                            state['out_aln'],
+                                            state['postordered_nodes'],
+                                            state['preordered_nodes'],
+                                            state['parent_nodes'],
+                                            state['child_nodes'],
+                                            state['seed_node'],
+                                            state['ancestral_node_order'],
+                                            state['node_probabilities'],
+                                            state['base_frequencies'],
+                                            state['node_index_to_aln_row'],
+                                            node_snps)
+    # Every pattern is reconstructed without the subtree cache
+    return numpy.zeros(3, dtype = numpy.int64), numpy.array([0, 0, block_end - block_start], dtype = numpy.int64)
+
+def choose_pattern_batch_size(num_nodes, num_patterns, max_batch_size = 512, max_bytes = 2**25):
+    """Selects the number of patterns reconstructed together, limiting the size of the likelihood tensor"""
+    batch_size = max_bytes//(16*max(num_nodes,1))
+    return int(max(1, min(batch_size, max_batch_size, num_patterns)))
+
+# Estimated costs of reconstructing singleton and other polymorphic patterns, relative to writing a single position
+singleton_pattern_cost = 1.0
+full_pattern_cost = 4.0
+
+def balance_pattern_blocks(pattern_costs, num_blocks):
+    """Divides the patterns into up to num_blocks contiguous blocks of similar estimated cost"""
+    if pattern_costs.size == 0:
+        return []
+    cumulative_costs = numpy.cumsum(pattern_costs)
+    targets = cumulative_costs[-1]*numpy.arange(1, num_blocks)/num_blocks
+    # Each block ends either before or after the pattern at which the cumulative cost reaches the
+    # target, whichever is closer to the target
+    crossings = numpy.searchsorted(cumulative_costs, targets)
+    previous_costs = numpy.where(crossings > 0, cumulative_costs[numpy.maximum(crossings - 1, 0)], 0.0)
+    ends = crossings + (cumulative_costs[crossings] - targets < targets - previous_costs)
+    boundaries = numpy.unique(numpy.concatenate(([0], ends, [pattern_costs.size])))
+    return [(int(block_start), int(block_end)) for block_start,block_end in zip(boundaries[:-1],boundaries[1:])]
+
+def run_reconstruction_task(task, idle_states = None):
+    """Reconstructs a block of patterns, returning the block index, the worker, the wall-clock and CPU time taken
+    and the counts from reconstruct_pattern_block; tasks run within this process use the state of an idle worker
+    from the queue"""
+    start_time = time.perf_counter()
+    start_cpu_time = time.thread_time()
+    if idle_states is None:
+        worker = os.getpid()
+        block_counts = reconstruct_pattern_block(*task)
+    else:
+        worker, state = idle_states.get()
+        try:
+            block_counts = reconstruct_pattern_block(*task, state = state)
+        finally:
+            idle_states.put((worker, state))
+    return task[0], worker, time.perf_counter() - start_time, time.thread_time() - start_cpu_time, block_counts
+
+def convert_positions_to_offsets(base_pattern_positions):
+    """Converts a list of position arrays into a flat array with offsets for each pattern"""
+    pattern_position_offsets = numpy.zeros(len(base_pattern_positions) + 1, dtype = numpy.int64)
+    pattern_position_offsets[1:] = numpy.cumsum([len(p) for p in base_pattern_positions])
+    if len(base_pattern_positions) > 0:
+        pattern_positions = numpy.concatenate(base_pattern_positions).astype(numpy.int32, copy = False)
+    else:
+        pattern_positions = numpy.zeros(0, dtype = numpy.int32)
+    return pattern_positions, pattern_position_offsets
+
+def calculate_node_fingerprints(postordered_nodes, child_nodes, node_pij, node_index_to_aln_row, seed_node, base_frequencies):
+    """Generates a digest for each node identifying its subtree from the sequences, topology and transition probabilities"""
+    node_fingerprints = [None for _ in postordered_nodes]
+    for node_index in postordered_nodes:
+        digest = hashlib.blake2b(node_pij[node_index,:].tobytes(), digest_size = 16)
+        digest.update(node_index_to_aln_row[node_index].tobytes())
+        for child_node_index in child_nodes[node_index,:]:
+            if child_node_index > -1:
+                digest.update(node_fingerprints[child_node_index])
+        if node_index == seed_node:
+            digest.update(base_frequencies.tobytes())
+        node_fingerprints[node_index] = digest.digest()
+    return node_fingerprints
+
+class ReconstructionEngine:
+    """Workers and shared memory used to reconstruct the same base patterns on successive trees"""
+
+    def __init__(self,
+                base_patterns = None,
+                num_samples = None,
+                base_pattern_positions = None,
+                max_pos = None,
+                threads = 1,
+                mp_method = "spawn",
+                incremental = False,
+                incremental_memory = 2**30,
+                backend = "process",
+                memory_budget = None,
+                temp_dir = None,
+                blocks_per_worker = 4):
+        """Makes the base patterns of the num_samples sequences, packed two bases per byte, accessible to the
+        workers and starts them; the thread backend reconstructs
+        blocks of patterns in parallel within this process, and the process backend uses worker processes
+        attached to shared memory. The patterns are divided into blocks of similar estimated cost, several per
+        worker, which are taken by the workers as they become idle. If the alignments exceed the memory budget (bytes), the output alignment,
+        and any arrays shared with worker processes, are memory-mapped from files in the temporary directory"""
+        if backend not in ["thread","process"]:
+            sys.stderr.write("Unrecognised reconstruction backend " + str(backend) + "\n")
+            sys.exit(1)
+        self.threads = threads
+        self.mp_method = mp_method
+        self.backend = backend
+        self.num_samples = num_samples
+        self.max_pos = max_pos
+        self.memory_budget = memory_budget
+        self.temp_dir = temp_dir
+        self.out_of_core = memory_budget is not None and \
+                            base_patterns.nbytes + max_pos*packed_width(max(num_samples - 1, 1)) > memory_budget
+        self.mapped_files = []
+        self.out_aln_file = None
+        pattern_positions, pattern_position_offsets = convert_positions_to_offsets(base_pattern_positions)
+        pattern_costs = numpy.zeros(len(base_patterns), dtype = numpy.float64)
+        if len(base_patterns) > 0:
+            estimate_pattern_costs(base_patterns, num_samples, pattern_position_offsets, singleton_pattern_cost, full_pattern_cost,
+                                    pattern_costs)
+        self.pattern_blocks = balance_pattern_blocks(pattern_costs, threads*blocks_per_worker if threads > 1 else 1)
+        self.block_costs = [float(pattern_costs[block_start:block_end].sum()) for block_start,block_end in self.pattern_blocks]
+        self.worker_busy_times = None
+        self.worker_cpu_times = None
+        # Incremental reconstruction stores the results for every node of a rooted bifurcating tree
+        self.incremental = incremental
+        self.incremental_memory = incremental_memory
+        self.num_slots = 2*num_samples - 1
+        self.block_stores = None
+        self.slot_fingerprints = {}
+        self.monomorphic_bases = None
+        self.reused_nodes = None
+        self.pattern_class_counts = None # Monomorphic, singleton and fully reconstructed patterns (see classify_base_patterns)
+        self.pool = None
+        self.worker_state = {} # Used if reconstructing within this process
+        # Each thread reconstructing blocks within this process takes the state, including the workspace,
+        # of an idle worker
+        self.worker_states = [self.worker_state] + [{} for _ in range(threads - 1)]
+        self.idle_states = queue.SimpleQueue()
+        for worker_state in enumerate(self.worker_states):
+            self.idle_states.put(worker_state)
+        self.out_aln = None
+        self.out_aln_shm = None
+        self.ancestral_node_capacity = 0
+        self.node_snp_counts = None
+        self.node_snp_counts_shm = None
+        if self.backend == "process":
+            self.smm = SharedMemoryManager()
+            self.smm.start()
+        else:
+            self.smm = None
+        self.base_patterns_shared_array = self.share_array(base_patterns)
+        self.pattern_positions_shared_array = self.share_array(pattern_positions)
+        self.pattern_position_offsets_shared_array = self.share_array(pattern_position_offsets)
+        # A rooted bifurcating tree has one fewer ancestral nodes than sequences
+        self.start_workers(max(num_samples - 1, 1))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def share_array(self, array):
+        """Returns an array accessible to the workers, which is copied into shared memory, or a memory-mapped
+        file if reconstructing out of core, if these are processes"""
+        if self.smm is None:
+            return array
+        if self.out_of_core:
+            mapped_array = generate_mapped_array(array, self.temp_dir)
+            self.mapped_files.append(mapped_array.filename)
+            return mapped_array
+        return generate_shared_mem_array(array, self.smm)
+
+    def start_workers(self, num_ancestral_nodes, num_nodes = 0):
+        """Allocates the output alignment, with the bases of the ancestral nodes packed two per byte, and
+        the substitution counts for a number of ancestral nodes, and (re)starts the workers"""
+        self.stop_workers()
+        self.ancestral_node_capacity = num_ancestral_nodes
+        if self.out_of_core:
+            # Columns are written directly to the mapped file, such that only the pages in use are resident
+            new_aln_shared_array = create_mapped_array((self.max_pos,packed_width(num_ancestral_nodes)), numpy.uint8, self.temp_dir,
+                                                        fill_value = 0x55)
+            self.out_aln_file = new_aln_shared_array.filename
+            new_aln_array = attach_mapped_array(new_aln_shared_array)
+        else:
+            new_aln_array = numpy.full((self.max_pos,packed_width(num_ancestral_nodes)), 0x55, dtype = numpy.uint8)
+        # Each block of patterns accumulates the substitutions on each branch in its own row
+        node_snp_counts_array = numpy.zeros((len(self.pattern_blocks),max(num_nodes,2*num_ancestral_nodes + 1)), dtype = numpy.int64)
+        if self.backend == "thread":
+            # The numba kernels release the GIL, such that threads reconstruct blocks in parallel
+            self.out_aln = new_aln_array
+            self.node_snp_counts = node_snp_counts_array
+            for state in self.worker_states:
+                install_reconstruction_arrays(self.base_patterns_shared_array,
+                                                self.out_aln,
+                                                self.pattern_positions_shared_array,
+                                                self.pattern_position_offsets_shared_array,
+                                                self.node_snp_counts,
+                                                state = state)
+            if self.threads > 1:
+                self.pool = ThreadPool(processes = self.threads)
+            return
+        if self.out_of_core:
+            self.out_aln = new_aln_array
+        else:
+            new_aln_shared_array = generate_shared_mem_array(new_aln_array, self.smm)
+            self.out_aln_shm = shared_memory.SharedMemory(name = new_aln_shared_array.name)
+            self.out_aln = numpy.ndarray(new_aln_array.shape, dtype = numpy.uint8, buffer = self.out_aln_shm.buf)
+        node_snp_counts_shared_array = generate_shared_mem_array(node_snp_counts_array, self.smm)
+        self.node_snp_counts_shm = shared_memory.SharedMemory(name = node_snp_counts_shared_array.name)
+        self.node_snp_counts = numpy.ndarray(node_snp_counts_array.shape, dtype = numpy.int64, buffer = self.node_snp_counts_shm.buf)
+        worker_data = (self.base_patterns_shared_array,
+                        new_aln_shared_array,
+                        self.pattern_positions_shared_array,
+                        self.pattern_position_offsets_shared_array,
+                        node_snp_counts_shared_array)
+        if self.threads > 1:
+            self.pool = multiprocessing.get_context(method = self.mp_method).Pool(processes = self.threads,
+                                                                                initializer = initialise_reconstruction_worker,
+                                                                                initargs = worker_data)
+        else:
+            initialise_reconstruction_worker(*worker_data, state = self.worker_state)
+
+    def stop_workers(self):
+        """Stops the workers and releases the output alignment"""
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+        for state in self.worker_states:
+            release_reconstruction_worker(state = state)
+        self.out_aln = None
+        self.node_snp_counts = None
+        for shm in [self.out_aln_shm, self.node_snp_counts_shm]:
+            if shm is not None:
+                shm.close()
+        self.out_aln_shm = None
+        self.node_snp_counts_shm = None
+        if self.out_aln_file is not None:
+            os.remove(self.out_aln_file)
+            self.out_aln_file = None
+
+    def allocate_block_stores(self):
+        """Allocates shared memory for the results of every node slot and pattern in each block, if
+        these fit within the memory limit"""
+        store_rows = [self.num_slots*(block_end - block_start + subtree_cache_keys) for block_start,block_end in self.pattern_blocks]
+        store_bytes = sum(store_rows)*20 + self.num_slots*self.pattern_blocks[-1][1]
+        if store_bytes > self.incremental_memory:
+            return False
+        self.block_stores = []
+        for (block_start,block_end),num_rows in zip(self.pattern_blocks,store_rows):
+            self.block_stores.append((self.share_array(numpy.empty((num_rows,4), dtype = numpy.float32)),
+                                        self.share_array(numpy.empty((num_rows,4), dtype = numpy.uint8)),
+                                        self.share_array(numpy.empty((self.num_slots,block_end - block_start),
+                                                                        dtype = numpy.uint8))))
+        return True
+
+    def assign_node_slots(self, node_fingerprints):
+        """Assigns each node to a slot in the block stores, reusing the slot of any node with an
+        identical subtree in the previous tree"""
+        num_nodes = len(node_fingerprints)
+        if num_nodes > self.num_slots or (self.block_stores is None and not self.allocate_block_stores()):
+            self.slot_fingerprints = {}
+            return None, None
+        node_slots = numpy.full(num_nodes, -1, dtype = numpy.int32)
+        node_reused = numpy.zeros(num_nodes, dtype = numpy.uint8)
+        for node_index,fingerprint in enumerate(node_fingerprints):
+            if fingerprint in self.slot_fingerprints:
+                node_slots[node_index] = self.slot_fingerprints[fingerprint]
+                node_reused[node_index] = 1
+        free_slots = numpy.setdiff1d(numpy.arange(self.num_slots, dtype = numpy.int32), node_slots[node_reused == 1])
+        node_slots[node_reused == 0] = free_slots[:num_nodes - numpy.count_nonzero(node_reused)]
+        self.slot_fingerprints = dict(zip(node_fingerprints,node_slots))
+        return node_slots, node_reused
+
+    def reconstruct(self, topology, num_ancestral_nodes, node_fingerprints = None, profile = None):
+        """Reconstructs all base patterns on a tree, returning the ancestral alignment, the substitutions on
+        each branch and the subtree cache counts for each block; in incremental mode, the node fingerprints
+        identify subtrees unchanged since the previous tree. The timings of each phase of the reconstruction
+        are added to the profile, if provided"""
+        if profile is None:
+            profile = PhaseProfile()
+        num_nodes = topology['postordered_nodes'].size
+        with profile.phase('shared_memory_setup'):
+            if num_ancestral_nodes > self.ancestral_node_capacity or num_nodes > self.node_snp_counts.shape[1]:
+                self.start_workers(max(num_ancestral_nodes,self.ancestral_node_capacity), num_nodes = num_nodes)
+            self.out_aln.fill(0x55)
+        with profile.phase('dispatch'):
+            reconstruction_tasks = self.prepare_tasks(topology, node_fingerprints)
+        with profile.phase('kernel'):
+            if self.pool is None:
+                task_results = [run_reconstruction_task(task, idle_states = self.idle_states) for task in reconstruction_tasks]
+            elif self.backend == "thread":
+                task_results = list(self.pool.imap_unordered(partial(run_reconstruction_task, idle_states = self.idle_states),
+                                                                reconstruction_tasks))
+            else:
+                task_results = list(self.pool.imap_unordered(run_reconstruction_task, reconstruction_tasks))
+        with profile.phase('result_reduction'):
+            block_counts = [None for _ in self.pattern_blocks]
+            self.worker_busy_times = {}
+            self.worker_cpu_times = {}
+            for block_index,worker,busy_time,cpu_time,counts in task_results:
+                block_counts[block_index] = counts
+                self.worker_busy_times[worker] = self.worker_busy_times.get(worker, 0.0) + busy_time
+                self.worker_cpu_times[worker] = self.worker_cpu_times.get(worker, 0.0) + cpu_time
+            node_snps = self.node_snp_counts[:,:num_nodes].sum(axis = 0)
+            cache_counts = [counts[0] for counts in block_counts]
+            self.pattern_class_counts = numpy.sum([counts[1] for counts in block_counts], axis = 0)
+        profile.add_worker_time('kernel', sum(self.worker_cpu_times.values()))
+        return self.out_aln[:,:packed_width(num_ancestral_nodes)], node_snps, cache_counts
+
+    def prepare_tasks(self, topology, node_fingerprints = None):
+        """Returns the reconstruction task for each block of patterns, in the order in which they are started"""
+        block_stores = [None for _ in self.pattern_blocks]
+        self.reused_nodes = None
+        topology = dict(topology, num_samples = self.num_samples)
+        if self.incremental and node_fingerprints is not None:
+            # Stored results are only valid if the same monomorphic patterns are resolved analytically
+            monomorphic_bases = find_monomorphic_bases(topology['postordered_nodes'],
+                                                        topology['seed_node'],
+                                                        topology['node_pij'],
+                                                        topology['base_frequencies'])
+            if monomorphic_bases != self.monomorphic_bases:
+                self.slot_fingerprints = {}
+                self.monomorphic_bases = monomorphic_bases
+            node_slots, node_reused = self.assign_node_slots(node_fingerprints)
+            if node_slots is not None:
+                topology = dict(topology, node_slots = node_slots, node_reused = node_reused)
+                block_stores = self.block_stores
+                self.reused_nodes = int(numpy.count_nonzero(node_reused))
+        # The most costly blocks are started first, and idle workers take the next remaining block
+        return [(block_index, block_start, block_end, topology, block_store)
+                    for block_index,((block_start,block_end),block_store)
+                        in sorted(enumerate(zip(self.pattern_blocks,block_stores)),
+                                    key = lambda block: -self.block_costs[block[0]])]
+
+    def close(self):
+        """Stops the workers and frees the shared memory and memory-mapped files"""
+        self.stop_workers()
+        if self.smm is not None:
+            self.smm.shutdown()
+            self.smm = None
+        for filename in self.mapped_files:
+            os.remove(filename)
+        self.mapped_files = []
+
 ########################################################
 # Function for reconstructing individual base patterns #
 ########################################################
 
 def reconstruct_alignment_column(column_index,
                                 base_pattern_positions,
-                                tree = None,
                                 preordered_nodes = None,
                                 postordered_nodes = None,
                                 leaf_nodes = None,
@@ -588,23 +2164,18 @@ def reconstruct_alignment_column(column_index,
                                 node_index_to_aln_row = None,
                                 ancestral_node_order = None,
                                 base_patterns = None,
+                                num_samples = None,
                                 base_frequencies = None,
                                 new_aln = None,
                                 threads = 1,
                                 verbose = False):
-    
-    ### TIMING
-    if verbose:
-        prep_time = 0.0
-        calc_time = 0.0
-        prep_time_start = time.process_time()
 
     # Load shared memory output alignment
     out_aln_shm = shared_memory.SharedMemory(name = new_aln.name)
-    out_aln = numpy.ndarray(new_aln.shape, dtype = numpy.int8, buffer = out_aln_shm.buf)
+    out_aln = numpy.ndarray(new_aln.shape, dtype = numpy.uint8, buffer = out_aln_shm.buf)
     
     # Generate data structures for reconstructions
-    num_nodes = len(tree.nodes())
+    num_nodes = postordered_nodes.size
     Lmat = numpy.full((num_nodes,4), numpy.NINF, dtype = numpy.float32)
     Cmat = numpy.full((num_nodes,4), [0,1,2,3], dtype = numpy.uint8)
     reconstructed_base_indices = numpy.full(num_nodes, 8, dtype = numpy.uint8)
@@ -620,13 +2191,7 @@ def reconstruct_alignment_column(column_index,
     # Load base pattern position information
     
     # Extract information for iterations
-    column = base_patterns[column_index]
-
-    ### TIMING
-    if verbose:
-        prep_time_end = time.process_time()
-        prep_time = prep_time_end - prep_time_start
-        calc_time_start = time.process_time()
+    column = unpack_bases(base_patterns[column_index], num_samples)
 
     # Iterate over columns
     iterate_over_base_patterns(column,
@@ -670,22 +2235,52 @@ def jar(sequence_names = None,
         threads = 1,
         verbose = False,
         mp_method = "spawn",
-        max_pos = None):
-
-    if verbose:
-        prep_time = 0.0
-        calc_time = 0.0
-        prep_time_start = time.process_time()
+        max_pos = None,
+        dispatch = "chunked",
+        subtree_cache_size = 2**18,
+        engine = None,
+        output_format = "fasta",
+        backend = "process",
+        reconstruction = "joint",
+        memory_budget = None,
+        temp_dir = None,
+        tree_arrays = None,
+        profile = False):
+
+    # Check the requested output format
+    if output_format not in ["fasta","binary","both"]:
+        sys.stderr.write("Unrecognised reconstruction output format " + str(output_format) + "\n")
+        sys.exit(1)
+
+    # Check the requested reconstruction; marginal reconstruction is only implemented for blocks of patterns
+    if reconstruction not in ["joint","marginal"]:
+        sys.stderr.write("Unrecognised ancestral reconstruction " + str(reconstruction) + "\n")
+        sys.exit(1)
+    if reconstruction == "marginal":
+        dispatch = "chunked"
+
+    # Reconstruction within a memory budget uses the memory-mapped output of the engine
+    if engine is not None:
+        memory_budget = engine.memory_budget
+    if memory_budget is not None:
+        dispatch = "chunked"
+
+    # Record the wall-clock and CPU time of each phase, including that of the workers
+    phase_profile = PhaseProfile()
     # Create a new alignment for the output containing all taxa in the input alignment
     alignment_sequence_names = {}
     for i, name in enumerate(sequence_names):
         alignment_sequence_names[name] = i
     
-    # Read the tree
-    if verbose:
-        print("Reading tree file:", tree_filename)
-    tree=read_tree(tree_filename)
+    # Read the tree, unless it has already been converted to arrays
+    if tree_arrays is None:
+        if verbose:
+            print("Reading tree file:", tree_filename)
+        with phase_profile.phase('tree_loading'):
+            tree_arrays = TreeArrays.from_newick(tree_filename)
     
+    phase_profile.start('pij_computation')
+
     # Read the info file and get frequencies and rates
     if info_filename != "":
         if verbose:
@@ -705,224 +2300,276 @@ def jar(sequence_names = None,
     rm = create_rate_matrix(f,r)
 
     # Label internal nodes in tree and add these to the new alignment and calculate pij per non-root branch
-    nodecounter=0
-    num_nodes = len(tree.nodes())
-    node_indices = {}
-    child_nodes_array = numpy.empty(num_nodes, dtype=object)
-    leaf_node_list = []
-    node_labels = numpy.empty(num_nodes, dtype=object)
+    num_nodes = tree_arrays.num_nodes
+    postordered_nodes = tree_arrays.postordered_nodes
+    preordered_nodes = tree_arrays.preordered_nodes
+    parent_nodes = tree_arrays.parent_nodes
+    child_nodes = tree_arrays.child_nodes
+    leaf_nodes = tree_arrays.leaf_nodes
+    seed_node = tree_arrays.seed_node
+    node_labels = list(tree_arrays.taxon_labels)
     node_pij = numpy.full((num_nodes,16), numpy.NINF, dtype=numpy.float32)
-    postordered_nodes = numpy.arange(num_nodes, dtype=numpy.int32)
-    seed_node = None
-    seed_node_edge_truncation = True
     node_index_to_aln_row = numpy.full(num_nodes, -1, dtype=numpy.int32)
     ancestral_node_indices = {}
 
-    for node_index,node in zip(postordered_nodes,tree.postorder_node_iter()):
-        if node.taxon == None:
-            nodecounter+=1
-            nodename="Node_"+str(nodecounter)
-            tree.taxon_namespace.add_taxon(dendropy.Taxon(nodename))
-            node.taxon=tree.taxon_namespace.get_taxon(nodename)
+    for node_index,node_label in enumerate(tree_arrays.taxon_labels):
+        if node_label == '':
+            nodename="Node_"+str(len(ancestral_node_indices) + 1)
             if nodename in alignment_sequence_names:
                 print(nodename, "already in alignment. Quitting")
                 sys.exit(209)
             ancestral_node_indices[node_index] = nodename
+            node_labels[node_index] = nodename
+        elif node_label in alignment_sequence_names:
+            node_index_to_aln_row[node_index] = alignment_sequence_names[node_label]
         else:
-            node.taxon.label = node.taxon.label.strip("'")
-            if node.taxon.label in alignment_sequence_names:
-                node_index_to_aln_row[node_index] = alignment_sequence_names[node.taxon.label]
-            else:
-                sys.stderr.write('Unable to find ' + node.taxon.label + ' in alignment')
-                sys.exit(1)
-        if node.parent_node == None:
-            seed_node = node_index
-        elif node.parent_node == tree.seed_node and seed_node_edge_truncation:
-            # Set the length of one root-to-child branch to ~zero
-            # as reconstruction should occur with rooting at a node
-            # midpoint rooting causes problems at the root, especially w/JC69
-            # With outgroup:
-            # Prefer to truncate the ingroup branch to force the recombinations
-            # onto the outgroup branch
-            if outgroup_name is None or \
-                            (outgroup_name is not None and node.taxon.label != outgroup_name):
-                seed_node_edge_truncation = False
-                node_pij[node_index,:]=calculate_pij(node.edge_length/1e6, rm)
-            else:
-                node_pij[node_index,:]=calculate_pij(node.edge_length, rm)
-        else:
-            node_pij[node_index,:]=calculate_pij(node.edge_length, rm)
-        # Store information to avoid subsequent recalculation as
-        # look up of taxon labels with dendropy is slower than native data structures
-        node_label = node.taxon.label
-        node_indices[node_label] = node_index
-        node_labels[node_index] = node_label
-        if node.is_leaf():
-            leaf_node_list.append(node_index)
-            child_nodes_array[node_index] = numpy.full(1, -1, dtype=numpy.int32) # Cannot leave array empty
-        else:
-            child_nodes_array[node_index] = numpy.array([node_indices[child.taxon.label] for child in node.child_node_iter()],
-                                                    dtype=numpy.int32)
-    leaf_nodes = numpy.array(leaf_node_list, dtype = numpy.int32)
-    child_nodes = convert_to_square_numpy_array(child_nodes_array)
-
-    # Store the preordered nodes and record parent node information
-    parent_nodes = numpy.full(num_nodes, -1, dtype = numpy.int32)
-    preordered_nodes = numpy.full(num_nodes-1, -1, dtype=numpy.int32)
-    for node_count,node in enumerate(tree.preorder_node_iter()):
-        if node.parent_node != None:
-            node_index = node_indices[node.taxon.label]
-            preordered_nodes[node_count-1] = node_index # Do not add root node to preordered nodes
-            parent_nodes[node_index] = node_indices[node.parent_node.taxon.label]
+            sys.stderr.write('Unable to find ' + node_label + ' in alignment')
+            sys.exit(1)
+
+    # Set the length of one root-to-child branch to ~zero
+    # as reconstruction should occur with rooting at a node
+    # midpoint rooting causes problems at the root, especially w/JC69
+    # With outgroup:
+    # Prefer to truncate the ingroup branch to force the recombinations
+    # onto the outgroup branch
+    node_branch_lengths = tree_arrays.edge_lengths.copy()
+    node_branch_lengths[seed_node] = numpy.nan
+    for node_index in numpy.flatnonzero(parent_nodes == seed_node).tolist():
+        if outgroup_name is None or node_labels[node_index] != outgroup_name:
+            node_branch_lengths[node_index] = node_branch_lengths[node_index]/1e6
+            break
+
+    # Calculate pij for all non-root branches together, reusing matrices from previous trees
+    branch_nodes = numpy.flatnonzero(~numpy.isnan(node_branch_lengths))
+    pij_lookups = transition_probability_cache.lookups
+    pij_hits = transition_probability_cache.hits
+    node_pij[branch_nodes,:] = transition_probability_cache.log_pij(rm, node_branch_lengths[branch_nodes])
+    if verbose:
+        print("Transition probabilities: " + str(transition_probability_cache.hits - pij_hits) + " of " + \
+                str(transition_probability_cache.lookups - pij_lookups) + " branch lengths reused from previous trees")
 
-        
-    ## Switch this to a numpy.int8 data type use the default as 5 the corresponding value to N
-    ## form the seq_to_int transformation o the sequence 
-    new_aln_array = numpy.full((max_pos,len(ancestral_node_indices)), 5, dtype = numpy.int8)
-    
     # Index names for reconstruction
     ancestral_node_order = numpy.fromiter(ancestral_node_indices.keys(), dtype=numpy.int32)
 
-    # Compile functions prior to multiprocessing
-    for func in [find_most_likely_base_given_descendents,
-                process_leaf,
-                calculate_root_likelihood,
-                count_node_snps,
-                reconstruct_alleles,
-                fill_out_aln,
-                iterate_over_base_patterns,
-                int_to_seq]:
-        try:
-            func()
-        except:
-            pass
+    phase_profile.stop('pij_computation')
 
     # Reconstruct each base position
     if verbose:
         print("Reconstructing sites on tree")
+        dispatch_time_start = time.perf_counter()
+    npatterns = len(base_patterns)
+
+    if dispatch == "chunked":
+
+        # Reconstruct contiguous blocks of patterns, with one block per thread, using workers
+        # that persist across trees if an engine is provided
+        own_engine = engine is None
+        if own_engine:
+            with phase_profile.phase('shared_memory_setup'):
+                engine = ReconstructionEngine(base_patterns = base_patterns,
+                                                num_samples = len(sequence_names),
+                                                base_pattern_positions = base_pattern_positions,
+                                                max_pos = max_pos,
+                                                threads = threads,
+                                                mp_method = mp_method,
+                                                backend = backend,
+                                                memory_budget = memory_budget,
+                                                temp_dir = temp_dir)
+        node_fingerprints = None
+        if engine.incremental and reconstruction == "joint":
+            with phase_profile.phase('dispatch'):
+                node_fingerprints = calculate_node_fingerprints(postordered_nodes,
+                                                                child_nodes,
+                                                                node_pij,
+                                                                node_index_to_aln_row,
+                                                                seed_node,
+                                                                f)
+        out_aln, node_snps, block_cache_counts = engine.reconstruct({
+                                                        'postordered_nodes': postordered_nodes,
+                                                        'preordered_nodes': preordered_nodes,
+                                                        'parent_nodes': parent_nodes,
+                                                        'child_nodes': child_nodes,
+                                                        'seed_node': seed_node,
+                                                        'leaf_nodes': leaf_nodes,
+                                                        'ancestral_node_order': ancestral_node_order,
+                                                        'node_pij': node_pij,
+                                                        'base_frequencies': f,
+                                                        'node_index_to_aln_row': node_index_to_aln_row,
+                                                        'subtree_cache_size': subtree_cache_size,
+                                                        'reconstruction': reconstruction,
+                                                        'node_probabilities': numpy.exp(node_pij.astype(numpy.float64)) \
+                                                                                if reconstruction == "marginal" else None
+                                                    },
+                                                    ancestral_node_order.size,
+                                                    node_fingerprints = node_fingerprints,
+                                                    profile = phase_profile)
+
+        # Report the patterns resolved analytically and the reuse of subtree calculations
+        if verbose and reconstruction == "joint":
+            monomorphic_count,singleton_count,full_count = engine.pattern_class_counts
+            print("Pattern classes: " + str(monomorphic_count) + " monomorphic and " + str(singleton_count) + \
+                    " singleton patterns resolved analytically; " + str(full_count) + \
+                    " reconstructed by dynamic programming")
+            lookups,hits,flushes = numpy.sum(block_cache_counts, axis = 0)
+            print("Subtree cache: " + str(hits) + " of " + str(lookups) + " single-base subtree calculations reused (" + \
+                    "{:.1f}".format(100*hits/max(lookups,1)) + "% hit rate; " + str(flushes) + " cache flushes)")
+            if engine.reused_nodes is not None:
+                print("Incremental reconstruction: " + str(engine.reused_nodes) + " of " + str(num_nodes) + \
+                        " nodes unchanged since the previous tree (" + \
+                        "{:.1f}".format(100*engine.reused_nodes/num_nodes) + "% of node calculations skipped)")
+
+        # Report the balance of work across the workers, including any that were not assigned a block
+        if verbose and len(engine.pattern_blocks) > 0:
+            busy_times = list(engine.worker_busy_times.values())
+            busy_times.extend([0.0]*max(engine.threads - len(busy_times),0))
+            mean_busy_time = sum(busy_times)/len(busy_times)
+            print("Worker busy time: " + ", ".join("{:.3f}".format(busy_time) for busy_time in sorted(busy_times, reverse = True)) + \
+                    " seconds for " + str(len(engine.pattern_blocks)) + " blocks of patterns (" + \
+                    "{:.1f}".format(100*(max(busy_times)/max(mean_busy_time,1e-9) - 1)) + "% load imbalance)")
 
-    with SharedMemoryManager() as smm:
-    
-        # Convert alignment to shared memory numpy array
-        new_aln_shared_array = generate_shared_mem_array(new_aln_array, smm)
-        
-        # Convert base patterns to shared memory numpy array
-        base_patterns_shared_array = generate_shared_mem_array(base_patterns, smm)
-        
-        # Convert base pattern positions to shared memory numpy array
-        bp_list = list(range(len(base_patterns)))
-        npatterns = len(base_patterns)
+    else:
 
-        if verbose:
-            prep_time_end = time.process_time()
-            prep_time = prep_time_end - prep_time_start
-            calc_time_start = time.process_time()
-
-
-        if threads > 1:
-
-            # Parallelise reconstructions across alignment columns using multiprocessing
-            with multiprocessing.get_context(method=mp_method).Pool(processes = threads) as pool:
-                reconstruction_results = pool.starmap(partial(
-                                            reconstruct_alignment_column,
-                                                tree = tree,
-                                                preordered_nodes = preordered_nodes,
-                                                postordered_nodes = postordered_nodes,
-                                                leaf_nodes = leaf_nodes,
-                                                parent_nodes = parent_nodes,
-                                                child_nodes = child_nodes,
-                                                seed_node = seed_node,
-                                                node_pij = node_pij,
-                                                node_index_to_aln_row = node_index_to_aln_row,
-                                                ancestral_node_order = ancestral_node_order,
-                                                base_patterns = base_patterns_shared_array,
-                                                base_frequencies = f,
-                                                new_aln = new_aln_shared_array,
-                                                threads = threads,
-                                                verbose = verbose),
-                                            zip(bp_list, base_pattern_positions)
-                                        )
+        ## Pack the bases of the ancestral nodes two per byte, using the default as 5 the corresponding
+        ## value to N from the seq_to_int transformation of the sequence
+        phase_profile.start('shared_memory_setup')
+        new_aln_array = numpy.full((max_pos,packed_width(len(ancestral_node_indices))), 0x55, dtype = numpy.uint8)
+
+        with SharedMemoryManager() as smm:
+        
+            # Convert alignment to shared memory numpy array
+            new_aln_shared_array = generate_shared_mem_array(new_aln_array, smm)
+            
+            # Convert base patterns to shared memory numpy array
+            base_patterns_shared_array = generate_shared_mem_array(base_patterns, smm)
             
-            # Write out alignment while shared memory manager still active
-            out_aln_shm = shared_memory.SharedMemory(name = new_aln_shared_array.name)
-            out_aln = numpy.ndarray(new_aln_array.shape, dtype = 'i1', buffer = out_aln_shm.buf)
+            # Convert base pattern positions to shared memory numpy array
+            bp_list = list(range(len(base_patterns)))
+            phase_profile.stop('shared_memory_setup')
+            phase_profile.start('kernel')
+
+            if threads > 1:
+
+                # Parallelise reconstructions across alignment columns using multiprocessing
+                with multiprocessing.get_context(method=mp_method).Pool(processes = threads) as pool:
+                    reconstruction_results = pool.starmap(partial(
+                                                reconstruct_alignment_column,
+                                                    preordered_nodes = preordered_nodes,
+                                                    postordered_nodes = postordered_nodes,
+                                                    leaf_nodes = leaf_nodes,
+                                                    parent_nodes = parent_nodes,
+                                                    child_nodes = child_nodes,
+                                                    seed_node = seed_node,
+                                                    node_pij = node_pij,
+                                                    node_index_to_aln_row = node_index_to_aln_row,
+                                                    ancestral_node_order = ancestral_node_order,
+                                                    base_patterns = base_patterns_shared_array,
+                                                    num_samples = len(sequence_names),
+                                                    base_frequencies = f,
+                                                    new_aln = new_aln_shared_array,
+                                                    threads = threads,
+                                                    verbose = verbose),
+                                                zip(bp_list, base_pattern_positions)
+                                            )
+                # The workers exit with the pool, so their CPU time is recorded as that of child processes
+                phase_profile.stop('kernel')
+                with phase_profile.phase('result_reduction'):
+                    node_snps = numpy.sum(reconstruction_results, axis = 0, dtype = numpy.int64)
+            
+                # Write out alignment while shared memory manager still active
+                out_aln_shm = shared_memory.SharedMemory(name = new_aln_shared_array.name)
+                out_aln = numpy.ndarray(new_aln_array.shape, dtype = numpy.uint8, buffer = out_aln_shm.buf)
                      
-            # Release pool nodes
-            pool.join()
+                # Release pool nodes
+                pool.join()
         
-        else:
+            else:
         
-            # Run as a loop on a single core
-            reconstruction_results = \
-                [
-                            reconstruct_alignment_column(
-                                b,
-                                p,
-                                tree = tree,
-                                preordered_nodes = preordered_nodes,
-                                postordered_nodes = postordered_nodes,
-                                leaf_nodes = leaf_nodes,
-                                parent_nodes = parent_nodes,
-                                child_nodes = child_nodes,
-                                seed_node = seed_node,
-                                node_pij = node_pij,
-                                node_index_to_aln_row = node_index_to_aln_row,
-                                ancestral_node_order = ancestral_node_order,
-                                base_patterns = base_patterns_shared_array,
-                                base_frequencies = f,
-                                new_aln = new_aln_shared_array,
-                                threads = threads,
-                                verbose = verbose) for b,p in zip(bp_list, base_pattern_positions)
-                ]
+                # Run as a loop on a single core
+                node_snps = numpy.zeros(num_nodes, dtype = numpy.int64)
+                for b,p in zip(bp_list, base_pattern_positions):
+                    node_snps += reconstruct_alignment_column(
+                                    b,
+                                    p,
+                                    preordered_nodes = preordered_nodes,
+                                    postordered_nodes = postordered_nodes,
+                                    leaf_nodes = leaf_nodes,
+                                    parent_nodes = parent_nodes,
+                                    child_nodes = child_nodes,
+                                    seed_node = seed_node,
+                                    node_pij = node_pij,
+                                    node_index_to_aln_row = node_index_to_aln_row,
+                                    ancestral_node_order = ancestral_node_order,
+                                    base_patterns = base_patterns_shared_array,
+                                    num_samples = len(sequence_names),
+                                    base_frequencies = f,
+                                    new_aln = new_aln_shared_array,
+                                    threads = threads,
+                                    verbose = verbose)
+                phase_profile.stop('kernel')
             
-            # Extract final result
-            out_aln_shm = shared_memory.SharedMemory(name = new_aln_shared_array.name)
-            out_aln = numpy.ndarray(new_aln_array.shape, dtype = 'i1', buffer = out_aln_shm.buf)
-
-    # Process outputs
-    aln_line = numpy.full(len(out_aln[:,0]),"?",dtype="U1")
-    if verbose:
-        print("Printing alignment with internal node sequences: ", output_prefix+".joint.aln")
-    source = alignment_filename
-    destination = output_prefix+".joint.aln"
-    dest = shutil.copy(source, destination)
-    with open(dest, "a") as asr_output:
-        for i,node_index in enumerate(ancestral_node_order):
-            taxon = ancestral_node_indices[node_index]
-            asr_output.write('>' + taxon + '\n')
-            int_to_seq(out_aln[:,i], aln_line)
-            asr_output.write(''.join(aln_line) + "\n")
-
-    # Combine results for each base across the alignment
-    for node in tree.preorder_node_iter():
-        node.edge_length = 0.0 # reset lengths to convert to SNPs
-        node_index = node_indices[node.taxon.label]
-        for x in range(len(reconstruction_results)):
-            try:
-                node.edge_length += reconstruction_results[x][node_index];
-            except AttributeError:
-                continue
+                # Extract final result
+                out_aln_shm = shared_memory.SharedMemory(name = new_aln_shared_array.name)
+                out_aln = numpy.ndarray(new_aln_array.shape, dtype = numpy.uint8, buffer = out_aln_shm.buf)
 
-    ### TIMING
+    # Report reconstruction throughput
     if verbose:
-        calc_time_end = time.process_time()
-        calc_time = (calc_time_end - calc_time_start)
+        dispatch_time = time.perf_counter() - dispatch_time_start
+        print("Reconstructed " + str(npatterns) + " base patterns in " + "{:.2f}".format(dispatch_time) + " seconds (" + \
+                "{:.1f}".format(npatterns/max(dispatch_time,1e-9)) + " patterns per second; " + dispatch + " dispatch)")
+        if dispatch == "chunked" and engine.out_of_core:
+            print("Ancestral sequences memory-mapped from " + engine.out_aln_file + " to remain within the memory budget of " + \
+                    "{:.1f}".format(engine.memory_budget/2**20) + " MB")
 
-    # Print tree
-    from gubbins.common import tree_as_string
-    
+    # Process outputs
+    ancestral_node_names = [ancestral_node_indices[node_index] for node_index in ancestral_node_order]
+    node_chunk_size = choose_node_chunk_size(max_pos, memory_budget = memory_budget)
+    phase_profile.start('alignment_writing')
+    if output_format in ["fasta","both"]:
+        if verbose:
+            print("Printing alignment with internal node sequences: ", output_prefix + "." + reconstruction + ".aln")
+        write_reconstruction_fasta(out_aln, ancestral_node_names, alignment_filename, output_prefix + "." + reconstruction + ".aln",
+                                    chunk_size = node_chunk_size)
+    if output_format in ["binary","both"]:
+        if verbose:
+            print("Writing binary matrix of internal node sequences: ", output_prefix + "." + reconstruction + ".recon")
+        write_reconstruction_binary(out_aln, ancestral_node_names, output_prefix + "." + reconstruction + ".recon",
+                                    chunk_size = node_chunk_size)
+    phase_profile.stop('alignment_writing')
+
+    # Stop any workers started for this tree
+    if dispatch == "chunked" and own_engine:
+        out_aln = None
+        with phase_profile.phase('worker_shutdown'):
+            engine.close()
+
+    # Print tree, with the substitutions on each branch as the branch lengths
     if verbose:
-        print("Printing tree with internal nodes labelled: ", output_prefix+".joint.tre")
-    with open(output_prefix+".joint.tre", "w") as tree_output:
-    
-        recon_tree = tree_as_string(tree,
-                                    suppress_rooting=True,
-                                    suppress_internal=False)
-        print(recon_tree.replace('\'', ''),
-              file = tree_output)
+        print("Printing tree with internal nodes labelled: ", output_prefix + "." + reconstruction + ".tre")
+    with phase_profile.phase('tree_writing'):
+        with open(output_prefix + "." + reconstruction + ".tre", "w") as tree_output:
+        
+            recon_tree = tree_arrays.as_string(taxon_labels = node_labels,
+                                                edge_lengths = node_snps.astype(numpy.float64))
+            print(recon_tree,
+                  file = tree_output)
+
+    # Record the timings of each phase alongside the reconstruction
+    if profile:
+        phase_profile.write_json(output_prefix + "." + reconstruction + ".profile.json",
+                                    reconstruction = reconstruction,
+                                    dispatch = dispatch,
+                                    backend = backend if engine is None else engine.backend,
+                                    threads = threads,
+                                    patterns = npatterns,
+                                    nodes = num_nodes,
+                                    peak_memory = peak_memory_usage()[0])
 
     if verbose:
         print("Done")
-        print('Time for JAR preparation:\t' + str(prep_time))
-        print('Time for JAR calculation:\t' + str(calc_time))
+        for phase_name,phase in phase_profile.phases.items():
+            print("Time for " + phase_name.replace('_',' ') + ":\t" + "{:.3f}".format(phase['wall_time']) + " seconds (CPU: " + \
+                    "{:.3f}".format(phase['cpu_time']) + " seconds in this process, " + \
+                    "{:.3f}".format(phase['child_cpu_time']) + " seconds in exited child processes, " + \
+                    "{:.3f}".format(phase['worker_cpu_time']) + " seconds in reconstruction tasks)")
+        print('Peak memory usage:\t' + "{:.1f}".format(peak_memory_usage()[0]/2**20) + ' MB')
 
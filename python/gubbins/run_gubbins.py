@@ -43,8 +43,27 @@ def parse_input_args():
                                                       version = version())
     ioGroup.add_argument('--threads',           '-c', help='Number of threads to use for parallelisation',
                                                       type=int,  default=1)
+    ioGroup.add_argument('--tree-threads',            help='Number of threads used by the tree building, model fitting and'
+                                                      ' time calibration algorithms [if unspecified: chosen from the'
+                                                      ' number of unique base patterns, up to --threads]',
+                                                      type=int,  default=None)
+    ioGroup.add_argument('--recon-threads',           help='Number of threads used for ancestral sequence reconstruction'
+                                                      ' [if unspecified: chosen from the numbers of sequences and unique'
+                                                      ' base patterns, up to --threads]',
+                                                      type=int,  default=None)
+    ioGroup.add_argument('--detect-threads',          help='Number of threads used for recombination detection [if'
+                                                      ' unspecified: chosen from the number of sequences, up to --threads]',
+                                                      type=int,  default=None)
     ioGroup.add_argument('--verbose',           '-v', help='Turn on debugging', action='store_true')
     ioGroup.add_argument('--no-cleanup',        '-n', help='Do not cleanup intermediate files', action='store_true')
+    ioGroup.add_argument('--cache-dir',               help='Directory in which trees, model fits and ancestral'
+                                                      ' reconstructions are cached, and reused by later runs with the'
+                                                      ' same data, options and --seed',
+                                                      default=None)
+    ioGroup.add_argument('--cache-size',              help='Maximum size (GB) of the cache directory, from which the least'
+                                                      ' recently used results are removed',
+                                                      type=float,
+                                                      default=10.0)
 
     dataGroup = parser.add_argument_group('Data processing options')
     dataGroup.add_argument('--pairwise',              help='Compare two sequences (without using a tree)',
@@ -113,12 +132,23 @@ def parse_input_args():
                                                       default=False, action='store_true')
     reconGroup.add_argument('--model-fitter-args',    help='Further arguments passed to model fitting algorithm',
                                                       default=None)
+    reconGroup.add_argument('--incremental-recon',    help='Reuse the joint ancestral reconstruction of subtrees unchanged'
+                                                      ' since the previous iteration (requires additional memory)',
+                                                      default=False, action='store_true')
+    reconGroup.add_argument('--recon-backend',        help='Parallelise joint ancestral reconstruction using separate processes,'
+                                                      ' or using threads within a single process (experimental)',
+                                                      default='process',
+                                                      choices=['thread','process'])
+    reconGroup.add_argument('--recon-memory',         help='Memory budget (GB) for pyjar ancestral reconstruction; larger'
+                                                      ' reconstructions are memory-mapped from the temporary directory',
+                                                      type=float,
+                                                      default=None)
     reconGroup.add_argument('--mar',                  help='Use marginal, rather than joint, ancestral reconstruction',
                                                       action='store_true')
     reconGroup.add_argument('--seq-recon',            help='Algorithm to use for marginal reconstruction [if unspecified: '
-                                                      'same as tree builder if possible, else iqtree; requires --mar flag]',
+                                                      'pyjar; requires --mar flag]',
                                                       default=None,
-                                                      choices=['raxml', 'raxmlng', 'iqtree', None])
+                                                      choices=['pyjar', 'raxml', 'raxmlng', 'iqtree', None])
     reconGroup.add_argument('--seq-recon-args',       help='Further arguments passed to sequence reconstruction algorithm'
                                                       ' (start string with a space if there is a risk of being interpreted as a flag)',
                                                       default=None)
@@ -156,7 +186,9 @@ def parse_input_args():
                                                                      'recombination'])
     stopGroup.add_argument('--resume',
                                                         help='Intermediate tree from previous run (must include'
-                                                        ' "iteration_X" in file name)',
+                                                        ' "iteration_X" in file name), or checkpoint file from a'
+                                                        ' previous run (ending ".checkpoint.json") to skip the'
+                                                        ' stages it completed',
                                                         default=None)
     return parser
 
@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+# encoding: utf-8
+#
+# Wellcome Trust Sanger Institute
+# Copyright (C) 2013  Wellcome Trust Sanger Institute
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+#
+
+import os
+import sys
+import csv
+import json
+import shlex
+import signal
+import subprocess
+import threading
+import time
+
+# Linux reports the maximum resident set size in kilobytes, macOS in bytes
+max_rss_scale = 1 if sys.platform == 'darwin' else 1024
+# Columns of the resource table
+resource_fields = ['stage', 'executable', 'working_directory', 'start_time', 'wall_time', 'user_time', 'sys_time',
+                    'max_rss', 'exit_status']
+
+class Command:
+    """An external command: the arguments passed to the executable, the file to which its output and errors
+    are written (by default, those of this process), its working directory and any environment variables set
+    in addition to those of this process"""
+
+    def __init__(self, arguments, output_filename = None, working_directory = None, environment = None):
+        """Constructor"""
+        self.arguments = [str(argument) for argument in arguments]
+        self.output_filename = output_filename
+        self.working_directory = working_directory
+        self.environment = {} if environment is None else environment
+
+    def __str__(self):
+        """Describes the command as it would be typed into a shell, for messages and the comparison of commands"""
+        description = " ".join(shlex.quote(argument) for argument in self.arguments)
+        if self.output_filename is not None:
+            description += " > " + self.output_filename + " 2>&1"
+        return description
+
+def exit_status(wait_status):
+    """Converts the status returned by os.wait4 to a return code, which is negative if the process was
+    killed by a signal"""
+    if os.WIFSIGNALED(wait_status):
+        return -os.WTERMSIG(wait_status)
+    return os.WEXITSTATUS(wait_status)
+
+class CommandRunner:
+    """Runs external commands without a shell, recording the wall-clock time, CPU time and peak memory of
+    each child process under the name of the stage that ran it"""
+
+    def __init__(self):
+        """Starts an empty record; commands may be run concurrently from different threads"""
+        self.start_time = time.time()
+        self.records = []
+        self.lock = threading.Lock()
+
+    def check_call(self, stage, command, working_directory = None):
+        """Runs a command in the working directory (by default that of the command, or else the current
+        directory), raising subprocess.CalledProcessError if it fails"""
+        record = self.run(stage, command, working_directory = working_directory)
+        if record['exit_status'] != 0:
+            raise subprocess.CalledProcessError(record['exit_status'], command.arguments)
+
+    def run(self, stage, command, working_directory = None):
+        """Runs a command, returning the record of the resources it used"""
+        if working_directory is None:
+            working_directory = command.working_directory
+        output_filename = command.output_filename
+        if output_filename is not None and working_directory is not None:
+            output_filename = os.path.join(working_directory, output_filename)
+        environment = None
+        if len(command.environment) > 0:
+            environment = dict(os.environ, **command.environment)
+        record = {'stage': stage,
+                    'executable': os.path.basename(command.arguments[0]),
+                    'working_directory': os.path.abspath(os.getcwd() if working_directory is None else working_directory),
+                    'start_time': round(time.time() - self.start_time, 3)}
+        output_file = None if output_filename is None else open(output_filename, 'w')
+        wall_start = time.perf_counter()
+        try:
+            process = subprocess.Popen(command.arguments,
+                                        cwd = working_directory,
+                                        env = environment,
+                                        stdout = output_file,
+                                        stderr = None if output_file is None else subprocess.STDOUT)
+        except OSError as error:
+            # Reported as by a shell if the executable cannot be run
+            sys.stderr.write("Unable to run " + command.arguments[0] + ": " + str(error) + "\n")
+            record.update({'wall_time': 0.0, 'user_time': 0.0, 'sys_time': 0.0, 'max_rss': 0, 'exit_status': 127})
+        else:
+            # Only this process's own child is collected, so commands can be run from several threads
+            _, wait_status, usage = os.wait4(process.pid, 0)
+            process.returncode = exit_status(wait_status)
+            record.update({'wall_time': round(time.perf_counter() - wall_start, 3),
+                            'user_time': round(usage.ru_utime, 3),
+                            'sys_time': round(usage.ru_stime, 3),
+                            'max_rss': usage.ru_maxrss*max_rss_scale,
+                            'exit_status': process.returncode})
+        finally:
+            if output_file is not None:
+                output_file.close()
+        with self.lock:
+            self.records.append(record)
+        return record
+
+    def describe(self, stage):
+        """Describes the outcome of the last command run in a stage, for error messages"""
+        records = [record for record in self.records if record['stage'] == stage]
+        if len(records) == 0:
+            return "no command was run"
+        record = records[-1]
+        if record['exit_status'] < 0:
+            try:
+                outcome = "killed by " + signal.Signals(-record['exit_status']).name
+            except ValueError:
+                outcome = "killed by signal " + str(-record['exit_status'])
+        else:
+            outcome = "exit status " + str(record['exit_status'])
+        return "{} {} after {:.2f} s using {:.2f} GB".format(record['executable'], outcome, record['wall_time'],
+                                                            record['max_rss']/2**30)
+
+    def stage_totals(self):
+        """Get the resources used by each stage: the summed times, and the largest peak memory, of its commands"""
+        totals = {}
+        for record in self.records:
+            if record['stage'] not in totals:
+                totals[record['stage']] = {'commands': 0, 'wall_time': 0.0, 'user_time': 0.0, 'sys_time': 0.0, 'max_rss': 0}
+            stage_total = totals[record['stage']]
+            stage_total['commands'] += 1
+            for key in ['wall_time', 'user_time', 'sys_time']:
+                stage_total[key] = round(stage_total[key] + record[key], 3)
+            stage_total['max_rss'] = max(stage_total['max_rss'], record['max_rss'])
+        return totals
+
+    def write_csv(self, filename):
+        """Writes the resources used by each command, in the order in which they were started"""
+        with open(filename, 'w', newline = '') as table_file:
+            writer = csv.DictWriter(table_file, fieldnames = resource_fields)
+            writer.writeheader()
+            for record in sorted(self.records, key = lambda record: record['start_time']):
+                writer.writerow(record)
+
+    def write_json(self, filename):
+        """Writes the resources used by each stage and by each command"""
+        with open(filename, 'w') as table_file:
+            json.dump({'stages': self.stage_totals(),
+                        'commands': sorted(self.records, key = lambda record: record['start_time'])},
+                        table_file, indent = 2)
+            table_file.write('\n')
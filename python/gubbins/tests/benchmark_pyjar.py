@@ -0,0 +1,131 @@
+#! /usr/bin/env python3
+# encoding: utf-8
+
+"""
+Benchmark of the thread and process backends of pyjar joint ancestral reconstruction
+
+Base patterns are simulated along a random tree, and the same patterns are reconstructed with each backend
+at each thread count, e.g.
+
+    python -m gubbins.tests.benchmark_pyjar --taxa 400 --patterns 200000 --threads 1 8 32
+"""
+
+import sys
+import os
+import time
+import shutil
+import argparse
+import tempfile
+import hashlib
+import statistics
+import numpy
+from gubbins import pyjar
+from gubbins.tree_arrays import TreeArrays
+
+def get_options():
+    parser = argparse.ArgumentParser(description = 'Time pyjar joint ancestral reconstruction with the thread and'
+                                                    ' process backends on the same simulated base patterns',
+                                     prog = 'benchmark_pyjar')
+    parser.add_argument('--taxa',       help = 'Number of sequences', type = int, default = 400)
+    parser.add_argument('--patterns',   help = 'Number of base patterns', type = int, default = 200000)
+    parser.add_argument('--mutation',   help = 'Probability of a base changing on each branch', type = float, default = 0.02)
+    parser.add_argument('--threads',    help = 'Thread counts to benchmark', type = int, nargs = '+', default = [1, 8, 32])
+    parser.add_argument('--backends',   help = 'Backends to benchmark', nargs = '+', default = ['thread', 'process'],
+                                        choices = ['thread', 'process'])
+    parser.add_argument('--repeats',    help = 'Reconstructions timed with each engine', type = int, default = 3)
+    parser.add_argument('--seed',       help = 'Seed of the simulation', type = int, default = 1)
+    return parser.parse_args()
+
+def simulate_tree(num_taxa, random_generator):
+    """Returns a random rooted binary tree, joining randomly chosen pairs of subtrees"""
+    subtrees = ['sequence_' + str(i + 1) + ':' + str(round(random_generator.exponential(0.01), 6)) for i in range(num_taxa)]
+    while len(subtrees) > 1:
+        first, second = sorted(random_generator.choice(len(subtrees), size = 2, replace = False).tolist(), reverse = True)
+        joined = '(' + subtrees.pop(first) + ',' + subtrees.pop(second) + ')'
+        subtrees.append(joined + ':' + str(round(random_generator.exponential(0.01), 6)))
+    return TreeArrays.from_newick_string(subtrees[0].rsplit(':', 1)[0] + ';')
+
+def simulate_base_patterns(tree_arrays, num_patterns, mutation_probability, random_generator):
+    """Evolves each pattern from a random root base, changing the base on each branch with a fixed probability,
+    and returns the leaf bases with one position per pattern"""
+    node_bases = numpy.empty((tree_arrays.num_nodes, num_patterns), dtype = numpy.uint8)
+    node_bases[tree_arrays.seed_node,:] = random_generator.integers(0, 4, size = num_patterns)
+    for node_index in tree_arrays.preordered_nodes.tolist():
+        parent_node = tree_arrays.parent_nodes[node_index]
+        if parent_node == -1:
+            continue
+        changed = random_generator.random(num_patterns) < mutation_probability
+        node_bases[node_index,:] = numpy.where(changed,
+                                                random_generator.integers(0, 4, size = num_patterns),
+                                                node_bases[parent_node,:])
+    leaf_nodes = tree_arrays.leaf_nodes.tolist()
+    sequence_names = [tree_arrays.taxon_labels[node_index] for node_index in leaf_nodes]
+    base_patterns = pyjar.pack_bases(numpy.ascontiguousarray(node_bases[leaf_nodes,:].T))
+    base_pattern_positions = [numpy.array([position], dtype = numpy.int32) for position in range(num_patterns)]
+    return sequence_names, base_patterns, base_pattern_positions
+
+def benchmark_backends(num_taxa = 400, num_patterns = 200000, mutation_probability = 0.02, thread_counts = (1, 8, 32),
+                        backends = ('thread', 'process'), repeats = 3, seed = 1, output_file = sys.stdout):
+    """Times the start of an engine, and the median of repeated reconstructions with it, for each backend and
+    thread count, checking that every configuration reconstructs the same alignment; returns the timings"""
+    random_generator = numpy.random.default_rng(seed)
+    tree_arrays = simulate_tree(num_taxa, random_generator)
+    sequence_names, base_patterns, base_pattern_positions = simulate_base_patterns(tree_arrays, num_patterns,
+                                                                                    mutation_probability, random_generator)
+    output_file.write("Benchmarking pyjar on {} sequences and {} base patterns using {} CPUs\n".format(num_taxa, num_patterns,
+                                                                                                        os.cpu_count()))
+    output_file.write("Backend,Threads,Engine start (s),Median reconstruction (s),Speedup\n")
+    pyjar.check_compiled_kernels()
+    timings = {}
+    alignment_digests = set()
+    output_dir = tempfile.mkdtemp()
+    try:
+        for backend in backends:
+            for threads in thread_counts:
+                engine_start = time.perf_counter()
+                with pyjar.ReconstructionEngine(base_patterns = base_patterns,
+                                                num_samples = len(sequence_names),
+                                                base_pattern_positions = base_pattern_positions,
+                                                max_pos = num_patterns,
+                                                threads = threads,
+                                                backend = backend) as engine:
+                    engine_time = time.perf_counter() - engine_start
+                    reconstruction_times = []
+                    for repeat in range(repeats):
+                        output_prefix = os.path.join(output_dir, backend + str(threads))
+                        reconstruction_start = time.perf_counter()
+                        pyjar.jar(sequence_names = sequence_names,
+                                  base_patterns = base_patterns,
+                                  base_pattern_positions = base_pattern_positions,
+                                  info_filename = "",
+                                  output_prefix = output_prefix,
+                                  threads = threads,
+                                  max_pos = num_patterns,
+                                  engine = engine,
+                                  output_format = 'binary',
+                                  backend = backend,
+                                  tree_arrays = tree_arrays)
+                        reconstruction_times.append(time.perf_counter() - reconstruction_start)
+                with open(output_prefix + '.joint.recon', 'rb') as alignment_file:
+                    alignment_digests.add(hashlib.sha256(alignment_file.read()).hexdigest())
+                timings[(backend,threads)] = (engine_time, statistics.median(reconstruction_times))
+                baseline = timings.get((backend,thread_counts[0]), timings[(backend,threads)])[1]
+                output_file.write("{},{},{:.3f},{:.3f},{:.2f}\n".format(backend, threads, engine_time,
+                                                                        timings[(backend,threads)][1],
+                                                                        baseline/timings[(backend,threads)][1]))
+    finally:
+        shutil.rmtree(output_dir)
+    if len(alignment_digests) != 1:
+        sys.stderr.write("Reconstructed alignments differ between backends or thread counts\n")
+        sys.exit(1)
+    return timings
+
+if __name__ == "__main__":
+    args = get_options()
+    benchmark_backends(num_taxa = args.taxa,
+                        num_patterns = args.patterns,
+                        mutation_probability = args.mutation,
+                        thread_counts = args.threads,
+                        backends = args.backends,
+                        repeats = args.repeats,
+                        seed = args.seed)
@@ -0,0 +1,83 @@
+#! /usr/bin/env python3
+# encoding: utf-8
+
+"""
+Tests for the cache of stage results shared between runs
+"""
+
+import unittest
+import os
+import shutil
+import time
+import tempfile
+from gubbins.cache import ResultCache, normalise_command
+
+class TestCache(unittest.TestCase):
+
+    def setUp(self):
+        self.working_directory = tempfile.mkdtemp()
+        self.cache_directory = os.path.join(self.working_directory, 'cache')
+        self.input_filename = os.path.join(self.working_directory, 'input.aln')
+        self.output_filename = os.path.join(self.working_directory, 'output.tre')
+        self.write_file(self.input_filename, '>A\nACGT\n')
+
+    def tearDown(self):
+        shutil.rmtree(self.working_directory)
+
+    def write_file(self, filename, contents):
+        with open(filename, 'w') as output_file:
+            output_file.write(contents)
+
+    def read_file(self, filename):
+        with open(filename, 'r') as input_file:
+            return input_file.read()
+
+    def test_normalise_command(self):
+        # Longer paths are replaced before those they contain
+        command = normalise_command('FastTree -out /run/tmp123/prefix.iteration_1.tre /run/prefix.aln > /dev/null 2>&1',
+                                    {'/run': '{current_directory}',
+                                     '/run/tmp123': '{working_directory}',
+                                     'prefix': '{basename}',
+                                     ' > /dev/null 2>&1': ''})
+        assert command == 'FastTree -out {working_directory}/{basename}.iteration_1.tre {current_directory}/{basename}.aln'
+
+    def test_store_and_restore(self):
+        result_cache = ResultCache(self.cache_directory, 2**20, substitutions = {self.working_directory: '{working_directory}'})
+        key = result_cache.get_key('tree_building', [self.input_filename], ['FastTree -out ' + self.output_filename])
+        assert not result_cache.restore(key, [self.output_filename])
+        self.write_file(self.output_filename, '(A,B);\n')
+        result_cache.store(key, [self.output_filename])
+        # Keys depend on the contents of the inputs and the parameters without run-specific paths
+        other_cache = ResultCache(self.cache_directory, 2**20, substitutions = {'/elsewhere': '{working_directory}'})
+        assert other_cache.get_key('tree_building', [self.input_filename], ['FastTree -out /elsewhere/output.tre']) == key
+        restored_filename = os.path.join(self.working_directory, 'restored.tre')
+        assert other_cache.restore(key, [restored_filename])
+        assert self.read_file(restored_filename) == '(A,B);\n'
+        self.write_file(self.input_filename, '>A\nACGA\n')
+        assert other_cache.get_key('tree_building', [self.input_filename], ['FastTree -out /elsewhere/output.tre']) != key
+        assert (result_cache.hits, result_cache.misses) == (0, 1)
+        assert (other_cache.hits, other_cache.misses) == (1, 0)
+
+    def test_least_recently_used_eviction(self):
+        result_cache = ResultCache(self.cache_directory, 300)
+        self.write_file(self.output_filename, 'A'*100)
+        for key in ['first', 'second']:
+            result_cache.store(key, [self.output_filename])
+            time.sleep(0.01)
+        # Using the first entry makes the second the least recently used
+        assert result_cache.restore('first', [self.output_filename])
+        time.sleep(0.01)
+        result_cache.store('third', [self.output_filename])
+        assert [key for _,key,_ in result_cache.get_entries()] == ['first', 'third']
+        assert not result_cache.restore('second', [self.output_filename])
+
+    def test_disabled_cache(self):
+        result_cache = ResultCache(None, 2**20)
+        key = result_cache.get_key('tree_building', [self.input_filename], [])
+        assert key is None
+        assert not result_cache.restore(key, [self.output_filename])
+        result_cache.store(key, [self.output_filename])
+        assert (result_cache.hits, result_cache.misses) == (0, 0)
+
+if __name__ == "__main__":
+    unittest.main()
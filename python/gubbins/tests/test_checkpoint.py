@@ -0,0 +1,83 @@
+#! /usr/bin/env python3
+# encoding: utf-8
+
+"""
+Tests for the checkpoint manifest used to resume runs
+"""
+
+import unittest
+import os
+import shutil
+import tempfile
+from gubbins.checkpoint import CheckpointManifest
+
+class TestCheckpoint(unittest.TestCase):
+
+    def setUp(self):
+        self.working_directory = tempfile.mkdtemp()
+        self.manifest_filename = os.path.join(self.working_directory, 'run.checkpoint.json')
+        self.input_filename = os.path.join(self.working_directory, 'input.aln')
+        self.output_filename = os.path.join(self.working_directory, 'output.tre')
+        self.write_file(self.input_filename, '>A\nACGT\n')
+
+    def tearDown(self):
+        shutil.rmtree(self.working_directory)
+
+    def write_file(self, filename, contents):
+        with open(filename, 'w') as output_file:
+            output_file.write(contents)
+
+    def run_stages(self, manifest, tree_contents = '(A,B);\n', parameters = 'tree builder'):
+        """Runs two stages, the second replacing the output of the first, and returns those that were run"""
+        stages_run = []
+        if not manifest.is_complete('tree_building', [self.input_filename], parameters = parameters):
+            self.write_file(self.output_filename, tree_contents)
+            manifest.record('tree_building', [self.output_filename])
+            stages_run.append('tree_building')
+        if not manifest.is_complete('reroot', [self.output_filename]):
+            self.write_file(self.output_filename, '(B,A);\n')
+            manifest.record('reroot', [self.output_filename])
+            stages_run.append('reroot')
+        return stages_run
+
+    def test_resume_skips_completed_stages(self):
+        manifest = CheckpointManifest(self.manifest_filename, working_directory = self.working_directory, seed = 3)
+        assert self.run_stages(manifest) == ['tree_building', 'reroot']
+        # Outputs replaced by later stages do not prevent resuming
+        resumed_manifest = CheckpointManifest(self.manifest_filename, resume = True)
+        assert resumed_manifest.seed == 3
+        assert resumed_manifest.working_directory == self.working_directory
+        assert resumed_manifest.resumable_stages == 2
+        assert self.run_stages(resumed_manifest) == []
+        assert resumed_manifest.get_outputs('reroot') == [self.output_filename]
+
+    def test_changed_input_reruns_stages(self):
+        manifest = CheckpointManifest(self.manifest_filename, working_directory = self.working_directory)
+        self.run_stages(manifest)
+        self.write_file(self.input_filename, '>A\nACGA\n')
+        resumed_manifest = CheckpointManifest(self.manifest_filename, resume = True)
+        assert self.run_stages(resumed_manifest) == ['tree_building', 'reroot']
+
+    def test_changed_parameters_rerun_stages(self):
+        manifest = CheckpointManifest(self.manifest_filename, working_directory = self.working_directory)
+        self.run_stages(manifest)
+        resumed_manifest = CheckpointManifest(self.manifest_filename, resume = True)
+        assert self.run_stages(resumed_manifest, parameters = 'other tree builder') == ['tree_building', 'reroot']
+        assert [stage['parameters'] for stage in resumed_manifest.stages] == ['other tree builder', '']
+
+    def test_modified_output_truncates_manifest(self):
+        manifest = CheckpointManifest(self.manifest_filename, working_directory = self.working_directory)
+        self.run_stages(manifest)
+        # No stage can be resumed if a recorded output has been changed outside the run
+        self.write_file(self.output_filename, '(A,(B,C));\n')
+        resumed_manifest = CheckpointManifest(self.manifest_filename, resume = True)
+        assert resumed_manifest.resumable_stages == 0
+        assert self.run_stages(resumed_manifest) == ['tree_building', 'reroot']
+        assert [stage['stage'] for stage in resumed_manifest.stages] == ['tree_building', 'reroot']
+
+    def test_missing_manifest(self):
+        with self.assertRaises(SystemExit):
+            CheckpointManifest(self.manifest_filename, resume = True)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -837,6 +837,8 @@ class TestExternalDependencies(unittest.TestCase):
         assert os.path.exists(prefix + '.branch_base_reconstruction.embl')
         assert os.path.exists(prefix + '.final_tree.tre')
         assert os.path.exists(prefix + '.node_labelled.final_tree.tre')
+        assert os.path.exists(prefix + '.resources.csv')
+        assert os.path.exists(prefix + '.resources.json')
         return 0
 
     @staticmethod
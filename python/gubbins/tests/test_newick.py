@@ -0,0 +1,75 @@
+#! /usr/bin/env python3
+# encoding: utf-8
+
+"""
+Tests for reading and writing Newick trees as flat arrays
+"""
+
+import unittest
+import os
+import shutil
+import tempfile
+import numpy
+import dendropy
+from gubbins import newick, utils
+from gubbins.common import tree_as_string, do_the_names_match_the_fasta_file
+from gubbins.tree_arrays import TreeArrays
+
+modules_dir = os.path.dirname(os.path.abspath(newick.__file__))
+data_dir = os.path.join(modules_dir, 'tests', 'data')
+
+class TestNewick(unittest.TestCase):
+
+    def test_parse_newick(self):
+        # Quoted labels keep their spaces and escaped quotes, unquoted labels keep their underscores,
+        # and comments are ignored
+        taxon_labels, node_labels, parent_nodes, edge_lengths = \
+            newick.parse_newick("[&R] (('seq 1':0.1,seq_2[comment]:0.25)0.95:0.3,'it''s',:2)root:0.0;")
+        assert taxon_labels == ['seq 1', 'seq_2', '', "it's", '', '']
+        assert node_labels == ['', '', '0.95', '', '', 'root']
+        assert parent_nodes == [2, 2, 5, 5, 5, -1]
+        numpy.testing.assert_array_equal(edge_lengths, [0.1, 0.25, 0.3, numpy.nan, 2.0, 0.0])
+
+    def test_parse_invalid_newick(self):
+        for tree_string in ["((A,B);", "(A,B));", "(A,B):x;", "(A,B)C D;"]:
+            with self.assertRaises(SystemExit):
+                newick.parse_newick(tree_string)
+
+    def test_newick_matches_dendropy(self):
+        # Every tree in the test data is read and written as by dendropy and tree_as_string with quotes removed
+        tree_filenames = sorted(filename for filename in os.listdir(data_dir)
+                                if filename.endswith(('.tre', '.tree', '.newick', '.nwk')) and
+                                filename not in ['invalid_newick_tree.tre', 'duplicate_names_in_tree.tre'])
+        assert len(tree_filenames) > 20
+        for filename in tree_filenames:
+            tree_filename = os.path.join(data_dir, filename)
+            tree = dendropy.Tree.get(path = tree_filename,
+                                     schema = 'newick',
+                                     preserve_underscores = True,
+                                     rooting = 'force-rooted')
+            tree_arrays = TreeArrays.from_newick(tree_filename)
+            dendropy_arrays = TreeArrays.from_tree(tree)
+            assert tree_arrays.taxon_labels == dendropy_arrays.taxon_labels, filename
+            numpy.testing.assert_array_equal(tree_arrays.parent_nodes, dendropy_arrays.parent_nodes)
+            numpy.testing.assert_array_equal(tree_arrays.edge_lengths, dendropy_arrays.edge_lengths)
+            for suppress_internal in [True, False]:
+                assert tree_arrays.as_string(suppress_internal = suppress_internal) == \
+                    tree_as_string(tree, suppress_internal = suppress_internal).replace('\'', ''), filename
+
+    def test_starting_tree_names_match_dendropy(self):
+        # Starting trees are rewritten with processed leaf names as they were when read with dendropy
+        tree_filename = os.path.join(data_dir, 'multiple_recombinations_gubbins.final_tree.tre')
+        alignment_filename = os.path.join(data_dir, 'multiple_recombinations.aln')
+        tree = dendropy.Tree.get_from_path(tree_filename, 'newick', preserve_underscores = True)
+        for leaf in tree.leaf_nodes():
+            leaf.taxon.label = utils.process_sequence_names(leaf.taxon.label)
+        expected_tree_string = tree_as_string(tree, suppress_internal = False).replace('\'', '')
+        with tempfile.TemporaryDirectory() as tmpdir:
+            starting_tree = os.path.join(tmpdir, 'starting.tre')
+            shutil.copyfile(tree_filename, starting_tree)
+            assert do_the_names_match_the_fasta_file(starting_tree, alignment_filename)
+            with open(starting_tree) as tree_file:
+                assert tree_file.read() == expected_tree_string
+
+if __name__ == "__main__":
+    unittest.main()
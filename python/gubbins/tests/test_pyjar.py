@@ -0,0 +1,475 @@
+#! /usr/bin/env python3
+# encoding: utf-8
+
+"""
+Tests for the joint and marginal ancestral reconstruction of sequences using pyjar
+"""
+
+import unittest
+import os
+import shutil
+import tempfile
+import filecmp
+import tracemalloc
+import itertools
+import io
+import json
+import subprocess
+import numpy
+import dendropy
+from scipy import linalg
+from gubbins import pyjar, utils
+from gubbins.tests import benchmark_pyjar
+
+modules_dir = os.path.dirname(os.path.abspath(pyjar.__file__))
+data_dir = os.path.join(modules_dir, 'tests', 'data')
+
+def read_base_patterns(alignment_filename):
+    # Collapse the columns of an alignment into unique base patterns, packed two bases per byte
+    sequence_names = []
+    sequences = []
+    with open(alignment_filename, 'r') as alignment_file:
+        for line in alignment_file:
+            if line.startswith('>'):
+                sequence_names.append(line[1:].strip())
+                sequences.append('')
+            else:
+                sequences[-1] += line.strip()
+    alignment = numpy.empty((len(sequences),len(sequences[0])), dtype = numpy.uint8)
+    for i,sequence in enumerate(sequences):
+        pyjar.seq_to_int(numpy.array(list(sequence), dtype = 'U1'), alignment[i,:])
+    patterns,pattern_index = numpy.unique(alignment, axis = 1, return_inverse = True)
+    pattern_index = pattern_index.reshape(-1)
+    base_patterns = pyjar.pack_bases(patterns.T)
+    base_pattern_positions = [numpy.where(pattern_index == i)[0].astype(numpy.int32) for i in range(base_patterns.shape[0])]
+    return sequence_names,base_patterns,base_pattern_positions,alignment.shape[1]
+
+class TestPyjar(unittest.TestCase):
+
+    def setUp(self):
+        self.output_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.output_dir)
+
+    def run_jar(self, prefix, dispatch, tree_filename, info_filename = "", threads = 1, subtree_cache_size = 2**18, engine = None,
+                output_format = "fasta", backend = "thread", profile = False):
+        alignment_filename = os.path.join(data_dir, 'multiple_recombinations.aln')
+        sequence_names, base_patterns, base_pattern_positions, max_pos = read_base_patterns(alignment_filename)
+        output_prefix = os.path.join(self.output_dir, prefix)
+        pyjar.jar(sequence_names = sequence_names,
+                  base_patterns = base_patterns,
+                  base_pattern_positions = base_pattern_positions,
+                  alignment_filename = alignment_filename,
+                  tree_filename = os.path.join(data_dir, tree_filename),
+                  info_filename = info_filename,
+                  info_filetype = 'fasttree',
+                  output_prefix = output_prefix,
+                  threads = threads,
+                  max_pos = max_pos,
+                  dispatch = dispatch,
+                  subtree_cache_size = subtree_cache_size,
+                  engine = engine,
+                  output_format = output_format,
+                  backend = backend,
+                  profile = profile)
+        return output_prefix
+
+    def compare_dispatch_methods(self, tree_filename, info_filename = "", threads = 1, subtree_cache_size = 2**18, backend = "thread"):
+        pattern_prefix = self.run_jar('pattern', 'pattern', tree_filename, info_filename = info_filename, threads = threads)
+        chunked_prefix = self.run_jar('chunked', 'chunked', tree_filename, info_filename = info_filename, threads = threads,
+                                        subtree_cache_size = subtree_cache_size, backend = backend)
+        for suffix in ['.joint.aln', '.joint.tre']:
+            assert filecmp.cmp(pattern_prefix + suffix, chunked_prefix + suffix, shallow = False)
+
+    def test_batched_reconstruction_jc(self):
+        self.compare_dispatch_methods('robinson_foulds_distance_tree1.tre')
+
+    def test_batched_reconstruction_gtr(self):
+        info_filename = os.path.join(self.output_dir, 'info.txt')
+        with open(info_filename, 'w') as info_file:
+            info_file.write('GTRFreq 0.3 0.2 0.25 0.25\nGTRRates 1.2 3.5 0.8 1.1 4.0 1.0\n')
+        self.compare_dispatch_methods('robinson_foulds_distance_tree1.tre', info_filename = info_filename)
+
+    def test_batched_reconstruction_long_branches(self):
+        self.compare_dispatch_methods('multiple_recombinations_gubbins.final_tree.tre')
+
+    def test_batched_reconstruction_minimal_cache(self):
+        self.compare_dispatch_methods('robinson_foulds_distance_tree1.tre', subtree_cache_size = 0)
+
+    def test_batched_reconstruction_threads(self):
+        self.compare_dispatch_methods('robinson_foulds_distance_tree1.tre', threads = 2)
+
+    def test_batched_reconstruction_processes(self):
+        self.compare_dispatch_methods('robinson_foulds_distance_tree1.tre', threads = 2, backend = "process")
+
+    def test_engine_reused_across_trees(self):
+        alignment_filename = os.path.join(data_dir, 'multiple_recombinations.aln')
+        sequence_names, base_patterns, base_pattern_positions, max_pos = read_base_patterns(alignment_filename)
+        with pyjar.ReconstructionEngine(base_patterns = base_patterns,
+                                        num_samples = len(sequence_names),
+                                        base_pattern_positions = base_pattern_positions,
+                                        max_pos = max_pos,
+                                        threads = 2) as engine:
+            for tree_filename in ['robinson_foulds_distance_tree1.tre',
+                                    'multiple_recombinations_gubbins.final_tree.tre',
+                                    'robinson_foulds_distance_tree1.tre']:
+                pattern_prefix = self.run_jar('pattern', 'pattern', tree_filename)
+                engine_prefix = self.run_jar('engine', 'chunked', tree_filename, engine = engine)
+                for suffix in ['.joint.aln', '.joint.tre']:
+                    assert filecmp.cmp(pattern_prefix + suffix, engine_prefix + suffix, shallow = False)
+
+    def test_incremental_reconstruction(self):
+        alignment_filename = os.path.join(data_dir, 'multiple_recombinations.aln')
+        sequence_names, base_patterns, base_pattern_positions, max_pos = read_base_patterns(alignment_filename)
+        # Modify the length of a single branch
+        modified_tree_filename = os.path.join(self.output_dir, 'modified.tre')
+        with open(os.path.join(data_dir, 'robinson_foulds_distance_tree1.tre'), 'r') as tree_file:
+            tree_string = tree_file.read()
+        with open(modified_tree_filename, 'w') as tree_file:
+            tree_file.write(tree_string.replace('sequence_8:0.000011', 'sequence_8:0.1'))
+        with pyjar.ReconstructionEngine(base_patterns = base_patterns,
+                                        num_samples = len(sequence_names),
+                                        base_pattern_positions = base_pattern_positions,
+                                        max_pos = max_pos,
+                                        incremental = True) as engine:
+            reused_nodes = []
+            for tree_filename in ['robinson_foulds_distance_tree1.tre',
+                                    'robinson_foulds_distance_tree1.tre',
+                                    modified_tree_filename,
+                                    'multiple_recombinations_gubbins.final_tree.tre']:
+                pattern_prefix = self.run_jar('pattern', 'pattern', tree_filename)
+                engine_prefix = self.run_jar('engine', 'chunked', tree_filename, engine = engine)
+                reused_nodes.append(engine.reused_nodes)
+                for suffix in ['.joint.aln', '.joint.tre']:
+                    assert filecmp.cmp(pattern_prefix + suffix, engine_prefix + suffix, shallow = False)
+        # The tree has 18 nodes, and only the modified branch and its ancestors (N8, N7 and the root) are recalculated
+        assert reused_nodes[0] == 0
+        assert reused_nodes[1] == 18
+        assert reused_nodes[2] == 14
+
+    def test_binary_reconstruction_output(self):
+        fasta_prefix = self.run_jar('fasta', 'chunked', 'robinson_foulds_distance_tree1.tre')
+        both_prefix = self.run_jar('both', 'chunked', 'robinson_foulds_distance_tree1.tre', output_format = 'both')
+        binary_prefix = self.run_jar('binary', 'chunked', 'robinson_foulds_distance_tree1.tre', output_format = 'binary')
+        assert filecmp.cmp(fasta_prefix + '.joint.aln', both_prefix + '.joint.aln', shallow = False)
+        assert filecmp.cmp(both_prefix + '.joint.recon', binary_prefix + '.joint.recon', shallow = False)
+        assert not os.path.exists(binary_prefix + '.joint.aln')
+        # The binary matrix should contain the internal node sequences appended to the FASTA output
+        node_names, sequences = pyjar.read_reconstruction_binary(binary_prefix + '.joint.recon')
+        fasta_sequences = {}
+        with open(fasta_prefix + '.joint.aln', 'r') as fasta_file:
+            for line in fasta_file:
+                if line.startswith('>'):
+                    name = line[1:].strip()
+                    fasta_sequences[name] = ''
+                else:
+                    fasta_sequences[name] += line.strip()
+        assert len(node_names) == 8
+        lookup_table = numpy.array(list('ACGT-N'))
+        for node_name,sequence in zip(node_names, sequences):
+            assert ''.join(lookup_table[sequence]) == fasta_sequences[node_name]
+
+    def test_packed_bases(self):
+        bases = numpy.array([[0,1,2,3,4], [5,4,3,2,1]], dtype = numpy.uint8)
+        packed_bases = pyjar.pack_bases(bases)
+        numpy.testing.assert_array_equal(packed_bases, [[0x10,0x32,0x54], [0x45,0x23,0x51]])
+        numpy.testing.assert_array_equal(pyjar.unpack_bases(packed_bases, 5), bases)
+        numpy.testing.assert_array_equal(pyjar.unpack_node_block(packed_bases, 2, 5), bases[:,2:].T)
+        # Single bases are stored without modifying the other base in the byte
+        pyjar.set_packed_base(packed_bases, 0, 3, 0)
+        pyjar.set_packed_base(packed_bases, 1, 0, 2)
+        numpy.testing.assert_array_equal(pyjar.unpack_bases(packed_bases, 5), [[0,1,2,0,4], [2,4,3,2,1]])
+        assert [pyjar.get_packed_base(packed_bases, 1, index) for index in range(6)] == [2,4,3,2,1,5]
+
+    def test_out_of_core_reconstruction(self):
+        alignment_filename = os.path.join(data_dir, 'multiple_recombinations.aln')
+        sequence_names, base_patterns, base_pattern_positions, max_pos = read_base_patterns(alignment_filename)
+        in_memory_prefix = self.run_jar('memory', 'chunked', 'robinson_foulds_distance_tree1.tre', output_format = 'both')
+        mapped_dir = os.path.join(self.output_dir, 'mapped')
+        os.mkdir(mapped_dir)
+        for threads,backend in [(1,'thread'), (2,'thread'), (2,'process')]:
+            # A budget of a single byte forces the output alignment to be memory-mapped
+            with pyjar.ReconstructionEngine(base_patterns = base_patterns,
+                                            num_samples = len(sequence_names),
+                                            base_pattern_positions = base_pattern_positions,
+                                            max_pos = max_pos,
+                                            threads = threads,
+                                            backend = backend,
+                                            memory_budget = 1,
+                                            temp_dir = mapped_dir) as engine:
+                assert engine.out_of_core
+                assert os.path.dirname(engine.out_aln_file) == mapped_dir
+                mapped_prefix = self.run_jar('mapped', 'chunked', 'robinson_foulds_distance_tree1.tre', engine = engine,
+                                                output_format = 'both')
+            for suffix in ['.joint.aln', '.joint.tre', '.joint.recon']:
+                assert filecmp.cmp(in_memory_prefix + suffix, mapped_prefix + suffix, shallow = False)
+            # The mapped files are removed when the engine is closed
+            assert os.listdir(mapped_dir) == []
+
+    def test_pattern_block_balancing(self):
+        # Monomorphic, singleton and other patterns, the first of which occurs at three positions
+        base_patterns = pyjar.pack_bases([[0,0,0,0], [0,0,0,1], [0,1,2,3], [4,0,0,1], [2,2,5,2]])
+        pattern_position_offsets = numpy.array([0,3,4,5,6,7], dtype = numpy.int64)
+        pattern_costs = numpy.zeros(5, dtype = numpy.float64)
+        pyjar.estimate_pattern_costs(base_patterns, 4, pattern_position_offsets, 1.0, 4.0, pattern_costs)
+        numpy.testing.assert_array_equal(pattern_costs, [3.0, 2.0, 5.0, 5.0, 1.0])
+        # Blocks are contiguous and divide the patterns close to the cumulative cost targets
+        assert pyjar.balance_pattern_blocks(pattern_costs, 3) == [(0,2), (2,3), (3,5)]
+        assert pyjar.balance_pattern_blocks(pattern_costs, 1) == [(0,5)]
+        assert pyjar.balance_pattern_blocks(numpy.array([1.0,20.0,1.0]), 4) == [(0,1), (1,2), (2,3)]
+        # Every block is reconstructed, and the time taken is recorded for each worker
+        alignment_filename = os.path.join(data_dir, 'multiple_recombinations.aln')
+        sequence_names, base_patterns, base_pattern_positions, max_pos = read_base_patterns(alignment_filename)
+        for backend in ['thread', 'process']:
+            with pyjar.ReconstructionEngine(base_patterns = base_patterns,
+                                            num_samples = len(sequence_names),
+                                            base_pattern_positions = base_pattern_positions,
+                                            max_pos = max_pos,
+                                            threads = 2,
+                                            backend = backend) as engine:
+                assert 2 < len(engine.pattern_blocks) <= 8
+                engine_prefix = self.run_jar('engine', 'chunked', 'robinson_foulds_distance_tree1.tre', engine = engine)
+                assert 0 < len(engine.worker_busy_times) <= 2
+            pattern_prefix = self.run_jar('pattern', 'pattern', 'robinson_foulds_distance_tree1.tre')
+            for suffix in ['.joint.aln', '.joint.tre']:
+                assert filecmp.cmp(pattern_prefix + suffix, engine_prefix + suffix, shallow = False)
+
+    def test_backend_benchmark(self):
+        # The benchmark of the reconstruction backends runs on a small simulated pattern set, and every
+        # backend and thread count reconstructs the same ancestral sequences
+        benchmark_output = io.StringIO()
+        timings = benchmark_pyjar.benchmark_backends(num_taxa = 20, num_patterns = 2000, thread_counts = [1, 2], repeats = 1,
+                                                        output_file = benchmark_output)
+        assert set(timings) == {('thread',1), ('thread',2), ('process',1), ('process',2)}
+        assert len(benchmark_output.getvalue().splitlines()) == 6
+
+    def test_reconstruction_profile(self):
+        # The wall-clock and CPU time of each phase are written alongside the reconstruction, including the
+        # CPU time of the reconstruction tasks run in worker processes
+        for dispatch,backend in [('chunked', 'thread'), ('chunked', 'process'), ('pattern', 'thread')]:
+            prefix = self.run_jar(dispatch + '_' + backend, dispatch, 'robinson_foulds_distance_tree1.tre',
+                                    threads = 2, backend = backend, profile = True)
+            with open(prefix + '.joint.profile.json', 'r') as profile_file:
+                profile = json.load(profile_file)
+            assert profile['dispatch'] == dispatch and profile['threads'] == 2
+            for phase_name in ['tree_loading', 'pij_computation', 'shared_memory_setup', 'kernel', 'alignment_writing', 'tree_writing']:
+                assert profile['phases'][phase_name]['wall_time'] > 0
+            if dispatch == 'chunked':
+                assert profile['phases']['kernel']['worker_cpu_time'] > 0
+                assert 'result_reduction' in profile['phases'] and 'worker_shutdown' in profile['phases']
+            else:
+                # The pool of processes exits before the end of the phase
+                assert profile['phases']['kernel']['child_cpu_time'] > 0
+            assert numpy.isclose(profile['total']['wall_time'], sum(phase['wall_time'] for phase in profile['phases'].values()))
+
+    def test_jar_with_tree_arrays(self):
+        alignment_filename = os.path.join(data_dir, 'multiple_recombinations.aln')
+        tree_filename = os.path.join(data_dir, 'robinson_foulds_distance_tree1.tre')
+        sequence_names, base_patterns, base_pattern_positions, max_pos = read_base_patterns(alignment_filename)
+        tree_arrays = pyjar.TreeArrays.from_newick(tree_filename)
+        tree_arrays.save(os.path.join(self.output_dir, 'tree.npz'))
+        for prefix,tree_arrays in [('newick', None), ('arrays', pyjar.TreeArrays.load(os.path.join(self.output_dir, 'tree.npz')))]:
+            pyjar.jar(sequence_names = sequence_names,
+                      base_patterns = base_patterns,
+                      base_pattern_positions = base_pattern_positions,
+                      alignment_filename = alignment_filename,
+                      tree_filename = tree_filename,
+                      info_filename = "",
+                      info_filetype = 'fasttree',
+                      output_prefix = os.path.join(self.output_dir, prefix),
+                      max_pos = max_pos,
+                      tree_arrays = tree_arrays)
+        for suffix in ['.joint.aln', '.joint.tre']:
+            assert filecmp.cmp(os.path.join(self.output_dir, 'newick' + suffix),
+                                os.path.join(self.output_dir, 'arrays' + suffix),
+                                shallow = False)
+
+    def test_workspace_reused_across_trees(self):
+        alignment_filename = os.path.join(data_dir, 'multiple_recombinations.aln')
+        sequence_names, base_patterns, base_pattern_positions, max_pos = read_base_patterns(alignment_filename)
+        with pyjar.ReconstructionEngine(base_patterns = base_patterns,
+                                        num_samples = len(sequence_names),
+                                        base_pattern_positions = base_pattern_positions,
+                                        max_pos = max_pos) as engine:
+            self.run_jar('engine', 'chunked', 'multiple_recombinations_gubbins.final_tree.tre', engine = engine)
+            workspace = engine.worker_state['workspace']
+            allocations = workspace.allocations
+            for tree_filename in ['robinson_foulds_distance_tree1.tre',
+                                    'multiple_recombinations_gubbins.final_tree.tre']:
+                self.run_jar('engine', 'chunked', tree_filename, engine = engine)
+            assert workspace.allocations == allocations
+            # Reconstructing the block again should not allocate any scratch arrays
+            block_start, block_end = engine.pattern_blocks[0]
+            tracemalloc.start()
+            pyjar.reconstruct_pattern_block(0, block_start, block_end, state = engine.worker_state)
+            _, peak_memory = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            assert workspace.allocations == allocations
+            assert peak_memory < workspace.buffers['Lmat'].nbytes//16
+
+    def test_pattern_classes(self):
+        # Monomorphic (with and without gaps), singleton and other patterns, including a singleton on a
+        # branch of zero length, for which the substitution is reconstructed on an ancestral branch
+        columns = ['AAAAAA', 'CC-CC-', '------', 'GGGGGT', 'TAAAAA', 'ATAAAA', 'AACCCC', 'AAAAA-', 'ACGTAC']
+        alignment_filename = os.path.join(self.output_dir, 'classes.aln')
+        with open(alignment_filename, 'w') as alignment_file:
+            for i in range(6):
+                alignment_file.write('>s' + str(i + 1) + '\n' + ''.join(column[i] for column in columns) + '\n')
+        tree_filename = os.path.join(self.output_dir, 'classes.tre')
+        with open(tree_filename, 'w') as tree_file:
+            tree_file.write('((s1:0.02,s2:0.0):0.01,((s3:0.05,s4:0.01):0.02,(s5:0.03,s6:0.04):0.01):0.02);\n')
+        sequence_names, base_patterns, base_pattern_positions, max_pos = read_base_patterns(alignment_filename)
+        with pyjar.ReconstructionEngine(base_patterns = base_patterns,
+                                        num_samples = len(sequence_names),
+                                        base_pattern_positions = base_pattern_positions,
+                                        max_pos = max_pos) as engine:
+            for dispatch in ['pattern', 'chunked']:
+                pyjar.jar(sequence_names = sequence_names,
+                          base_patterns = base_patterns,
+                          base_pattern_positions = base_pattern_positions,
+                          alignment_filename = alignment_filename,
+                          tree_filename = tree_filename,
+                          info_filename = "",
+                          info_filetype = 'fasttree',
+                          output_prefix = os.path.join(self.output_dir, dispatch),
+                          threads = 1,
+                          max_pos = max_pos,
+                          dispatch = dispatch,
+                          engine = engine)
+            assert list(engine.pattern_class_counts) == [4, 2, 3]
+        for suffix in ['.joint.aln', '.joint.tre']:
+            assert filecmp.cmp(os.path.join(self.output_dir, 'pattern' + suffix),
+                                os.path.join(self.output_dir, 'chunked' + suffix),
+                                shallow = False)
+
+    def test_marginal_reconstruction(self):
+        columns = ['AACT', 'ACGT', 'CCAA', 'G-GT', '--AC', 'TGCA', 'AGGA', '--T-']
+        alignment_filename = os.path.join(self.output_dir, 'marginal.aln')
+        with open(alignment_filename, 'w') as alignment_file:
+            for i in range(4):
+                alignment_file.write('>s' + str(i + 1) + '\n' + ''.join(column[i] for column in columns) + '\n')
+        tree_filename = os.path.join(self.output_dir, 'marginal.tre')
+        with open(tree_filename, 'w') as tree_file:
+            tree_file.write('((s1:0.1,s2:0.3):0.2,(s3:0.05,s4:0.4):0.25);\n')
+        info_filename = os.path.join(self.output_dir, 'info.txt')
+        with open(info_filename, 'w') as info_file:
+            info_file.write('GTRFreq 0.3 0.2 0.25 0.25\nGTRRates 1.2 3.5 0.8 1.1 4.0 1.0\n')
+        sequence_names, base_patterns, base_pattern_positions, max_pos = read_base_patterns(alignment_filename)
+        for threads,backend in [(1,'thread'), (2,'thread'), (2,'process')]:
+            pyjar.jar(sequence_names = sequence_names,
+                      base_patterns = base_patterns,
+                      base_pattern_positions = base_pattern_positions,
+                      alignment_filename = alignment_filename,
+                      tree_filename = tree_filename,
+                      info_filename = info_filename,
+                      info_filetype = 'fasttree',
+                      output_prefix = os.path.join(self.output_dir, backend + str(threads)),
+                      threads = threads,
+                      max_pos = max_pos,
+                      backend = backend,
+                      reconstruction = 'marginal')
+        for prefix in ['thread2', 'process2']:
+            assert filecmp.cmp(os.path.join(self.output_dir, 'thread1.marginal.aln'),
+                                os.path.join(self.output_dir, prefix + '.marginal.aln'),
+                                shallow = False)
+        reconstruction = {}
+        with open(os.path.join(self.output_dir, 'thread1.marginal.aln'), 'r') as fasta_file:
+            for line in fasta_file:
+                if line.startswith('>'):
+                    name = line[1:].strip()
+                    reconstruction[name] = ''
+                else:
+                    reconstruction[name] += line.strip()
+        # Identify the internal node labels assigned by pyjar
+        output_tree = dendropy.Tree.get(path = os.path.join(self.output_dir, 'thread1.marginal.tre'), schema = 'newick',
+                                        preserve_underscores = True)
+        node_names = [node.label for node in output_tree.preorder_node_iter() if not node.is_leaf()]
+        # Calculate the posterior probabilities of bases at the root (N1) and internal nodes (N2, N3) by enumeration,
+        # with the branch to N2 shortened as in the reconstruction
+        frequencies = numpy.array([0.3,0.2,0.25,0.25])
+        rate_matrix = pyjar.create_rate_matrix(frequencies.astype(numpy.float32),
+                                                numpy.array([1.2,3.5,0.8,1.1,4.0,1.0], dtype = numpy.float32))
+        pij = {branch: linalg.expm(rate_matrix.astype(numpy.float64)*length)
+                for branch,length in [('N2',0.2/1e6), ('N3',0.25), ('s1',0.1), ('s2',0.3), ('s3',0.05), ('s4',0.4)]}
+        for c,column in enumerate(columns):
+            posteriors = numpy.zeros((3,4))
+            for n1,n2,n3 in itertools.product(range(4), repeat = 3):
+                p = frequencies[n1]*pij['N2'][n1,n2]*pij['N3'][n1,n3]
+                for i,parent in enumerate([n2,n2,n3,n3]):
+                    if column[i] != '-':
+                        p *= pij['s' + str(i + 1)][parent,'ACGT'.index(column[i])]
+                for node,base in enumerate([n1,n2,n3]):
+                    posteriors[node,base] += p
+            for node,(name,descendants) in enumerate(zip(node_names, [column, column[:2], column[2:]])):
+                if set(descendants) == {'-'}:
+                    assert reconstruction[name][c] == '-'
+                else:
+                    assert reconstruction[name][c] == 'ACGT'[numpy.argmax(posteriors[node,:])]
+
+    def test_kernel_cache(self):
+        # Kernels are loaded when pyjar is imported, from a writable cache directory
+        kernel_load_time, cached_kernels = pyjar.check_compiled_kernels()
+        assert kernel_load_time > 0
+        assert 0 <= cached_kernels <= len(pyjar.compiled_kernels)
+        assert pyjar.is_writable_directory(pyjar.kernel_cache_dir)
+        assert not pyjar.is_writable_directory(os.path.join(data_dir, 'multiple_recombinations.aln'))
+
+    def test_binary_base_patterns(self):
+        alignment_filename = os.path.join(data_dir, 'multiple_recombinations.aln')
+        sequence_names, base_patterns, base_pattern_positions, max_pos = read_base_patterns(alignment_filename)
+        prefix = os.path.join(self.output_dir, 'patterns')
+        # Write the CSV files
+        bases = numpy.array(list('ACGT-N'))
+        with open(prefix + '.gaps.sequence_names.csv', 'w') as names_file:
+            names_file.write(''.join(name + '\n' for name in sequence_names))
+        with open(prefix + '.gaps.base_patterns.csv', 'w') as patterns_file:
+            patterns_file.write(''.join(''.join(bases[pattern]) + '\n' for pattern in pyjar.unpack_bases(base_patterns, len(sequence_names))))
+        with open(prefix + '.gaps.base_positions.csv', 'w') as positions_file:
+            positions_file.write(''.join(','.join(map(str, positions)) + '\n' for positions in base_pattern_positions))
+        csv_patterns = pyjar.get_base_patterns(prefix, False)
+        dimensions = (len(sequence_names), sum(len(positions) for positions in base_pattern_positions), len(base_patterns))
+        assert pyjar.get_base_pattern_dimensions(prefix) == dimensions
+        # Write the equivalent binary file, with the bases packed two per byte and each section padded to a
+        # multiple of eight bytes
+        names_block = ''.join(name + '\n' for name in sequence_names).encode()
+        offsets = numpy.cumsum([0] + [len(positions) for positions in base_pattern_positions], dtype = numpy.int64)
+        with open(prefix + '.gaps.base_patterns.bin', 'wb') as binary_file:
+            binary_file.write(b'GUBBPAT2')
+            binary_file.write(numpy.array([base_patterns.shape[0], len(sequence_names), offsets[-1], len(names_block)],
+                                            dtype = numpy.int64).tobytes())
+            binary_file.write(base_patterns.tobytes() + bytes(-base_patterns.size % 8))
+            binary_file.write(offsets.tobytes())
+            binary_file.write(numpy.concatenate(base_pattern_positions).astype(numpy.int32).tobytes() + bytes(4*(offsets[-1] % 2)))
+            binary_file.write(names_block)
+        binary_patterns = pyjar.get_base_patterns(prefix, False)
+        assert pyjar.get_base_pattern_dimensions(prefix) == dimensions
+        for loaded_patterns in [csv_patterns, binary_patterns]:
+            assert loaded_patterns[0] == sequence_names
+            numpy.testing.assert_array_equal(loaded_patterns[1], base_patterns)
+            assert len(loaded_patterns[2]) == len(base_pattern_positions)
+            for loaded_positions,positions in zip(loaded_patterns[2], base_pattern_positions):
+                numpy.testing.assert_array_equal(loaded_positions, positions)
+            assert loaded_patterns[3] == max_pos
+
+    def test_binary_base_patterns_from_snp_finder(self):
+        # Run the C SNP finder, which writes both the CSV files and the binary file of base patterns
+        gubbins_exec = utils.which('gubbins')
+        if gubbins_exec is None:
+            gubbins_exec = os.path.abspath(os.path.join(modules_dir, '../../src/gubbins'))
+        alignment_filename = os.path.join(data_dir, 'multiple_recombinations.aln')
+        subprocess.check_call([gubbins_exec, alignment_filename], cwd = self.output_dir, stdout = subprocess.DEVNULL)
+        prefix = os.path.join(self.output_dir, 'multiple_recombinations.aln')
+        binary_patterns = pyjar.read_binary_base_patterns(prefix + '.gaps.base_patterns.bin')
+        # Parse the CSV files written in the same pass
+        os.remove(prefix + '.gaps.base_patterns.bin')
+        csv_patterns = pyjar.get_base_patterns(prefix, False)
+        assert binary_patterns[0] == csv_patterns[0]
+        numpy.testing.assert_array_equal(binary_patterns[1], csv_patterns[1])
+        assert len(binary_patterns[2]) == len(csv_patterns[2])
+        for binary_positions,csv_positions in zip(binary_patterns[2], csv_patterns[2]):
+            numpy.testing.assert_array_equal(binary_positions, csv_positions)
+        assert binary_patterns[3] == csv_patterns[3]
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,97 @@
+#! /usr/bin/env python3
+# encoding: utf-8
+
+"""
+Tests for the runner of external commands
+"""
+
+import unittest
+import os
+import sys
+import csv
+import json
+import shutil
+import subprocess
+import tempfile
+from gubbins.runner import Command, CommandRunner
+
+class TestRunner(unittest.TestCase):
+
+    def setUp(self):
+        self.working_directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.working_directory)
+
+    def python_command(self, code, **options):
+        return Command([sys.executable, '-c', code], **options)
+
+    def test_command_description(self):
+        assert str(Command(['raxmlHPC', '-s', 'a b.phylip', '-f', 'e'], output_filename = os.devnull)) == \
+                    "raxmlHPC -s 'a b.phylip' -f e > " + os.devnull + " 2>&1"
+        assert str(Command(['iqtree', '--date-options', ' -l 0'])) == "iqtree --date-options ' -l 0'"
+
+    def test_arguments_are_not_interpreted_by_a_shell(self):
+        runner = CommandRunner()
+        command = Command([sys.executable, '-c', "import sys; open('arguments.txt', 'w').write(repr(sys.argv[1:]))",
+                            '&&', '|', '*', '>', 'x', '$HOME'],
+                          working_directory = self.working_directory)
+        runner.check_call('arguments', command)
+        with open(os.path.join(self.working_directory, 'arguments.txt')) as arguments_file:
+            assert arguments_file.read() == repr(['&&', '|', '*', '>', 'x', '$HOME'])
+        assert not os.path.exists(os.path.join(self.working_directory, 'x'))
+
+    def test_commands_run_in_working_directory(self):
+        runner = CommandRunner()
+        runner.check_call('writing', self.python_command("open('output.txt', 'w').write('x' * 10)"),
+                          working_directory = self.working_directory)
+        runner.check_call('writing', Command(['cp', 'output.txt', 'copy.txt'], working_directory = self.working_directory))
+        assert os.path.isfile(os.path.join(self.working_directory, 'copy.txt'))
+        assert not os.path.isfile('output.txt')
+        assert len(runner.records) == 2
+        for record in runner.records:
+            assert record['stage'] == 'writing'
+            assert record['exit_status'] == 0
+            assert record['wall_time'] >= 0 and record['max_rss'] > 0
+        totals = runner.stage_totals()
+        assert totals['writing']['commands'] == 2
+        assert totals['writing']['max_rss'] == max(record['max_rss'] for record in runner.records)
+
+    def test_output_and_environment(self):
+        runner = CommandRunner()
+        runner.check_call('printing', self.python_command("import os; print(os.environ['OMP_NUM_THREADS'])",
+                                                          output_filename = 'printed.txt',
+                                                          working_directory = self.working_directory,
+                                                          environment = {'OMP_NUM_THREADS': '3'}))
+        with open(os.path.join(self.working_directory, 'printed.txt')) as printed_file:
+            assert printed_file.read() == '3\n'
+        assert 'OMP_NUM_THREADS' not in os.environ or os.environ['OMP_NUM_THREADS'] != '3'
+
+    def test_failures(self):
+        runner = CommandRunner()
+        with self.assertRaises(subprocess.CalledProcessError):
+            runner.check_call('failing', self.python_command("import sys; sys.exit(3)"))
+        assert 'exit status 3' in runner.describe('failing')
+        with self.assertRaises(subprocess.CalledProcessError):
+            runner.check_call('missing', Command(['non_existent_program', '--help'], output_filename = os.devnull))
+        assert runner.records[-1]['exit_status'] == 127
+        assert runner.describe('unknown') == "no command was run"
+
+    def test_resource_tables(self):
+        runner = CommandRunner()
+        runner.check_call('first', self.python_command("pass"))
+        runner.check_call('second', self.python_command("pass"))
+        csv_filename = os.path.join(self.working_directory, 'run.resources.csv')
+        json_filename = os.path.join(self.working_directory, 'run.resources.json')
+        runner.write_csv(csv_filename)
+        runner.write_json(json_filename)
+        with open(csv_filename) as csv_file:
+            rows = list(csv.DictReader(csv_file))
+        assert [row['stage'] for row in rows] == ['first', 'second']
+        with open(json_filename) as json_file:
+            resources = json.load(json_file)
+        assert set(resources['stages']) == {'first', 'second'}
+        assert len(resources['commands']) == 2
+
+if __name__ == "__main__":
+    unittest.main()
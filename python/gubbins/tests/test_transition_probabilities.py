@@ -0,0 +1,53 @@
+#! /usr/bin/env python3
+# encoding: utf-8
+
+"""
+Tests for the calculation of transition probability matrices used in ancestral reconstruction
+"""
+
+import unittest
+import numpy
+from gubbins import pyjar
+from gubbins.transition_probabilities import TransitionProbabilityCache
+
+class TestTransitionProbabilities(unittest.TestCase):
+
+    branch_lengths = numpy.array([0.0, 1e-11, 3.2e-7, 0.000011, 0.0042, 0.05, 0.3, 2.5])
+
+    def compare_to_matrix_exponential(self, f, r):
+        f = numpy.array(f, dtype = numpy.float32)
+        r = numpy.array(r, dtype = numpy.float32)
+        rate_matrix = pyjar.create_rate_matrix(f, r)
+        expected_pij = numpy.array([pyjar.calculate_pij(branch_length, rate_matrix) for branch_length in self.branch_lengths])
+        cache = TransitionProbabilityCache()
+        numpy.testing.assert_array_equal(cache.log_pij(rate_matrix, self.branch_lengths), expected_pij)
+
+    def test_jc_transition_probabilities(self):
+        self.compare_to_matrix_exponential([0.25,0.25,0.25,0.25], [1.0,1.0,1.0,1.0,1.0,1.0])
+
+    def test_gtr_transition_probabilities(self):
+        self.compare_to_matrix_exponential([0.3,0.2,0.25,0.25], [1.2,3.5,0.8,1.1,4.0,1.0])
+
+    def test_transition_probability_cache(self):
+        rate_matrix = pyjar.create_rate_matrix(numpy.array([0.3,0.2,0.25,0.25], dtype = numpy.float32),
+                                                numpy.array([1.2,3.5,0.8,1.1,4.0,1.0], dtype = numpy.float32))
+        cache = TransitionProbabilityCache(max_size = 4)
+        first_pij = cache.log_pij(rate_matrix, [0.1, 0.2, 0.1])
+        assert cache.hits == 0
+        assert len(cache.matrices) == 2
+        numpy.testing.assert_array_equal(first_pij[0,:], first_pij[2,:])
+        # Repeated branch lengths are retrieved from the cache
+        second_pij = cache.log_pij(rate_matrix, [0.2, 0.1, 0.3])
+        assert cache.hits == 2
+        numpy.testing.assert_array_equal(first_pij[[1,0],:], second_pij[:2,:])
+        # The least recently used matrices are discarded when the cache is full
+        cache.log_pij(rate_matrix, [0.4, 0.5])
+        assert len(cache.matrices) == 4
+        assert (cache.get_decomposition(rate_matrix)[0], 0.2) not in cache.matrices
+        # A different model does not reuse the matrices
+        cache.log_pij(pyjar.create_rate_matrix(numpy.full(4, 0.25, dtype = numpy.float32),
+                                                numpy.ones(6, dtype = numpy.float32)), [0.5])
+        assert cache.hits == 2
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,65 @@
+#! /usr/bin/env python3
+# encoding: utf-8
+
+"""
+Tests for the array representation of trees used in ancestral reconstruction
+"""
+
+import unittest
+import os
+import shutil
+import tempfile
+import numpy
+import dendropy
+from gubbins import pyjar
+from gubbins.common import tree_as_string
+from gubbins.tree_arrays import TreeArrays
+
+modules_dir = os.path.dirname(os.path.abspath(pyjar.__file__))
+data_dir = os.path.join(modules_dir, 'tests', 'data')
+
+class TestTreeArrays(unittest.TestCase):
+
+    def setUp(self):
+        self.output_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.output_dir)
+
+    def test_tree_arrays(self):
+        tree_arrays = TreeArrays.from_newick_string("((A:0.1,B:0.2):0.3,(C:0.4,(D:0.5,E:0.6):0.7,F:0.8):0.9);")
+        # Nodes are indexed in postorder, with the children of each node in order
+        assert tree_arrays.taxon_labels == ['A', 'B', '', 'C', 'D', 'E', '', 'F', '', '']
+        numpy.testing.assert_array_equal(tree_arrays.parent_nodes, [2, 2, 9, 8, 6, 6, 8, 8, 9, -1])
+        numpy.testing.assert_array_equal(tree_arrays.child_nodes[[2,8,9],:], [[0, 1, -1], [3, 6, 7], [2, 8, -1]])
+        numpy.testing.assert_array_equal(tree_arrays.leaf_nodes, [0, 1, 3, 4, 5, 7])
+        numpy.testing.assert_array_equal(tree_arrays.preordered_nodes, [2, 0, 1, 8, 3, 6, 4, 5, 7])
+        assert tree_arrays.seed_node == 9
+        numpy.testing.assert_array_equal(tree_arrays.edge_lengths[:9], [0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9])
+        assert numpy.isnan(tree_arrays.edge_lengths[9])
+
+    def test_tree_arrays_saved(self):
+        tree_arrays = TreeArrays.from_newick(os.path.join(data_dir, 'multiple_recombinations_gubbins.final_tree.tre'))
+        tree_arrays.save(os.path.join(self.output_dir, 'tree.npz'))
+        loaded_tree_arrays = TreeArrays.load(os.path.join(self.output_dir, 'tree.npz'))
+        assert loaded_tree_arrays.taxon_labels == tree_arrays.taxon_labels
+        assert loaded_tree_arrays.node_labels == tree_arrays.node_labels
+        for name in ['parent_nodes', 'edge_lengths', 'child_nodes', 'leaf_nodes', 'preordered_nodes']:
+            numpy.testing.assert_array_equal(getattr(loaded_tree_arrays, name), getattr(tree_arrays, name))
+        assert loaded_tree_arrays.as_string() == tree_arrays.as_string()
+
+    def test_tree_arrays_as_string(self):
+        # Trees are written as by tree_as_string with quotes removed, including internal node labels and
+        # labels that are quoted
+        tree_string = "(('seq 1':0.1,'seq_2':0.25)0.95:0.3,('seq(3)':1e-05,seq4:2):0.5,'it''s':0.0)root;"
+        tree_arrays = TreeArrays.from_newick_string(tree_string)
+        tree = dendropy.Tree.get(data = tree_string, schema = 'newick', preserve_underscores = True, rooting = 'force-rooted')
+        expected_string = tree_as_string(tree, suppress_rooting = True, suppress_internal = False).replace('\'', '')
+        assert tree_arrays.as_string() == expected_string
+        # Labels and edge lengths can be replaced
+        labels = ['A', 'B', 'Node_1', 'C', 'D', 'Node_2', 'E', 'Node_3']
+        assert tree_arrays.as_string(taxon_labels = labels, edge_lengths = numpy.arange(8)) == \
+                    "((A:0.0,B:1.0)Node_1 0.95:2.0,(C:3.0,D:4.0)Node_2:5.0,E:6.0)Node_3 root:7.0;\n"
+
+if __name__ == "__main__":
+    unittest.main()
@@ -20,8 +20,8 @@ data_dir = os.path.join(modules_dir, 'tests', 'data')
 class TestUtilities(unittest.TestCase):
 
     def test_gubbins_command(self):
-        assert common.create_gubbins_command('AAA', 'BBB', 'CCC', 'DDD', 'EEE', 5, 10, 200, 0.05, 1.0, 0, 1) \
-               == 'AAA -r -v CCC -a 10 -b 200 -f EEE -t DDD -m 5 -p 0.05 -i 1.0 -n 1 BBB'
+        assert common.create_gubbins_command('AAA', 'BBB', 'CCC', 'DDD', 'EEE', 5, 10, 200, 0.05, 1.0, 0, 1).arguments \
+               == ['AAA', '-r', '-v', 'CCC', '-a', '10', '-b', '200', '-f', 'EEE', '-t', 'DDD', '-m', '5', '-p', '0.05', '-i', '1.0', '-n', '1', 'BBB']
 
     def test_translation_of_filenames_to_final_filenames(self):
         assert common.translation_of_filenames_to_final_filenames('AAA', 'test') == {
@@ -113,3 +113,53 @@ class TestUtilities(unittest.TestCase):
         assert set_seed_val == "42"
         random_seed_val = utils.set_seed(None)
         assert(int(random_seed_val) < 10001)
+
+    def test_split_threads(self):
+        assert utils.split_threads(8, [100, 1, 1]) == [6, 1, 1]
+        assert utils.split_threads(4, [1, 1]) == [2, 2]
+        assert utils.split_threads(5, [1, 1]) == [3, 2]
+        # Every task is allocated at least one thread
+        assert utils.split_threads(2, [1, 1, 1]) == [1, 1, 1]
+
+    def test_choose_threads(self):
+        assert utils.choose_threads(32, 300, 1000) == 1
+        assert utils.choose_threads(32, 4500, 1000) == 5
+        assert utils.choose_threads(4, 100000, 1000) == 4
+        assert utils.choose_threads(4, 0, 1000) == 1
+
+    def test_allocate_stage_threads(self):
+        class ArgsObject:
+            pass
+        arguments = ArgsObject
+        arguments.threads = 32
+        arguments.seq_recon = 'pyjar'
+        arguments.tree_threads = None
+        arguments.recon_threads = None
+        arguments.detect_threads = None
+        # Small problems use few threads
+        assert common.allocate_stage_threads(arguments, 10, 300) == {'tree': 1, 'recon': 1, 'detect': 1}
+        assert common.allocate_stage_threads(arguments, 400, 20000) == {'tree': 20, 'recon': 8, 'detect': 25}
+        # Explicit thread counts override the policy
+        arguments.recon_threads = 3
+        arguments.detect_threads = 2
+        assert common.allocate_stage_threads(arguments, 10, 300) == {'tree': 1, 'recon': 3, 'detect': 2}
+
+    def test_stage_graph(self):
+        finished_stages = []
+        stage_graph = common.StageGraph(4)
+        for name,dependencies,cost in [('search', [], 3), ('annotation', ['search'], 1), ('dating', [], 1)]:
+            stage_graph.add_stage(name, lambda threads, name = name: finished_stages.append(name),
+                                  dependencies = dependencies, cost = cost)
+        timings = stage_graph.run()
+        # Independent stages are started together, dividing the threads by cost
+        assert timings['search'][2] == 3 and timings['dating'][2] == 1
+        assert finished_stages.index('annotation') > finished_stages.index('search')
+        assert set(timings) == {'search', 'annotation', 'dating'}
+        # The values returned by the stages are kept as their results
+        assert stage_graph.results == {'search': None, 'annotation': None, 'dating': None}
+        stage_graph = common.StageGraph(2)
+        stage_graph.add_stage('dating', lambda threads: False)
+        stage_graph.run()
+        assert stage_graph.results['dating'] is False
+        with self.assertRaises(SystemExit):
+            stage_graph.add_stage('support', lambda threads: None, dependencies = ['sh_test'])
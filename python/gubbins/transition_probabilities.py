@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+# encoding: utf-8
+#
+# Wellcome Trust Sanger Institute
+# Copyright (C) 2013  Wellcome Trust Sanger Institute
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+#
+
+import collections
+import numpy
+
+class RateMatrixDecomposition:
+    """Eigendecomposition of an instantaneous rate matrix"""
+
+    def __init__(self, rate_matrix):
+        """Decomposes the rate matrix into its eigenvalues and eigenvectors"""
+        self.eigenvalues, self.eigenvectors = numpy.linalg.eig(numpy.asarray(rate_matrix, dtype = numpy.float64))
+        self.inverse_eigenvectors = numpy.linalg.inv(self.eigenvectors)
+
+    def log_pij(self, branch_lengths):
+        """Returns the flattened log transition probability matrices for an array of branch lengths"""
+        branch_lengths = numpy.asarray(branch_lengths, dtype = numpy.float64)
+        # P(t) = I + V(exp(Dt) - I)V^-1, which retains the precision of small off-diagonal
+        # probabilities on short branches
+        exponentials = numpy.expm1(numpy.multiply.outer(branch_lengths, self.eigenvalues))
+        pij = numpy.einsum('ik,bk,kj->bij',
+                            self.eigenvectors,
+                            exponentials,
+                            self.inverse_eigenvectors).real + numpy.eye(4)
+        with numpy.errstate(divide = 'ignore', invalid = 'ignore'):
+            log_pij = numpy.log(pij).astype(numpy.float32)
+        # Branches of zero length cannot have any substitutions
+        log_pij[branch_lengths == 0,:,:] = numpy.where(numpy.eye(4, dtype = bool), 0.0, numpy.NINF)
+        return log_pij.reshape(-1,16)
+
+class TransitionProbabilityCache:
+    """Least-recently-used cache of log transition probability matrices, indexed by the
+    rate matrix and branch length, which persists across the trees of successive iterations"""
+
+    def __init__(self, max_size = 2**20):
+        """Initialises an empty cache"""
+        self.max_size = max_size
+        self.matrices = collections.OrderedDict()
+        self.decompositions = {}
+        self.hits = 0
+        self.lookups = 0
+
+    def get_decomposition(self, rate_matrix):
+        """Returns the eigendecomposition of a rate matrix, calculating it if required"""
+        model_key = numpy.asarray(rate_matrix, dtype = numpy.float64).tobytes()
+        if model_key not in self.decompositions:
+            self.decompositions[model_key] = RateMatrixDecomposition(rate_matrix)
+        return model_key, self.decompositions[model_key]
+
+    def log_pij(self, rate_matrix, branch_lengths):
+        """Returns a (branches x 16) array of the flattened log transition probability matrices,
+        calculating those not in the cache in a single batch"""
+        model_key, decomposition = self.get_decomposition(rate_matrix)
+        branch_lengths = numpy.asarray(branch_lengths, dtype = numpy.float64)
+        log_pij = numpy.empty((branch_lengths.size,16), dtype = numpy.float32)
+        missing_lengths = {}
+        for i,branch_length in enumerate(branch_lengths.tolist()):
+            key = (model_key,branch_length)
+            if key in self.matrices:
+                self.matrices.move_to_end(key)
+                log_pij[i,:] = self.matrices[key]
+            else:
+                missing_lengths.setdefault(branch_length,[]).append(i)
+        self.lookups += branch_lengths.size
+        self.hits += branch_lengths.size - sum(len(indices) for indices in missing_lengths.values())
+        if len(missing_lengths) > 0:
+            new_log_pij = decomposition.log_pij(list(missing_lengths.keys()))
+            for (branch_length,indices),matrix in zip(missing_lengths.items(),new_log_pij):
+                log_pij[indices,:] = matrix
+                self.matrices[(model_key,branch_length)] = matrix.copy()
+            while len(self.matrices) > self.max_size:
+                self.matrices.popitem(last = False)
+        return log_pij
+
+    def clear(self):
+        """Empties the cache"""
+        self.matrices.clear()
+        self.decompositions.clear()
+        self.hits = 0
+        self.lookups = 0
+
+# Cache used by pyjar across successive reconstructions within a process
+transition_probability_cache = TransitionProbabilityCache()
@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+# encoding: utf-8
+#
+# Wellcome Trust Sanger Institute
+# Copyright (C) 2013  Wellcome Trust Sanger Institute
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+#
+
+import numpy
+from gubbins.newick import parse_newick, read_newick, write_newick
+
+class TreeArrays:
+    """Flat arrays describing a rooted tree, with the nodes indexed in postorder, which can be built once
+    and reused for repeated reconstructions on the same topology without parsing the tree"""
+
+    def __init__(self, taxon_labels, node_labels, parent_nodes, edge_lengths):
+        """Derives the children, leaves and preorder of the nodes from the index of the parent of each node
+        (-1 for the root); empty labels indicate nodes without a taxon or label, and edges without a length
+        are NaN"""
+        self.taxon_labels = [str(label) for label in taxon_labels]
+        self.node_labels = [str(label) for label in node_labels]
+        self.parent_nodes = numpy.asarray(parent_nodes, dtype = numpy.int32)
+        self.edge_lengths = numpy.asarray(edge_lengths, dtype = numpy.float64)
+        self.num_nodes = self.parent_nodes.size
+        self.postordered_nodes = numpy.arange(self.num_nodes, dtype = numpy.int32)
+        self.seed_node = int(numpy.flatnonzero(self.parent_nodes == -1)[0])
+        # Children are listed in their original order, which is that of their postorder indices
+        child_counts = numpy.bincount(self.parent_nodes[self.parent_nodes > -1], minlength = self.num_nodes)
+        self.child_nodes = numpy.full((self.num_nodes,max(int(child_counts.max(initial = 0)),1)), -1, dtype = numpy.int32)
+        child_positions = numpy.zeros(self.num_nodes, dtype = numpy.int64)
+        for node_index,parent_node in enumerate(self.parent_nodes.tolist()):
+            if parent_node > -1:
+                self.child_nodes[parent_node,child_positions[parent_node]] = node_index
+                child_positions[parent_node] += 1
+        self.leaf_nodes = numpy.flatnonzero(child_counts == 0).astype(numpy.int32)
+        # The preorder excludes the root, and visits the children of each node in order
+        preordered_nodes = []
+        stack = [self.seed_node]
+        while len(stack) > 0:
+            node_index = stack.pop()
+            preordered_nodes.append(node_index)
+            stack.extend(child for child in self.child_nodes[node_index,::-1].tolist() if child > -1)
+        self.preordered_nodes = numpy.array(preordered_nodes[1:], dtype = numpy.int32)
+
+    @classmethod
+    def from_tree(cls, tree):
+        """Converts a dendropy tree"""
+        node_indices = {}
+        taxon_labels = []
+        node_labels = []
+        parent_nodes = []
+        edge_lengths = []
+        for node_index,node in enumerate(tree.postorder_node_iter()):
+            node_indices[node] = node_index
+            taxon_labels.append(node.taxon.label.strip("'") if node.taxon is not None else '')
+            node_labels.append(str(node.label) if node.label else '')
+            edge_lengths.append(node.edge_length if node.edge_length is not None else numpy.nan)
+        for node,node_index in node_indices.items():
+            parent_nodes.append(node_indices[node.parent_node] if node.parent_node is not None else -1)
+        return cls(taxon_labels, node_labels, parent_nodes, edge_lengths)
+
+    @classmethod
+    def from_newick(cls, tree_filename):
+        """Reads a Newick tree file"""
+        return cls(*read_newick(tree_filename))
+
+    @classmethod
+    def from_newick_string(cls, tree_string):
+        """Reads a Newick string"""
+        return cls(*parse_newick(tree_string))
+
+    def save(self, filename):
+        """Writes the arrays to a .npz file"""
+        numpy.savez(filename,
+                    taxon_labels = numpy.array(self.taxon_labels, dtype = str),
+                    node_labels = numpy.array(self.node_labels, dtype = str),
+                    parent_nodes = self.parent_nodes,
+                    edge_lengths = self.edge_lengths)
+
+    @classmethod
+    def load(cls, filename):
+        """Reads the arrays written by save"""
+        with numpy.load(filename, allow_pickle = False) as tree_data:
+            return cls(tree_data['taxon_labels'].tolist(),
+                        tree_data['node_labels'].tolist(),
+                        tree_data['parent_nodes'],
+                        tree_data['edge_lengths'])
+
+    def as_string(self, taxon_labels = None, edge_lengths = None, suppress_internal = False):
+        """Returns the tree in Newick format, with the leaf taxon labels and the internal taxon and node labels,
+        as written by tree_as_string with quotes removed; the taxon labels and edge lengths of every node can be
+        replaced"""
+        taxon_labels = self.taxon_labels if taxon_labels is None else taxon_labels
+        edge_lengths = self.edge_lengths if edge_lengths is None else numpy.asarray(edge_lengths, dtype = numpy.float64)
+        labels = list(taxon_labels)
+        for node_index in numpy.flatnonzero(self.child_nodes[:,0] > -1).tolist():
+            if suppress_internal:
+                labels[node_index] = ''
+            else:
+                labels[node_index] = ' '.join(part for part in [labels[node_index], self.node_labels[node_index]] if part)
+        return write_newick(self.child_nodes, self.seed_node, labels, edge_lengths.tolist())
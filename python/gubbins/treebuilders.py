@@ -21,11 +21,13 @@
 
 import sys
 import os
+import shlex
 import subprocess
 
 from Bio import SeqIO
 
 from gubbins import utils
+from gubbins.runner import Command
 
 class Star:
     """Class for constructing star phylogenies"""
@@ -84,7 +86,7 @@ class RapidNJ:
         self.citation = "https://doi.org/10.1007/978-3-540-87361-7_10"
 
         command = [self.executable]
-        command.extend(["-i fa", "-t d", "-n"])
+        command.extend(["-i", "fa", "-t", "d", "-n"])
         command.extend(["-c", str(self.threads)])
         if self.model == 'JC':
             command.extend(["-a", "jc"])
@@ -94,10 +96,10 @@ class RapidNJ:
             command.extend(["-a", self.model])
         # Additional arguments
         if self.additional_args is not None:
-            command.extend([self.additional_args])
+            command.extend(shlex.split(self.additional_args))
         self.base_command = command
 
-    def tree_building_command(self, alignment_filename: str, input_tree: str, basename: str) -> str:
+    def tree_building_command(self, alignment_filename: str, input_tree: str, basename: str) -> Command:
         """Constructs the command to call the rapidNJ executable"""
         command = self.base_command.copy()
         # Alignment file needs to be first argument
@@ -107,11 +109,9 @@ class RapidNJ:
         # Specify output file
         output_tree = basename + self.tree_suffix
         command.extend(["-x", output_tree])
-        if not self.verbose:
-            command.extend([">", "/dev/null", "2>&1"])
-        return " ".join(command)
+        return Command(command, output_filename = None if self.verbose else os.devnull)
         
-    def bootstrapping_command(self, alignment_filename: str, input_tree: str, basename: str) -> str:
+    def bootstrapping_command(self, alignment_filename: str, input_tree: str, basename: str) -> Command:
         """Runs a bootstrapping analysis and annotates the nodes of a summary tree"""
         command = self.base_command.copy()
         # Alignment file needs to be first argument
@@ -123,9 +123,7 @@ class RapidNJ:
         # Number of bootstraps
         command.extend(["-b", str(self.bootstrap)])
         command.extend(["-x", output_tree])
-        if not self.verbose:
-            command.extend([">", "/dev/null", "2>&1"])
-        return " ".join(command)
+        return Command(command, output_filename = None if self.verbose else os.devnull)
 
 class FastTree:
     """Class for operations with the FastTree executable"""
@@ -169,15 +167,10 @@ class FastTree:
         command.extend(["-seed",self.seed])
         # Additional arguments
         if self.additional_args is not None:
-            command.extend([self.additional_args])
+            command.extend(shlex.split(self.additional_args))
         self.base_command = command
-        
-        # Set the number of threads for parallelisation
-        omp_threads_command = 'export OMP_NUM_THREADS=' + str(self.threads)
-        try:
-            subprocess.check_call(omp_threads_command, shell=True)
-        except subprocess.SubprocessError:
-            sys.exit("Failed to set number of threads for fasttree with command " + omp_threads_command)
+        # The number of threads for parallelisation is set in the environment of each command
+        self.environment = {'OMP_NUM_THREADS': str(self.threads)}
 
     def get_version(self,exe) -> str:
         """Gets the version of the tree building algorithm being used"""
@@ -191,7 +184,7 @@ class FastTree:
                 break
         return version
 
-    def tree_building_command(self, alignment_filename: str, input_tree: str, basename: str) -> str:
+    def tree_building_command(self, alignment_filename: str, input_tree: str, basename: str) -> Command:
         """Constructs the command to call the FastTree executable"""
         command = self.base_command.copy()
         if input_tree:
@@ -201,9 +194,7 @@ class FastTree:
         command.extend(["-out", output_tree])
         command.extend(["-log", basename + '.log'])
         command.append(alignment_filename)
-        if not self.verbose:
-            command.extend([">", "/dev/null", "2>&1"])
-        return " ".join(command)
+        return Command(command, output_filename = None if self.verbose else os.devnull, environment = self.environment)
     
     def get_info_filename(self, tmp: str, basename: str) -> str:
         """Returns the name of the file containing the fitted model parameters"""
@@ -215,7 +206,7 @@ class FastTree:
         fn = tmp + '/' + basename + '.treefile'
         return fn
 
-    def model_fitting_command(self, alignment_filename: str, input_tree: str, basename: str) -> str:
+    def model_fitting_command(self, alignment_filename: str, input_tree: str, basename: str) -> Command:
         """Fits a nucleotide substitution model to a tree and an alignment"""
         command = self.base_command.copy()
         command.extend(["-mllen","-nome"])
@@ -224,9 +215,9 @@ class FastTree:
         command.extend(["-log", basename + ".log"])
         command.extend(["-out", basename + ".treefile"])
         command.extend([alignment_filename])
-        return " ".join(command)
+        return Command(command, environment = self.environment)
         
-    def bootstrapping_command(self, alignment_filename: str, input_tree: str, basename: str, tmp: str) -> str:
+    def bootstrapping_command(self, alignment_filename: str, input_tree: str, basename: str, tmp: str) -> Command:
         """Runs a bootstrapping analysis and annotates the nodes of a summary tree"""
         command = self.base_command.copy()
         output_tree = basename + self.tree_suffix
@@ -236,20 +227,16 @@ class FastTree:
         command.extend(["-log", basename + ".log"])
         command.extend(["-n", str(self.bootstrap)])
         command.append(alignment_filename + ".bootstrapping.aln")
-        if not self.verbose:
-            command.extend([">", "/dev/null", "2>&1"])
-        return " ".join(command)
+        return Command(command, output_filename = None if self.verbose else os.devnull, environment = self.environment)
     
-    def sh_test(self, alignment_filename: str, input_tree: str, basename: str, tmp: str) -> str:
+    def sh_test(self, alignment_filename: str, input_tree: str, basename: str, tmp: str) -> Command:
         """Runs a single branch support test"""
         command = self.base_command.copy()
         command.extend(["-mllen","-nome"])
         command.extend(["-intree",input_tree])
         command.extend(["-out",tmp + "/" + input_tree + ".sh_support"])
         command.extend([alignment_filename])
-        if not self.verbose:
-            command.extend([">", "/dev/null", "2>&1"])
-        return " ".join(command)
+        return Command(command, output_filename = None if self.verbose else os.devnull, environment = self.environment)
 
     def get_bootstrapped_trees_file(self, tmp: str, basename: str) -> str:
         """Return bootstrapped tree files name"""
@@ -310,7 +297,7 @@ class IQTree:
         command.extend(["-seed",self.seed])
         # Additional arguments
         if self.additional_args is not None:
-            command.extend([self.additional_args])
+            command.extend(shlex.split(self.additional_args))
         self.base_command = command
 
     def get_version(self,exe) -> str:
@@ -325,7 +312,7 @@ class IQTree:
                 break
         return version
 
-    def tree_building_command(self, alignment_filename: str, input_tree: str, basename: str) -> str:
+    def tree_building_command(self, alignment_filename: str, input_tree: str, basename: str) -> Command:
         """Constructs the command to call the IQTree executable"""
         command = self.base_command.copy()
         command.extend(["-s", alignment_filename, "-pre", basename])
@@ -333,9 +320,9 @@ class IQTree:
             command.extend(["-t", input_tree])
         if not self.verbose:
             command.append("-quiet")
-        return " ".join(command)
+        return Command(command)
 
-    def internal_sequence_reconstruction_command(self, alignment_filename: str, input_tree: str, basename: str) -> str:
+    def internal_sequence_reconstruction_command(self, alignment_filename: str, input_tree: str, basename: str) -> Command:
         """Constructs the command to call the IQTree executable for ancestral sequence reconstruction"""
         command = self.base_command.copy()
         command.extend(["-asr"])
@@ -344,7 +331,7 @@ class IQTree:
             command.extend(["-te", input_tree])
         if not self.verbose:
             command.append("-quiet")
-        return " ".join(command)
+        return Command(command)
 
     def convert_raw_ancestral_states_to_fasta(self, input_filename, output_filename):
         """Converts the file containing ancestral sequences into FASTA format"""
@@ -379,36 +366,34 @@ class IQTree:
         fn = tmp + '/' + basename + '.treefile'
         return fn
 
-    def model_fitting_command(self, alignment_filename: str, input_tree: str, basename: str) -> str:
+    def model_fitting_command(self, alignment_filename: str, input_tree: str, basename: str) -> Command:
         """Fits a nucleotide substitution model to a tree and an alignment"""
         # Using http://www.iqtree.org/doc/Advanced-Tutorial#user-defined-substitution-models
         command = self.base_command.copy()
-        command.extend(["-s", alignment_filename, "-t", input_tree, "--prefix", basename, " -n 0 --mlrate", "-redo"])
-        return " ".join(command)
+        command.extend(["-s", alignment_filename, "-t", input_tree, "--prefix", basename, "-n", "0", "--mlrate", "-redo"])
+        return Command(command)
     
-    def bootstrapping_command(self, alignment_filename: str, input_tree: str, basename: str, tmp: str) -> str:
+    def bootstrapping_command(self, alignment_filename: str, input_tree: str, basename: str, tmp: str) -> Command:
         """Runs a bootstrapping analysis"""
         command = self.base_command.copy()
         command.extend(["-s", alignment_filename, "-t", input_tree, "--prefix", tmp + "/" + basename + ".bootstrapped", "-B", str(self.bootstrap), "-wbt"])
-        return " ".join(command)
+        return Command(command)
 
-    def sh_test(self, alignment_filename: str, input_tree: str, basename: str, tmp: str) -> str:
+    def sh_test(self, alignment_filename: str, input_tree: str, basename: str, tmp: str) -> Command:
         """Runs a single branch support test"""
         command = self.base_command.copy()
         command.extend(["-s", alignment_filename])
         command.extend(["--prefix", tmp + "/" + input_tree + ".sh_support"])
         command.extend(["-te", input_tree])
-        command.extend(["-alrt 0"])
-        if not self.verbose:
-            command.extend([">", "/dev/null", "2>&1"])
-        return " ".join(command)
+        command.extend(["-alrt", "0"])
+        return Command(command, output_filename = None if self.verbose else os.devnull)
         
     def get_bootstrapped_trees_file(self, tmp: str, basename: str) -> str:
         """Return bootstrapped tree files name"""
         file_name = tmp + "/" + basename + ".bootstrapped.ufboot"
         return file_name
     
-    def run_time_tree(self, alignment_filename: str, input_tree: str, date_file: str, tmp: str, basename: str, outgroup=None) -> str:
+    def run_time_tree(self, alignment_filename: str, input_tree: str, date_file: str, tmp: str, basename: str, outgroup=None) -> Command:
         """Run time calibration of tree"""
         command = self.base_command.copy()
         command.extend(["-s", alignment_filename])
@@ -416,23 +401,19 @@ class IQTree:
         command.extend(["--date", date_file])
         command.extend(["--prefix", os.path.join(tmp,basename)])
         command.extend(["-blfix"])
-        command.extend(["--date-options","' -l 0'"])
+        command.extend(["--date-options"," -l 0"])
         if outgroup is not None:
             command.extend(["-o", outgroup])
-        if not self.verbose:
-            command.extend([">", "/dev/null", "2>&1"])
-        return " ".join(command)
+        return Command(command, output_filename = None if self.verbose else os.devnull)
 
-    def run_model_comparison(self, alignment_filename: str, basename: str) -> str:
+    def run_model_comparison(self, alignment_filename: str, basename: str) -> Command:
         """Pick best model based on ML fit to data"""
         command = self.base_command.copy()
         command.extend(["-s", alignment_filename])
-        command.extend(["-m TESTONLY"])
-        command.extend(["-mset JC,K2P,HKY,GTR -cmax 4"])
+        command.extend(["-m", "TESTONLY"])
+        command.extend(["-mset", "JC,K2P,HKY,GTR", "-cmax", "4"])
         command.extend(["--prefix",basename])
-        if not self.verbose:
-            command.extend([">", "/dev/null", "2>&1"])
-        return " ".join(command)
+        return Command(command, output_filename = None if self.verbose else os.devnull)
 
 class RAxML:
     """Class for operations with the RAxML executable"""
@@ -488,7 +469,7 @@ class RAxML:
         command.extend(["-p",self.seed])
         # Additional arguments
         if self.additional_args is not None:
-            command.extend([self.additional_args])
+            command.extend(shlex.split(self.additional_args))
         self.base_command = command
 
     def get_version(self,exe) -> str:
@@ -503,26 +484,22 @@ class RAxML:
                 break
         return version
 
-    def tree_building_command(self, alignment_filename: str, input_tree: str, basename: str) -> str:
+    def tree_building_command(self, alignment_filename: str, input_tree: str, basename: str) -> Command:
         """Constructs the command to call the RAxML executable for tree building"""
         command = self.base_command.copy()
         command.extend(["-f", "d", "-p", str(1)])
         command.extend(["-s", alignment_filename, "-n", basename])
         if input_tree:
             command.extend(["-t", input_tree])
-        if not self.verbose:
-            command.extend([">", "/dev/null", "2>&1"])
-        return " ".join(command)
+        return Command(command, output_filename = None if self.verbose else os.devnull)
 
-    def internal_sequence_reconstruction_command(self, alignment_filename: str, input_tree: str, basename: str) -> str:
+    def internal_sequence_reconstruction_command(self, alignment_filename: str, input_tree: str, basename: str) -> Command:
         """Constructs the command to call the RAxML executable for ancestral sequence reconstruction"""
         command = self.base_command.copy()
         command.extend(["-f", "A", "-p", str(1)])
         command.extend(["-s", alignment_filename, "-n", basename])
         command.extend(["-t", input_tree])
-        if not self.verbose:
-            command.extend([">", "/dev/null", "2>&1"])
-        return " ".join(command)
+        return Command(command, output_filename = None if self.verbose else os.devnull)
 
     def select_executable_based_on_threads(self):
         """Chooses an appropriate executable"""
@@ -569,15 +546,15 @@ class RAxML:
         fn = tmp + '/RAxML_result.' + basename + '_reconstruction'
         return fn
 
-    def model_fitting_command(self, alignment_filename: str, input_tree: str, basename: str) -> str:
+    def model_fitting_command(self, alignment_filename: str, input_tree: str, basename: str) -> Command:
         """Fits a nucleotide substitution model to a tree and an alignment"""
         command = self.base_command.copy()
         command.extend(["-s", alignment_filename, "-n", os.path.basename(basename) + '_reconstruction', "-t", input_tree])
-        command.extend(["-f e"])
+        command.extend(["-f", "e"])
         command.extend(["-w",os.path.dirname(basename)])
-        return " ".join(command)
+        return Command(command)
     
-    def bootstrapping_command(self, alignment_filename: str, input_tree: str, basename: str, tmp: str) -> str:
+    def bootstrapping_command(self, alignment_filename: str, input_tree: str, basename: str, tmp: str) -> Command:
         """Runs a bootstrapping analysis and annotates the nodes of a summary tree"""
         # Run bootstraps
         command = self.base_command.copy()
@@ -585,22 +562,16 @@ class RAxML:
         command.extend(["-w",tmp])
         command.extend(["-x",self.seed])
         command.extend(["-#",str(self.bootstrap)])
-        # Output
-        if not self.verbose:
-            command.extend([">", "/dev/null", "2>&1"])
-        command.extend([";"])
-        return " ".join(command)
+        return Command(command, output_filename = None if self.verbose else os.devnull)
 
-    def sh_test(self, alignment_filename: str, input_tree: str, basename: str, tmp: str) -> str:
+    def sh_test(self, alignment_filename: str, input_tree: str, basename: str, tmp: str) -> Command:
         """Runs a single branch support test"""
         command = self.base_command.copy()
         command.extend(["-f", "J"])
         command.extend(["-s", alignment_filename, "-n", input_tree + ".sh_support"])
         command.extend(["-t", input_tree])
         command.extend(["-w",tmp])
-        if not self.verbose:
-            command.extend([">", "/dev/null", "2>&1"])
-        return " ".join(command)
+        return Command(command, output_filename = None if self.verbose else os.devnull)
 
     def get_bootstrapped_trees_file(self, tmp: str, basename: str) -> str:
         """Return bootstrapped tree files name"""
@@ -659,7 +630,7 @@ class RAxMLNG:
         command.extend(["--seed",self.seed])
         # Additional arguments
         if self.additional_args is not None:
-            command.extend([self.additional_args])
+            command.extend(shlex.split(self.additional_args))
         self.base_command = command
 
     def get_version(self,exe) -> str:
@@ -674,25 +645,21 @@ class RAxMLNG:
                 break
         return version
 
-    def tree_building_command(self, alignment_filename: str, input_tree: str, basename: str) -> str:
+    def tree_building_command(self, alignment_filename: str, input_tree: str, basename: str) -> Command:
         """Constructs the command to call the RAxMLNG executable for tree building"""
         command = self.base_command.copy()
         if "--search1" not in command:
             command.extend(["--search"])
         command.extend(["--msa", alignment_filename, "--prefix", basename])
-        if not self.verbose:
-            command.extend([">", "/dev/null", "2>&1"])
-        return " ".join(command)
+        return Command(command, output_filename = None if self.verbose else os.devnull)
 
-    def internal_sequence_reconstruction_command(self, alignment_filename: str, input_tree: str, basename: str) -> str:
+    def internal_sequence_reconstruction_command(self, alignment_filename: str, input_tree: str, basename: str) -> Command:
         """Constructs the command to call the RAxMLNG executable for ancestral sequence reconstruction"""
         command = self.base_command.copy()
         command.extend(["--ancestral"])
         command.extend(["--msa", alignment_filename, "--prefix", basename])
         command.extend(["--tree", input_tree])
-        if not self.verbose:
-            command.extend([">", "/dev/null", "2>&1"])
-        return " ".join(command)
+        return Command(command, output_filename = None if self.verbose else os.devnull)
 
     def select_executable_based_on_threads(self):
         """Chooses an appropriate executable"""
@@ -752,27 +719,23 @@ class RAxMLNG:
         fn = tmp + '/' + basename + '_reconstruction.raxml.bestTree'
         return fn
 
-    def model_fitting_command(self, alignment_filename: str, input_tree: str, basename: str) -> str:
+    def model_fitting_command(self, alignment_filename: str, input_tree: str, basename: str) -> Command:
         """Fits a nucleotide substitution model to a tree and an alignment"""
         command = self.base_command.copy()
         command.extend(["--evaluate"])
         command.extend(["--msa", alignment_filename, "--prefix", basename + '_reconstruction', "--tree", input_tree])
-        return " ".join(command)
+        return Command(command)
 
-    def bootstrapping_command(self, alignment_filename: str, input_tree: str, basename: str, tmp: str) -> str:
+    def bootstrapping_command(self, alignment_filename: str, input_tree: str, basename: str, tmp: str) -> Command:
         """Runs a bootstrapping analysis and annotates the nodes of a summary tree"""
         # Run bootstraps
         command = self.base_command.copy()
         command.extend(["--bootstrap"])
         command.extend(["--msa", alignment_filename, "--prefix", tmp + "/" + basename])
         command.extend(["--bs-trees",str(self.bootstrap)])
-        # Output
-        if not self.verbose:
-            command.extend([">", "/dev/null", "2>&1"])
-        command.extend([";"])
-        return " ".join(command)
+        return Command(command, output_filename = None if self.verbose else os.devnull)
 
-    def annotate_tree_using_bootstraps_command(self, alignment_filename: str, input_tree: str, bootstrapped_trees: str, basename: str, tmp: str, transfer = False) -> str:
+    def annotate_tree_using_bootstraps_command(self, alignment_filename: str, input_tree: str, bootstrapped_trees: str, basename: str, tmp: str, transfer = False) -> Command:
         # Annotate tree with bootstraps
         command = self.base_command.copy()
         command.extend(["--support"])
@@ -780,16 +743,15 @@ class RAxMLNG:
         command.extend(["--tree",input_tree])
         command.extend(["--prefix",tmp + "/" + basename + ".bootstrapped"])
         if transfer:
-            command.extend(["--bs-metric tbe"])
+            command.extend(["--bs-metric", "tbe"])
         else:
-            command.extend(["--bs-metric fbp"])
-        # Output
-        if not self.verbose:
-            command.extend([">", "/dev/null", "2>&1"])
-        command.extend([";"])
-        # Rename final file
-        command.extend(["cp",tmp + "/" + basename + ".bootstrapped.raxml.support", basename + ".tre.bootstrapped"])
-        return " ".join(command)
+            command.extend(["--bs-metric", "fbp"])
+        return Command(command, output_filename = None if self.verbose else os.devnull)
+
+    def get_annotated_tree_file(self, tmp: str, basename: str) -> str:
+        """Return the name of the tree annotated with bootstrap support values"""
+        file_name = tmp + "/" + basename + ".bootstrapped.raxml.support"
+        return file_name
 
     def get_bootstrapped_trees_file(self, tmp: str, basename: str) -> str:
         """Return bootstrapped tree files name"""
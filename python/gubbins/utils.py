@@ -25,10 +25,17 @@ import subprocess
 import re
 import numpy as np
 import collections
+import json
+import resource
+import sys
+import tempfile
+import time
+from contextlib import contextmanager
 from random import randint
 try:
     from multiprocessing.managers import SharedMemoryManager
     NumpyShared = collections.namedtuple('NumpyShared', ('name', 'shape', 'dtype'))
+    NumpyMapped = collections.namedtuple('NumpyMapped', ('filename', 'shape', 'dtype'))
 except ImportError as e:
     sys.stderr.write("This version of Gubbins requires python v3.8 or higher\n")
     sys.exit(0)
@@ -66,6 +73,66 @@ class VerbosePrinter:
                 print(message)
 
 
+class PhaseProfile:
+    """Class recording the wall-clock and CPU time of the named phases of a calculation"""
+
+    def __init__(self):
+        """Constructor"""
+        self.phases = {}
+        self.started = {}
+
+    def get_phase(self, name):
+        """Get the timings of a phase, which accumulate if the phase is entered repeatedly"""
+        if name not in self.phases:
+            self.phases[name] = {'wall_time': 0.0, 'cpu_time': 0.0, 'child_cpu_time': 0.0, 'worker_cpu_time': 0.0}
+        return self.phases[name]
+
+    def start(self, name):
+        """Starts timing a phase. The CPU time includes all threads of this process; that of child processes
+        is only reported by the operating system once they have exited, so is recorded separately"""
+        self.started[name] = (time.perf_counter(),
+                                resource.getrusage(resource.RUSAGE_SELF),
+                                resource.getrusage(resource.RUSAGE_CHILDREN))
+
+    def stop(self, name):
+        """Stops timing a phase"""
+        wall_start, self_usage, child_usage = self.started.pop(name)
+        new_self_usage = resource.getrusage(resource.RUSAGE_SELF)
+        new_child_usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+        phase = self.get_phase(name)
+        phase['wall_time'] += time.perf_counter() - wall_start
+        # Differences are rounded to the resolution of the operating system's accounting
+        phase['cpu_time'] += round(new_self_usage.ru_utime + new_self_usage.ru_stime
+                                    - self_usage.ru_utime - self_usage.ru_stime, 6)
+        phase['child_cpu_time'] += round(new_child_usage.ru_utime + new_child_usage.ru_stime
+                                            - child_usage.ru_utime - child_usage.ru_stime, 6)
+
+    @contextmanager
+    def phase(self, name):
+        """Times a phase within a with statement"""
+        self.start(name)
+        try:
+            yield
+        finally:
+            self.stop(name)
+
+    def add_worker_time(self, name, cpu_time):
+        """Adds the CPU time measured within the tasks run by workers during a phase, which persistent worker
+        processes do not report to this process"""
+        self.get_phase(name)['worker_cpu_time'] += cpu_time
+
+    def total(self, names = None):
+        """Get the timings summed over phases"""
+        phases = [self.phases[name] for name in (self.phases if names is None else names) if name in self.phases]
+        return {key: sum(phase[key] for phase in phases) for key in ['wall_time', 'cpu_time', 'child_cpu_time', 'worker_cpu_time']}
+
+    def write_json(self, filename, **details):
+        """Writes the timings of each phase, and their totals, with any further details of the calculation"""
+        with open(filename, 'w') as profile_file:
+            json.dump(dict(details, phases = self.phases, total = self.total()), profile_file, indent = 2)
+            profile_file.write('\n')
+
+
 def which(program: str):
     """Checks if a given program exists on the system. Works analogously to the UNIX "which" function"""
     program_and_parameters = program.split(" ")
@@ -185,6 +252,40 @@ def generate_shared_mem_array(in_array, smm):
     array_shared = NumpyShared(name = array_raw.name, shape = in_array.shape, dtype = in_array.dtype)
     return(array_shared)
 
+def create_mapped_array(shape, dtype, directory, fill_value = 0):
+    """Creates a numpy array memory-mapped from a new file in a directory, returning its representation"""
+    file_descriptor, filename = tempfile.mkstemp(prefix = 'mapped_', suffix = '.bin', dir = directory)
+    os.close(file_descriptor)
+    array_mapped = NumpyMapped(filename = filename, shape = tuple(shape), dtype = np.dtype(dtype))
+    if int(np.prod(shape)) > 0:
+        mapped_array = np.memmap(filename, dtype = dtype, mode = 'w+', shape = tuple(shape))
+        # New files are filled with zeros
+        if fill_value != 0:
+            mapped_array.fill(fill_value)
+        mapped_array.flush()
+        del mapped_array
+    return(array_mapped)
+
+def generate_mapped_array(in_array, directory):
+    """Generates a memory-mapped representation of a numpy array, copied into a file in a directory"""
+    array_mapped = create_mapped_array(in_array.shape, in_array.dtype, directory)
+    if in_array.size > 0:
+        attach_mapped_array(array_mapped)[:] = in_array[:]
+    return(array_mapped)
+
+def attach_mapped_array(array_mapped):
+    """Opens a memory-mapped representation of a numpy array for reading and writing"""
+    if int(np.prod(array_mapped.shape)) == 0:
+        return np.empty(array_mapped.shape, dtype = array_mapped.dtype)
+    return np.asarray(np.memmap(array_mapped.filename, dtype = array_mapped.dtype, mode = 'r+', shape = array_mapped.shape))
+
+def peak_memory_usage():
+    """Returns the peak resident memory (bytes) of this process and of the largest of its completed subprocesses"""
+    # Linux reports the maximum resident set size in kilobytes, macOS in bytes
+    scale = 1 if sys.platform == 'darwin' else 1024
+    return(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss*scale,
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss*scale)
+
 def process_sequence_names(name):
     """Replaces disalowed characters in names with underscores"""
     new_name = name.replace("#","_").replace(":","_")
@@ -207,3 +308,21 @@ def set_seed(seed):
     else:
         seed = str(seed)
     return seed
+
+def split_threads(threads, costs):
+    """Divides threads between tasks in proportion to their relative costs, with at least one thread for each
+    task; the remainder is allocated to the tasks with the largest fractional shares"""
+    allocation = [1]*len(costs)
+    remaining_threads = threads - len(costs)
+    total_cost = sum(costs)
+    if remaining_threads > 0 and total_cost > 0:
+        shares = [remaining_threads*cost/total_cost for cost in costs]
+        allocation = [allocated + int(share) for allocated,share in zip(allocation,shares)]
+        remainder = threads - sum(allocation)
+        for index in sorted(range(len(costs)), key = lambda index: shares[index] - int(shares[index]), reverse = True)[:remainder]:
+            allocation[index] += 1
+    return allocation
+
+def choose_threads(threads, work, work_per_thread):
+    """Chooses the number of threads, up to a maximum, such that each thread has at least the given amount of work"""
+    return max(1, min(threads, -(-int(work)//int(work_per_thread))))
@@ -21,6 +21,7 @@
 #include <stdio.h>
 #include <stdlib.h>
 #include <string.h>
+#include <stdint.h>
 #include "csv_of_snp_sites.h"
 #include "parse_phylip.h"
 #include "string_cat.h"
@@ -36,6 +37,35 @@ int qrcmp(const void *x, const void *y) {
     return (strcmp(pattern_x.pattern,pattern_y.pattern));
 }
 
+// Convert a base to the integer encoding used for ancestral state reconstruction
+uint8_t encode_base_for_reconstruction(char base) {
+    switch (base)
+    {
+        case 'A': return 0;
+        case 'C': return 1;
+        case 'G': return 2;
+        case 'T': return 3;
+        case '-': return 4;
+        default: return 5;
+    }
+}
+
+// Exit if a file could not be opened or memory could not be allocated for the binary file
+void check_binary_output_allocation(void* pointer, char* description) {
+    if (pointer == NULL)
+    {
+        fprintf(stderr, "Unable to write base patterns in binary format: cannot %s\n", description);
+        exit(EXIT_FAILURE);
+    }
+}
+
+// Pad a binary file with zeros to the next multiple of eight bytes
+void pad_binary_file(FILE* file_pointer, int64_t section_length) {
+    int64_t padding = (8 - section_length % 8) % 8;
+    int64_t zero = 0;
+    fwrite(&zero, 1, padding, file_pointer);
+}
+
 char * generate_file_name(char prefix[], char suffix[]) {
     char * fn;
     fn = (char*) calloc(1024,sizeof(char));
@@ -67,6 +97,29 @@ void create_csv_of_snp_sites(char filename[], int number_of_snps, char ** bases_
     names_file_name = generate_file_name(filename,names_extension);
     names_file_pointer = fopen(names_file_name,"w");
 
+    // Binary file containing the patterns, positions and names, which can be memory-mapped:
+    // an eight byte identifier, then the numbers of patterns, samples and positions and the
+    // length of the names as 64-bit integers, followed by the (patterns x samples) matrix of
+    // encoded bases, packed two per byte with even samples in the low four bits, the 64-bit offsets of each pattern's positions, the 32-bit positions and
+    // the newline-terminated names, with each section padded to a multiple of eight bytes
+    FILE* binary_file_pointer;
+    char * binary_file_name;
+    char binary_extension[19] = {".base_patterns.bin"};
+    binary_file_name = generate_file_name(filename,binary_extension);
+    binary_file_pointer = fopen(binary_file_name,"wb");
+    check_binary_output_allocation(binary_file_pointer, "open file");
+    int64_t header[5] = {0, 0, 0, 0, 0};
+    memcpy(header, "GUBBPAT2", 8);
+    fwrite(header, sizeof(int64_t), 5, binary_file_pointer);
+    int64_t* pattern_position_offsets = malloc((number_of_snps + 1) * sizeof(int64_t));
+    check_binary_output_allocation(pattern_position_offsets, "allocate pattern offsets");
+    int32_t* pattern_positions = malloc((number_of_snps + 1) * sizeof(int32_t));
+    check_binary_output_allocation(pattern_positions, "allocate pattern positions");
+    int64_t packed_pattern_length = (number_of_samples + 1)/2;
+    uint8_t* encoded_pattern = malloc((packed_pattern_length + 1) * sizeof(uint8_t));
+    check_binary_output_allocation(encoded_pattern, "allocate encoded pattern");
+    int64_t number_of_patterns = 0;
+
     // Write out sequence names
     int i = 0;
     for (i = 0; i < number_of_samples; i++)
@@ -103,7 +156,27 @@ void create_csv_of_snp_sites(char filename[], int number_of_snps, char ** bases_
             }
             // Print base pattern to file
             fprintf(patterns_file_pointer, "%s\n", base_pattern_indices[j].pattern);
+            // An odd number of samples is padded with an unknown base
+            if (number_of_samples % 2 == 1)
+            {
+                encoded_pattern[packed_pattern_length - 1] = 0x50;
+            }
+            for (i = 0; i < number_of_samples; i++)
+            {
+                if (i % 2 == 0)
+                {
+                    encoded_pattern[i/2] = (encoded_pattern[i/2] & 0xF0) | encode_base_for_reconstruction(base_pattern_indices[j].pattern[i]);
+                }
+                else
+                {
+                    encoded_pattern[i/2] = (encoded_pattern[i/2] & 0x0F) | (encode_base_for_reconstruction(base_pattern_indices[j].pattern[i]) << 4);
+                }
+            }
+            fwrite(encoded_pattern, sizeof(uint8_t), packed_pattern_length, binary_file_pointer);
+            pattern_position_offsets[number_of_patterns] = j;
+            number_of_patterns++;
         }
+        pattern_positions[j] = base_pattern_indices[j].index;
         if (first == 1)
         {
             fprintf(positions_file_pointer, "%i", base_pattern_indices[j].index);
@@ -116,6 +189,26 @@ void create_csv_of_snp_sites(char filename[], int number_of_snps, char ** bases_
     }
     // Final end of line
     fprintf(positions_file_pointer, "\n");
+
+    // Complete the binary file
+    pattern_position_offsets[number_of_patterns] = number_of_snps;
+    pad_binary_file(binary_file_pointer, number_of_patterns*packed_pattern_length);
+    fwrite(pattern_position_offsets, sizeof(int64_t), number_of_patterns + 1, binary_file_pointer);
+    fwrite(pattern_positions, sizeof(int32_t), number_of_snps, binary_file_pointer);
+    pad_binary_file(binary_file_pointer, number_of_snps*sizeof(int32_t));
+    int64_t names_length = 0;
+    for (i = 0; i < number_of_samples; i++)
+    {
+        names_length += fprintf(binary_file_pointer, "%s\n", sequence_names[i]);
+    }
+    int64_t counts[4] = {number_of_patterns, number_of_samples, number_of_snps, names_length};
+    fseek(binary_file_pointer, 8, SEEK_SET);
+    fwrite(counts, sizeof(int64_t), 4, binary_file_pointer);
+    fclose(binary_file_pointer);
+    free(binary_file_name);
+    free(pattern_position_offsets);
+    free(pattern_positions);
+    free(encoded_pattern);
     
     // Tidy up memory
     fclose(patterns_file_pointer);
@@ -21,8 +21,15 @@
 #ifndef _CSV_OF_SNP_SITES_
 #define _CSV_OF_SNP_SITES_
 
+#include <stdint.h>
+#include <stdio.h>
+
 int qcmp(const void *x, const void *y);
 
+uint8_t encode_base_for_reconstruction(char base);
+
+void pad_binary_file(FILE* file_pointer, int64_t section_length);
+
 char * generate_file_name(char prefix[], char suffix[]);
 
 void create_csv_of_snp_sites(char filename[], int number_of_snps, char ** bases_for_snps, char ** sequence_names, int number_of_samples);
@@ -103,7 +103,7 @@ int generate_snp_sites(char filename[],  int exclude_gaps, char suffix[])
 	create_phylip_of_snp_sites(filename_without_directory, number_of_snps, bases_for_snps, sequence_names, number_of_samples,internal_nodes);
 	create_fasta_of_snp_sites(filename_without_directory, number_of_snps, bases_for_snps, sequence_names, number_of_samples,internal_nodes);
 
-    // Generate CSV for ancestral state reconstruction - only need version with gaps
+    // Generate CSV and binary files for ancestral state reconstruction - only need version with gaps
     if (exclude_gaps == 0)
     {
         create_csv_of_snp_sites(filename_without_directory, number_of_snps, bases_for_snps, sequence_names, number_of_samples);